@@ -0,0 +1,164 @@
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from core import sizing
+from core.equity_curve import PAYOUT_RATIO, GAS_FEE
+
+PARAMS = ['bet_threshold', 'min_bet_odds', 'min_pool_size', 'kelly_fraction', 'kelly_cap']
+
+
+def round_arrays(df):
+    """Column arrays of oracle called rounds with premium extremes, the input of evaluate()"""
+    df = df[df['oracle_called']].sort_values('epoch')
+    return {'epoch': df['epoch'].to_numpy(np.int64),
+            'max_premium': df['max_premium'].to_numpy(np.float64),
+            'min_premium': df['min_premium'].to_numpy(np.float64),
+            'total_amount': df['total_amount'].to_numpy(np.float64),
+            'bull_amount': df['bull_amount'].to_numpy(np.float64),
+            'bear_amount': df['bear_amount'].to_numpy(np.float64),
+            'bull_won': (df['close_price'] > df['lock_price']).to_numpy()}
+
+
+def load_rounds(pp, sync=True):
+    """
+    Premiums joined with the round archive, loaded once for any number of sweeps
+    Bet window extremes come from the premium recorder when it has samples, from the journal otherwise
+    """
+    if sync:
+        pp.round_archive.sync(pp)
+    if pp.premium_recorder is not None and len(pp.premium_recorder.records()):
+        premiums = pp.premium_recorder.premium_extremes(blocks_away=pp.blocks_away, execution_block=pp.execution_block)
+    else:
+        premiums = pp.journal.premium_extremes()
+    return round_arrays(pp.round_archive.frame(start_epoch=premiums['epoch'].min()).merge(premiums, on='epoch'))
+
+
+def param_grid(bet_threshold=(0.005,), min_bet_odds=(1.0,), min_pool_size=(0.0,), kelly_fraction=(0.0,),
+               kelly_cap=(1.0,)):
+    """Every combination of the given values, one row per combination in PARAMS order"""
+    return np.array(list(itertools.product(bet_threshold, min_bet_odds, min_pool_size, kelly_fraction, kelly_cap)),
+                    dtype=np.float64)
+
+
+def evaluate(rounds, params, win_probability=0.55, gas_fee=GAS_FEE):
+    """
+    PnL, bet count, hit rate and max drawdown of every parameter row over all rounds in one broadcast pass
+    A round is bet bull when its highest premium reaches bet_threshold, otherwise bear when its lowest reaches
+    -bet_threshold, as in record_parser. Final pool odds are used for the odds and pool gates.
+    Stakes are in units of a fixed bankroll, sized by core.sizing as live bets are: kelly_fraction of the fee adjusted
+    kelly stake capped at kelly_cap, a kelly_fraction of 0 bets kelly_cap flat
+    """
+    params = np.atleast_2d(params)
+    thres, min_odds, min_pool, fraction, cap = (params[:, i:i + 1] for i in range(len(PARAMS)))
+    total = rounds['total_amount']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bull_odds = np.where(rounds['bull_amount'] > 0, total / rounds['bull_amount'], 0.0)
+        bear_odds = np.where(rounds['bear_amount'] > 0, total / rounds['bear_amount'], 0.0)
+
+    bull = rounds['max_premium'] >= thres
+    bear = ~bull & (rounds['min_premium'] <= -thres)
+    odds = np.where(bull, bull_odds, bear_odds)
+    bet = (bull | bear) & (odds >= min_odds) & (total >= min_pool)
+    win = np.where(bull, rounds['bull_won'], ~rounds['bull_won'])
+
+    kelly = sizing.kelly(win_probability, odds)
+    stake = np.where(fraction > 0, sizing.bet_size(kelly, 1.0, fraction=fraction, cap=cap), cap)
+    bet &= stake > 0
+    pnl = np.where(bet, stake * (np.where(win, odds * PAYOUT_RATIO, 0.0) - 1) - gas_fee, 0.0)
+
+    equity = np.cumsum(pnl, axis=1)
+    peak = np.maximum(np.maximum.accumulate(equity, axis=1), 0)
+    bets = bet.sum(axis=1)
+    wins = (bet & win).sum(axis=1)
+    result = pd.DataFrame(params, columns=PARAMS)
+    result['pnl'] = equity[:, -1] if equity.shape[1] else 0.0
+    result['bets'] = bets
+    result['hit_rate'] = np.divide(wins, bets, out=np.zeros(len(bets)), where=bets > 0)
+    result['max_drawdown'] = (peak - equity).max(axis=1, initial=0)
+    return result
+
+
+_rounds = None
+
+
+def _init_worker(rounds):
+    global _rounds
+    _rounds = rounds
+
+
+def _evaluate_chunk(args):
+    params, win_probability, gas_fee = args
+    return evaluate(_rounds, params, win_probability=win_probability, gas_fee=gas_fee)
+
+
+def sweep(rounds, grid, win_probability=0.55, gas_fee=GAS_FEE, chunk_size=64, processes=None):
+    """
+    Evaluate a parameter grid in chunks of chunk_size rows (memory is chunk_size x rounds per array)
+    Grids of more than one chunk fan out over a process pool unless processes is 1
+    """
+    chunks = [(grid[i:i + chunk_size], win_probability, gas_fee) for i in range(0, len(grid), chunk_size)]
+    if len(chunks) <= 1 or processes == 1:
+        _init_worker(rounds)
+        results = [_evaluate_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes or os.cpu_count(), initializer=_init_worker,
+                                 initargs=(rounds,)) as pool:
+            results = list(pool.map(_evaluate_chunk, chunks))
+    return pd.concat(results, ignore_index=True).sort_values('pnl', ascending=False).reset_index(drop=True)
+
+
+def synthetic_rounds(n, seed=0):
+    rng = np.random.default_rng(seed)
+    bull_amount = rng.gamma(2, 5, n)
+    bear_amount = rng.gamma(2, 5, n)
+    premium = rng.normal(0, 0.005, n)
+    return {'epoch': np.arange(1, n + 1),
+            'max_premium': premium + np.abs(rng.normal(0, 0.002, n)),
+            'min_premium': premium - np.abs(rng.normal(0, 0.002, n)),
+            'total_amount': bull_amount + bear_amount,
+            'bull_amount': bull_amount,
+            'bear_amount': bear_amount,
+            'bull_won': rng.random(n) < 0.5 + np.clip(premium * 20, -0.2, 0.2)}
+
+
+def _loop_backtest(rounds, thres, gas_fee=GAS_FEE):
+    # record_parser style reference loop for a single threshold
+    capital = 0
+    for i in range(len(rounds['epoch'])):
+        total = rounds['total_amount'][i]
+        if rounds['max_premium'][i] >= thres:
+            capital -= 1 + gas_fee
+            if rounds['bull_won'][i]:
+                capital += total / rounds['bull_amount'][i] * PAYOUT_RATIO
+        elif rounds['min_premium'][i] <= -thres:
+            capital -= 1 + gas_fee
+            if not rounds['bull_won'][i]:
+                capital += total / rounds['bear_amount'][i] * PAYOUT_RATIO
+    return capital
+
+
+if __name__ == '__main__':
+    rounds = synthetic_rounds(20000)
+    thresholds = [0.005, 0.006, 0.007, 0.008, 0.009, 0.010]
+
+    start = time.perf_counter()
+    loop_pnl = [_loop_backtest(rounds, thres) for thres in thresholds]
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    result = sweep(rounds, param_grid(bet_threshold=thresholds), processes=1).sort_values('bet_threshold')
+    vector_time = time.perf_counter() - start
+    assert np.allclose(loop_pnl, result['pnl'])
+    print('6 thresholds x %s rounds: loop %.3fs, vectorised %.3fs' % (len(rounds['epoch']), loop_time, vector_time))
+
+    grid = param_grid(bet_threshold=np.linspace(0.002, 0.012, 11), min_bet_odds=[1.0, 1.5, 1.8, 2.0],
+                      min_pool_size=[0, 5, 10, 20], kelly_fraction=[0, 0.25, 0.5, 1.0], kelly_cap=[0.05, 0.1, 0.2])
+    for processes in [1, None]:
+        start = time.perf_counter()
+        result = sweep(rounds, grid, processes=processes)
+        print('%s combinations, processes=%s: %.3fs' % (len(grid), processes, time.perf_counter() - start))
+    print(result.head(10))
@@ -0,0 +1,49 @@
+import asyncio
+import json
+import time
+from typing import NamedTuple
+
+
+class BlockHead(NamedTuple):
+    number: int
+    received_at: float
+
+
+async def websocket_heads(ws_url):
+    """Yield new heads from an eth_subscribe('newHeads') websocket subscription"""
+    import websockets
+    async with websockets.connect(ws_url) as ws:
+        await ws.send(json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'eth_subscribe', 'params': ['newHeads']}))
+        resp = json.loads(await ws.recv())
+        if 'error' in resp:
+            raise ConnectionError('newHeads subscription refused: %s' % resp['error'])
+        while True:
+            msg = json.loads(await ws.recv())
+            if msg.get('method') == 'eth_subscription':
+                yield BlockHead(number=int(msg['params']['result']['number'], 16), received_at=time.perf_counter())
+
+
+async def filter_heads(w3, poll_interval=0.2):
+    """
+    Yield new heads from an eth_newBlockFilter, falling back to eth_blockNumber polling when filters are unsupported
+    The sync web3 calls run in the default executor so they never block the event loop
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        block_filter = await loop.run_in_executor(None, w3.eth.filter, 'latest')
+    except Exception:
+        block_filter = None
+    last = None
+    while True:
+        if block_filter is None or await loop.run_in_executor(None, block_filter.get_new_entries):
+            number = await loop.run_in_executor(None, w3.eth.get_block_number)
+            if last is None or number > last:
+                last = number
+                yield BlockHead(number=number, received_at=time.perf_counter())
+        await asyncio.sleep(poll_interval)
+
+
+def new_heads(w3=None, ws_url=None, poll_interval=0.2):
+    if ws_url is not None:
+        return websocket_heads(ws_url)
+    return filter_heads(w3, poll_interval=poll_interval)
@@ -0,0 +1,185 @@
+import sqlite3
+import threading
+import time
+
+from connect.web3_client import wallet
+from utils import logger
+
+# ledger position enum of the prediction contract
+POSITIONS = {0: 'bull', 1: 'bear'}
+
+
+class BetIndex:
+    """
+    On-disk index of placed bets keyed by epoch
+    claimed: 0 open, 1 claimed, -1 settled with nothing to claim
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS bets (epoch INTEGER PRIMARY KEY, direction TEXT, '
+                              'bet_size REAL, tx_hash TEXT, placed_at REAL, claimed INTEGER DEFAULT 0, claim_tx TEXT)')
+
+    def record_bet(self, epoch, direction, bet_size, tx_hash=None, placed_at=None):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO bets (epoch, direction, bet_size, tx_hash, placed_at) '
+                              'VALUES (?, ?, ?, ?, ?)', (epoch, direction, bet_size, tx_hash, placed_at or time.time()))
+
+    def bet(self, epoch):
+        with self.lock:
+            row = self.conn.execute('SELECT epoch, direction, bet_size, tx_hash, claimed FROM bets WHERE epoch = ?',
+                                    (epoch,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['epoch', 'direction', 'bet_size', 'tx_hash', 'claimed'], row))
+
+    def unclaimed(self, max_epoch):
+        with self.lock:
+            rows = self.conn.execute('SELECT epoch FROM bets WHERE claimed = 0 AND epoch <= ? ORDER BY epoch',
+                                     (max_epoch,)).fetchall()
+        return [row[0] for row in rows]
+
+    def mark(self, epochs, claimed, claim_tx=None):
+        with self.lock, self.conn:
+            self.conn.executemany('UPDATE bets SET claimed = ?, claim_tx = ? WHERE epoch = ?',
+                                  [(claimed, claim_tx, epoch) for epoch in epochs])
+
+    def max_epoch(self):
+        with self.lock:
+            return self.conn.execute('SELECT MAX(epoch) FROM bets').fetchone()[0]
+
+
+class Claimer:
+    """
+    Claims every unclaimed winning epoch in the bet index on its own thread
+    Eligibility of all open epochs is read in batched multicalls, claims go out as one claim([...]) when the
+    contract takes an epoch array, otherwise as back to back single epoch claims
+    """
+
+    def __init__(self, engine, index, interval=60, batch_size=100):
+        self.engine = engine
+        self.index = index
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = set()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        # set when a TaskRuntime runs poll() instead of the claimer's own thread
+        self.task = None
+        self.discovered = False
+        claim_inputs = [fn['inputs'] for fn in engine.contract.abi if fn.get('name') == 'claim']
+        self.multi_claim = bool(claim_inputs) and claim_inputs[0][0]['type'].endswith('[]')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def wake(self):
+        """Ask for a claim pass now, e.g. when a new round starts"""
+        if self.task is not None:
+            self.task.wake()
+            return
+        if self._thread is None:
+            self.start()
+        self._wake.set()
+
+    def poll(self):
+        """One claim pass, past bets are discovered from the contract before the first one"""
+        if not self.discovered:
+            try:
+                self.discover()
+            except Exception as e:
+                logger.Logger.log_message('claimer discovery error: %s' % str(e))
+            self.discovered = True
+        return self.run_once()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                logger.Logger.log_message('claimer error: %s' % str(e))
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def discover(self, page_size=1000):
+        """Add bets placed outside this process (or before the index existed) from getUserRounds"""
+        functions = self.engine.contract.functions
+        cursor = 0
+        while True:
+            epochs, cursor = functions.getUserRounds(wallet[0], cursor, page_size).call()
+            new_epochs = [epoch for epoch in epochs if self.index.bet(epoch) is None]
+            for start in range(0, len(new_epochs), self.batch_size):
+                chunk = new_epochs[start:start + self.batch_size]
+                _, ledgers = self.engine.multicall.aggregate([functions.ledger(epoch, wallet[0]) for epoch in chunk])
+                for epoch, ledger in zip(chunk, ledgers):
+                    self.index.record_bet(epoch, POSITIONS[ledger[0]], float(self.engine.w3.fromWei(ledger[1], 'ether')))
+                    if ledger[2]:
+                        self.index.mark([epoch], 1)
+            if len(epochs) < page_size:
+                return
+
+    def eligibility(self, epochs):
+        """Split epochs into (claimable, settled without payout, already claimed), unsettled rounds are left out"""
+        functions = self.engine.contract.functions
+        claimable, lost, claimed = [], [], []
+        for start in range(0, len(epochs), self.batch_size):
+            chunk = epochs[start:start + self.batch_size]
+            calls = []
+            for epoch in chunk:
+                calls += [functions.claimable(epoch, wallet[0]), functions.refundable(epoch, wallet[0]),
+                          functions.ledger(epoch, wallet[0]), functions.rounds(epoch)]
+            _, resp = self.engine.multicall.aggregate(calls)
+            for i, epoch in enumerate(chunk):
+                is_claimable, is_refundable, ledger, round_resp = resp[i * 4:i * 4 + 4]
+                if ledger is not None and ledger[2]:
+                    claimed.append(epoch)
+                elif is_claimable or is_refundable:
+                    claimable.append(epoch)
+                elif round_resp is not None and round_resp[-1]:
+                    lost.append(epoch)
+        return claimable, lost, claimed
+
+    def run_once(self, epochs=None):
+        """Claim the given epochs, or every open epoch of finished rounds in the index, returns the claim tx hashes"""
+        if epochs is None:
+            epochs = self.index.unclaimed(self.engine.current_epoch() - 2)
+        epochs = [epoch for epoch in epochs if epoch not in self.pending]
+        if not epochs:
+            return []
+        claimable, lost, claimed = self.eligibility(epochs)
+        self.index.mark(lost, -1)
+        self.index.mark(claimed, 1)
+        if not claimable:
+            return []
+        logger.Logger.log_message('claiming epochs: %s' % str(claimable))
+        batches = [claimable] if self.multi_claim else [[epoch] for epoch in claimable]
+        tx_hashes = []
+        for batch in batches:
+            args = batch if self.multi_claim else batch[0]
+            tx_hash = self.engine._build_and_send_tx(self.engine.contract.functions.claim(args))
+            self.pending.update(batch)
+            self.engine.receipts.track(tx_hash, callback=lambda future, batch=batch, tx_hash=tx_hash.hex():
+                                       self.on_receipt(batch, tx_hash, future))
+            tx_hashes.append(tx_hash)
+        return tx_hashes
+
+    def on_receipt(self, epochs, tx_hash, future):
+        self.pending.difference_update(epochs)
+        try:
+            receipt = future.result()
+        except Exception as e:
+            logger.Logger.log_message('claim %s receipt error: %s' % (str(epochs), str(e)))
+            return
+        if receipt['status'] == 1:
+            self.index.mark(epochs, 1, claim_tx=tx_hash)
+            self.engine.on_claimed(epochs, tx_hash)
@@ -0,0 +1,115 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+# Share of the pool paid out to winners
+PAYOUT_RATIO = 0.97
+# Two transactions per round, bet and claim
+GAS_FEE = 0.0006 * 2
+# 5 minute rounds
+ROUNDS_PER_YEAR = 12 * 24 * 365
+
+
+def round_pnl(win, odds, bet_size=1.0, gas_fee=GAS_FEE, payout_ratio=PAYOUT_RATIO, bet=None):
+    """PnL of every round, the stake and gas are lost on each bet and winners get odds x payout ratio x stake back"""
+    win = np.asarray(win, dtype=bool)
+    payout = np.where(win, np.asarray(odds, dtype=np.float64) * payout_ratio, 0.0)
+    pnl = bet_size * (payout - 1) - gas_fee
+    return pnl if bet is None else np.where(bet, pnl, 0.0)
+
+
+def equity(pnl):
+    """Cumulative PnL starting from 0, one point longer than pnl"""
+    return np.concatenate([[0.0], np.cumsum(pnl)])
+
+
+def drawdown(curve):
+    return np.maximum.accumulate(curve) - curve
+
+
+def max_drawdown(curve):
+    return float(drawdown(curve).max(initial=0))
+
+
+def rolling_hit_rate(win, window=100):
+    """Hit rate of the last `window` bets at every bet, shorter windows at the start"""
+    wins = np.cumsum(np.asarray(win, dtype=np.float64))
+    lagged = np.concatenate([np.zeros(min(window, len(wins))), wins[:-window]])
+    return (wins - lagged) / np.minimum(np.arange(1, len(wins) + 1), window)
+
+
+def sharpe(pnl, periods_per_year=ROUNDS_PER_YEAR):
+    """Mean over standard deviation of per round PnL, annualised with periods_per_year"""
+    pnl = np.asarray(pnl, dtype=np.float64)
+    std = pnl.std(ddof=1) if len(pnl) > 1 else 0.0
+    return float(pnl.mean() / std * np.sqrt(periods_per_year)) if std > 0 else 0.0
+
+
+def bet_odds(df):
+    """Odds of the side each row bet on, from direction and bull_odds / bear_odds columns"""
+    return np.where(df['direction'].to_numpy() == 'bull', df['bull_odds'].to_numpy(), df['bear_odds'].to_numpy())
+
+
+def stats(pnl, win):
+    curve = equity(pnl)
+    return {'bets': len(pnl),
+            'wins': int(np.count_nonzero(win)),
+            'hit_rate': float(np.mean(win)) if len(win) else 0.0,
+            'pnl': float(curve[-1]),
+            'max_drawdown': max_drawdown(curve),
+            'sharpe': sharpe(pnl)}
+
+
+def summary(df, bet_size=1.0, gas_fee=GAS_FEE, payout_ratio=PAYOUT_RATIO):
+    """Stats of all bets and of bull and bear bets alone for a frame of settled bets (direction, win, odds columns)"""
+    win = df['win'].to_numpy(dtype=bool)
+    pnl = round_pnl(win, bet_odds(df), bet_size=bet_size, gas_fee=gas_fee, payout_ratio=payout_ratio)
+    direction = df['direction'].to_numpy()
+    resp = {'all': stats(pnl, win)}
+    for side in ['bull', 'bear']:
+        mask = direction == side
+        resp[side] = stats(pnl[mask], win[mask])
+    return pd.DataFrame(resp).T
+
+
+def _loop_equity(df, bet_size, gas_fee):
+    # result_stats(show=True) loop kept as the benchmark reference
+    pnl = 0
+    pnl_list = [0]
+    for game in df.iterrows():
+        pnl -= bet_size
+        pnl -= gas_fee
+        if game[1]['win']:
+            if game[1]['direction'] == 'bull':
+                pnl += game[1]['bull_odds'] * 0.97 * bet_size
+            if game[1]['direction'] == 'bear':
+                pnl += game[1]['bear_odds'] * 0.97 * bet_size
+        pnl_list.append(pnl)
+    return pnl_list
+
+
+if __name__ == '__main__':
+    n = 100000
+    rng = np.random.default_rng(0)
+    bull_amount = rng.gamma(2, 5, n)
+    bear_amount = rng.gamma(2, 5, n)
+    df = pd.DataFrame({'direction': np.where(rng.random(n) < 0.5, 'bull', 'bear'),
+                       'win': rng.random(n) < 0.52,
+                       'bull_odds': (bull_amount + bear_amount) / bull_amount,
+                       'bear_odds': (bull_amount + bear_amount) / bear_amount})
+
+    start = time.perf_counter()
+    loop_curve = _loop_equity(df, 0.02, GAS_FEE)
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    curve = equity(round_pnl(df['win'], bet_odds(df), bet_size=0.02))
+    vector_time = time.perf_counter() - start
+    assert np.allclose(loop_curve, curve)
+    start = time.perf_counter()
+    resp = summary(df, bet_size=0.02)
+    hit_rate = rolling_hit_rate(df['win'])
+    summary_time = time.perf_counter() - start
+    print('%s rounds: iterrows loop %.3fs, vectorised curve %.4fs (%.0fx), full summary %.4fs' % (
+        n, loop_time, vector_time, loop_time / vector_time, summary_time))
+    print(resp)
@@ -0,0 +1,223 @@
+import bisect
+import collections
+import math
+import threading
+
+from eth_utils import to_hex
+
+# largest block range eth_feeHistory serves in one request
+MAX_FEE_HISTORY = 1024
+# geth and BSC nodes only accept a same nonce replacement 10% above the pending price
+REPLACEMENT_BUMP = 1.1
+
+
+class GasOracle:
+    """
+    Clearing gas price of recent blocks from eth_feeHistory, fetched incrementally and cached per block
+    A block's clearing price is its base fee plus the `percentile` priority fee paid in it, the price a bet needs to
+    get into that block. A price that cleared a share q of recent blocks is taken to land in each coming block with
+    probability q, so within n blocks with probability 1 - (1 - q) ^ n
+    """
+
+    def __init__(self, w3, blocks=200, percentile=10, min_gas_price=0, max_gas_price=None):
+        self.w3 = w3
+        self.blocks = blocks
+        self.percentile = percentile
+        self.min_gas_price = min_gas_price
+        self.max_gas_price = max_gas_price
+        self.lock = threading.Lock()
+        self.prices = collections.OrderedDict()
+        self.sorted_prices = []
+        self.last_block = None
+
+    def fee_history(self, block_count, newest):
+        resp = self.w3.provider.make_request('eth_feeHistory', [hex(block_count), hex(newest), [self.percentile]])
+        if 'error' in resp:
+            raise ValueError(resp['error'])
+        return resp['result']
+
+    def update(self, block_number):
+        """Fetch the blocks after the last one seen up to block_number, returns the number of new blocks"""
+        if self.last_block is not None and block_number <= self.last_block:
+            return 0
+        first = max(block_number - self.blocks + 1, 0 if self.last_block is None else self.last_block + 1)
+        added = 0
+        while first <= block_number:
+            newest = min(first + MAX_FEE_HISTORY - 1, block_number)
+            resp = self.fee_history(newest - first + 1, newest)
+            oldest = int(resp['oldestBlock'], 16)
+            with self.lock:
+                for i, reward in enumerate(resp.get('reward') or []):
+                    self.add(oldest + i, int(resp['baseFeePerGas'][i], 16) + int(reward[0], 16))
+                    added += 1
+            first = newest + 1
+        self.last_block = block_number
+        return added
+
+    def add(self, block_number, price):
+        if block_number in self.prices:
+            return
+        self.prices[block_number] = price
+        bisect.insort(self.sorted_prices, price)
+        while len(self.prices) > self.blocks:
+            _, expired = self.prices.popitem(last=False)
+            del self.sorted_prices[bisect.bisect_left(self.sorted_prices, expired)]
+
+    def inclusion_probability(self, gas_price, blocks):
+        """Probability a transaction at gas_price is included within the next `blocks` blocks"""
+        with self.lock:
+            if not self.sorted_prices:
+                return None
+            cleared = bisect.bisect_right(self.sorted_prices, gas_price) / len(self.sorted_prices)
+        return 1 - (1 - cleared) ** max(blocks, 1)
+
+    def price(self, blocks, target=0.99):
+        """
+        Lowest recent clearing price included within `blocks` blocks with probability target, in wei
+        min_gas_price when no history is cached, capped at max_gas_price
+        """
+        with self.lock:
+            prices = self.sorted_prices
+            if not prices:
+                return self.min_gas_price
+            # per block share of blocks the price has to clear
+            cleared = 1 - (1 - target) ** (1.0 / max(blocks, 1))
+            price = prices[min(max(int(math.ceil(cleared * len(prices))) - 1, 0), len(prices) - 1)]
+        price = max(price, self.min_gas_price)
+        return price if self.max_gas_price is None else min(price, self.max_gas_price)
+
+
+class StuckTransaction:
+    def __init__(self, tx_hash, deadline_block, sent_block):
+        self.tx_hash = tx_hash
+        self.hashes = [tx_hash]
+        self.deadline_block = deadline_block
+        self.sent_block = sent_block
+
+
+class FeeBumper:
+    """
+    Replace-by-fee for bets that are not mined `stuck_blocks` after sending
+    The stuck transaction is read back from the node and re-signed at the same nonce, value and calldata with the
+    oracle's price for the blocks left before the deadline, at least REPLACEMENT_BUMP above the last price. A bet whose
+    bump would pass the oracle's max_gas_price is left as it is. on_replaced(old_hash, new_hash) runs after every
+    replacement
+    """
+
+    def __init__(self, w3, private_key, oracle, stuck_blocks=2, target=0.99, on_replaced=None):
+        self.w3 = w3
+        self.private_key = private_key
+        self.oracle = oracle
+        self.stuck_blocks = stuck_blocks
+        self.target = target
+        self.on_replaced = on_replaced
+        self.pending = {}
+        self.replacements = 0
+
+    def watch(self, tx_hash, deadline_block, sent_block):
+        """Bump tx_hash while it is not mined and the chain is before deadline_block"""
+        tx_hash = tx_hash if isinstance(tx_hash, str) else to_hex(tx_hash)
+        self.pending[tx_hash] = StuckTransaction(tx_hash, deadline_block, sent_block)
+
+    def get_transaction(self, tx_hash):
+        resp = self.w3.provider.make_request('eth_getTransactionByHash', [tx_hash])
+        if 'error' in resp:
+            raise ValueError(resp['error'])
+        return resp['result']
+
+    def check(self, block_number):
+        """Replace the watched transactions stuck at block_number, returns the hashes of the replacements"""
+        replaced = []
+        for tx_hash, stuck in list(self.pending.items()):
+            if block_number >= stuck.deadline_block:
+                del self.pending[tx_hash]
+                continue
+            if block_number < stuck.sent_block + self.stuck_blocks:
+                continue
+            tx = self.get_transaction(tx_hash)
+            if tx is None or tx.get('blockNumber') is not None:
+                # mined, or dropped for a replacement sent elsewhere
+                del self.pending[tx_hash]
+                continue
+            new_hash = self.replace(tx, stuck.deadline_block - block_number - 1)
+            del self.pending[tx_hash]
+            if new_hash is None:
+                continue
+            stuck.tx_hash, stuck.sent_block = new_hash, block_number
+            stuck.hashes.append(new_hash)
+            self.pending[new_hash] = stuck
+            self.replacements += 1
+            replaced.append(new_hash)
+            if self.on_replaced is not None:
+                self.on_replaced(tx_hash, new_hash)
+        return replaced
+
+    def replace(self, tx, blocks_left):
+        new_price = max(self.oracle.price(blocks_left, target=self.target),
+                        int(math.ceil(int(tx['gasPrice'], 16) * REPLACEMENT_BUMP)))
+        if self.oracle.max_gas_price is not None and new_price > self.oracle.max_gas_price:
+            return None
+        replacement = {'to': tx['to'],
+                       'value': int(tx['value'], 16),
+                       'data': tx['input'],
+                       'nonce': int(tx['nonce'], 16),
+                       'gas': int(tx['gas'], 16),
+                       'gasPrice': new_price,
+                       'chainId': self.w3.eth.chain_id}
+        signed_txn = self.w3.eth.account.sign_transaction(replacement, private_key=self.private_key)
+        return to_hex(self.w3.eth.send_raw_transaction(signed_txn.rawTransaction))
+
+
+def simulate_bidding(market, strategies, bets=2000, blocks_left=(1, 2, 3, 4, 5), history=200, gas=200000,
+                     stuck_blocks=1, seed=0):
+    """
+    Inclusion before lock and gas paid of bidding strategies against a FeeMarket, without a node
+    A strategy is a function (oracle, blocks_left) -> gas price in wei. Every bet is fired at a random block with
+    blocks_left blocks to be mined in before its lock, and bumped with FeeBumper's rule (stuck_blocks None never bumps)
+    """
+    import random
+
+    rng = random.Random(seed)
+    start = history + 1
+    end = start + bets * 10
+    market.clearing_price(end + max(blocks_left) + 1)
+    resp = {}
+    for name, strategy in strategies.items():
+        landed, fees, bumps = 0, 0.0, 0
+        rng.seed(seed)
+        for _ in range(bets):
+            fired = rng.randint(start, end)
+            lock = fired + rng.choice(blocks_left) + 1
+            oracle = GasOracle(None, blocks=history)
+            for number in range(fired - history + 1, fired + 1):
+                oracle.add(number, market.prices[number])
+            price = strategy(oracle, lock - fired - 1)
+            sent = fired
+            for number in range(fired + 1, lock):
+                if price >= market.prices[number]:
+                    landed += 1
+                    fees += price * gas / 10 ** 18
+                    break
+                oracle.add(number, market.prices[number])
+                if stuck_blocks is not None and number - sent >= stuck_blocks:
+                    price = max(strategy(oracle, lock - number - 1), int(math.ceil(price * REPLACEMENT_BUMP)))
+                    sent = number
+                    bumps += 1
+        resp[name] = {'inclusion_rate': landed / bets, 'mean_fee_bnb': fees / landed if landed else None,
+                      'bumps': bumps}
+    return resp
+
+
+if __name__ == '__main__':
+    from connect.stub_node import FeeMarket
+
+    gwei = 10 ** 9
+    strategies = {'static_5_gwei': lambda oracle, blocks: 5 * gwei,
+                  'static_10_gwei': lambda oracle, blocks: 10 * gwei,
+                  'oracle_p90': lambda oracle, blocks: oracle.price(blocks, target=0.9),
+                  'oracle_p99': lambda oracle, blocks: oracle.price(blocks, target=0.99)}
+    for congestion_rate in [0.01, 0.05, 0.2]:
+        market = FeeMarket(congestion_rate=congestion_rate)
+        print('congestion rate %s' % congestion_rate)
+        for name, resp in simulate_bidding(market, strategies).items():
+            print('  %-15s %s' % (name, resp))
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from core import root
+from utils import logger
+
+EPOCH, PREMIUM, BET, RECEIPT, CLAIM = range(5)
+KINDS = {EPOCH: 'epoch', PREMIUM: 'premium', BET: 'bet', RECEIPT: 'receipt', CLAIM: 'claim'}
+DIRECTIONS = {'bull': 1, 'bear': -1}
+
+RECORD = np.dtype([('time', '<f8'), ('epoch', '<i8'), ('value', '<f8'), ('kind', 'u1'), ('direction', 'i1'),
+                   ('status', 'i1'), ('tx_hash', 'u1', (32,))])
+
+
+class Journal:
+    """
+    Append-only file of fixed size typed records (epoch, premium, bet, receipt, claim)
+    Reads memory map the file, an epoch -> record positions index gives O(1) lookups of one epoch
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            # drop a partial record left by a crash mid write
+            size = os.path.getsize(path)
+            if size % RECORD.itemsize:
+                with open(path, 'r+b') as f:
+                    f.truncate(size - size % RECORD.itemsize)
+        self.file = open(path, 'ab')
+        self.index = {}
+        self.count = 0
+        records = self.records()
+        if len(records):
+            order = np.argsort(records['epoch'], kind='stable')
+            epochs, starts = np.unique(records['epoch'][order], return_index=True)
+            for epoch, positions in zip(epochs.tolist(), np.split(order, starts[1:])):
+                self.index[epoch] = positions.tolist()
+        self.count = len(records)
+
+    def append(self, kind, epoch, value=0.0, direction=None, status=0, tx_hash=None, timestamp=None):
+        record = np.zeros(1, dtype=RECORD)
+        # raw bytes, an S32 field would strip the trailing zero bytes of a hash
+        record[0] = (timestamp or time.time(), epoch, value, kind, DIRECTIONS.get(direction, 0), status,
+                     np.frombuffer(bytes.fromhex(tx_hash[2:] if tx_hash.startswith('0x') else tx_hash), dtype='u1')
+                     if tx_hash else np.zeros(32, dtype='u1'))
+        self.extend(record)
+
+    def extend(self, records):
+        """Append an array of RECORD in one write"""
+        with self.lock:
+            self.file.write(records.tobytes())
+            self.file.flush()
+            for epoch in records['epoch'].tolist():
+                self.index.setdefault(epoch, []).append(self.count)
+                self.count += 1
+
+    def log_epoch(self, epoch, timestamp=None):
+        self.append(EPOCH, epoch, timestamp=timestamp)
+
+    def log_premium(self, epoch, premium, timestamp=None):
+        self.append(PREMIUM, epoch, value=premium, timestamp=timestamp)
+
+    def log_bet(self, epoch, direction, bet_size, tx_hash=None, timestamp=None):
+        self.append(BET, epoch, value=bet_size, direction=direction, tx_hash=tx_hash, timestamp=timestamp)
+
+    def log_receipt(self, epoch, tx_hash, status):
+        self.append(RECEIPT, epoch, status=status, tx_hash=tx_hash)
+
+    def log_claim(self, epoch, tx_hash, amount=0.0):
+        self.append(CLAIM, epoch, value=amount, tx_hash=tx_hash)
+
+    def records(self):
+        """Memory map of every record written so far"""
+        with self.lock:
+            count = os.path.getsize(self.path) // RECORD.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=RECORD)
+        return np.memmap(self.path, dtype=RECORD, mode='r', shape=(count,))
+
+    def epoch(self, epoch):
+        """Every record of one epoch in write order"""
+        with self.lock:
+            positions = list(self.index.get(epoch, []))
+        return self.records()[positions]
+
+    def scan(self, start_epoch=None, end_epoch=None, kind=None):
+        """Records with start_epoch <= epoch <= end_epoch (and of one kind), in write order"""
+        records = self.records()
+        mask = np.ones(len(records), dtype=bool)
+        if start_epoch is not None:
+            mask &= records['epoch'] >= start_epoch
+        if end_epoch is not None:
+            mask &= records['epoch'] <= end_epoch
+        if kind is not None:
+            mask &= records['kind'] == kind
+        return records[mask]
+
+    def frame(self, kind=None, start_epoch=None, end_epoch=None):
+        records = self.scan(start_epoch, end_epoch, kind)
+        df = pd.DataFrame({'datetime': pd.to_datetime(records['time'], unit='s'),
+                           'action': pd.Categorical.from_codes(records['kind'], list(KINDS.values())),
+                           'epoch': records['epoch'],
+                           'value': records['value'],
+                           'direction': np.where(records['direction'] > 0, 'bull',
+                                                 np.where(records['direction'] < 0, 'bear', None)),
+                           'status': records['status']})
+        df['tx_hash'] = ['0x' + tx_hash.tobytes().hex() if tx_hash.any() else None for tx_hash in records['tx_hash']]
+        return df
+
+    def bets(self, start_epoch=None, end_epoch=None):
+        """Placed bets with the columns result_analysis reads from the prediction log"""
+        df = self.frame(BET, start_epoch, end_epoch).rename(columns={'value': 'bet_size'})
+        return df[['datetime', 'epoch', 'direction', 'bet_size', 'tx_hash']]
+
+    def premium_extremes(self, start_epoch=None, end_epoch=None):
+        records = self.scan(start_epoch, end_epoch, PREMIUM)
+        df = pd.DataFrame({'epoch': records['epoch'], 'premium': records['value']})
+        return df.groupby('epoch')['premium'].agg(['max', 'min']).rename(
+            columns={'max': 'max_premium', 'min': 'min_premium'}).reset_index()
+
+    def close(self):
+        self.file.close()
+
+
+def convert_logs(journal, prediction_log='pancake_bnb_prediction.log', status_log='pancake_bnb_status.log'):
+    """
+    One-time import of the tilde separated prediction and status logs, tracked by a .converted file next to the journal
+    Only lines older than the journal's first record are imported, later ones were journaled as they were logged
+    """
+    marker = journal.path + '.converted'
+    if os.path.exists(marker):
+        return 0
+    records = journal.records()
+    cutoff = float(records['time'].min()) if len(records) else None
+    bets = logger.all_logs_parser(prediction_log, ['datetime', 'type', 'level', 'action', 'epoch', 'direction',
+                                                   'bet_size'])
+    bets = bets[bets['action'] == 'bet']
+    status = logger.all_logs_parser(log=status_log, columns=['datetime', 'type', 'level', 'action', 'resp'])
+    status['epoch'] = pd.to_numeric(status['resp'].where(status['action'] == 'epoch'), errors='coerce').ffill()
+    status = status[status['action'].isin(['epoch', 'premium']) & status['epoch'].notna()]
+    if cutoff is not None:
+        bets = bets[pd.to_datetime(bets['datetime']).map(pd.Timestamp.timestamp) < cutoff]
+        status = status[pd.to_datetime(status['datetime']).map(pd.Timestamp.timestamp) < cutoff]
+
+    records = np.zeros(len(bets) + len(status), dtype=RECORD)
+    records['time'] = np.concatenate([pd.to_datetime(bets['datetime']).map(pd.Timestamp.timestamp).to_numpy(float),
+                                      pd.to_datetime(status['datetime']).map(pd.Timestamp.timestamp).to_numpy(float)])
+    records['epoch'] = np.concatenate([bets['epoch'].astype(int), status['epoch'].astype(int)])
+    records['value'] = np.concatenate([bets['bet_size'].astype(float),
+                                       pd.to_numeric(status['resp'].where(status['action'] == 'premium')).fillna(0)])
+    records['kind'] = np.concatenate([np.full(len(bets), BET), np.where(status['action'] == 'epoch', EPOCH, PREMIUM)])
+    records['direction'] = np.concatenate([bets['direction'].map(DIRECTIONS).fillna(0), np.zeros(len(status))])
+    journal.extend(records[np.argsort(records['time'], kind='stable')])
+    with open(marker, 'w') as f:
+        f.write('%s records converted at %s\n' % (len(records), time.time()))
+    return len(records)
+
+
+if __name__ == '__main__':
+    journal = Journal(os.path.join(root.ROOT_DIR, 'pancake_bnb_journal.bin'))
+    print('converted %s records' % convert_logs(journal))
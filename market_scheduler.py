@@ -0,0 +1,169 @@
+import asyncio
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from connect.block_feed import new_heads
+from connect.transport import default_transport
+from connect.tx_manager import NonceManager
+from connect.web3_client import wallet
+from core.pancake_prediction import PancakePrediction
+from core.price_feed import PriceFeed
+from core.round_engine import RoundEngine
+
+# RPC requests that serve every market at once, split evenly between them in cost()
+SHARED = 'shared'
+
+
+class MarketCost:
+    """Blocks handled and CPU / wall time spent in one market's round logic"""
+
+    def __init__(self, history=1000):
+        self.blocks = 0
+        self.cpu_time = 0.0
+        self.wall_time = 0.0
+        self.latencies = collections.deque(maxlen=history)
+
+    def record(self, cpu_time, wall_time):
+        self.blocks += 1
+        self.cpu_time += cpu_time
+        self.wall_time += wall_time
+        self.latencies.append(wall_time)
+
+
+class MarketScheduler:
+    """
+    Hosts several prediction markets in one process on one transport, one block clock and one price feed per symbol
+    Every block the snapshot calls of all markets go out as a single multicall, calls that several markets make
+    (a shared chainlink feed) are sent once. The round logic of each market then runs on its own worker thread
+    """
+
+    def __init__(self, provider="https://bsc-dataseed.binance.org:443", transport=default_transport,
+                 max_workers=None):
+        self.provider = provider
+        self.transport = transport
+        self.max_workers = max_workers
+        self.markets = collections.OrderedDict()
+        self.price_feeds = {}
+        # one nonce counter per wallet, markets betting from it would otherwise hand out the same nonce
+        self.nonce_managers = {}
+        self.costs = {}
+        self.executor = None
+        self.engine = None
+
+    def price_feed(self, symbol):
+        if symbol not in self.price_feeds:
+            self.price_feeds[symbol] = PriceFeed(symbol=symbol)
+        return self.price_feeds[symbol]
+
+    def nonce_manager(self, address):
+        if address not in self.nonce_managers:
+            self.nonce_managers[address] = NonceManager(self.transport.web3(self.provider), address)
+        return self.nonce_managers[address]
+
+    def add_market(self, name, abi_name, address, config, symbol='BNBUSDT', **kwargs):
+        """
+        Build a PancakePrediction on the shared transport, price feed and wallet nonce counter, kwargs go to its
+        constructor
+        """
+        kwargs.setdefault('nonces', self.nonce_manager(wallet[0]))
+        with self.transport.stats.tagged(name):
+            engine = PancakePrediction(abi_name=abi_name, address=address, config=config, provider=self.provider,
+                                       transport=self.transport, symbol=symbol, price_feed=self.price_feed(symbol),
+                                       **kwargs)
+        return self.add(name, engine)
+
+    def add(self, name, engine):
+        if engine.w3 is not self.transport.web3(self.provider):
+            raise ValueError('market %s is not on the scheduler transport and provider' % name)
+        self.markets[name] = engine
+        self.costs[name] = MarketCost()
+        return engine
+
+    def snapshots(self, block_identifier='latest'):
+        """One snapshot per market from a single multicall"""
+        calls = {}
+        unique = []
+        positions = {}
+        for name, engine in self.markets.items():
+            with self.transport.stats.tagged(name):
+                functions = engine.snapshot_calls()
+            positions[name] = []
+            for function in functions:
+                key = (function.address, function._encode_transaction_data())
+                if key not in calls:
+                    calls[key] = len(unique)
+                    unique.append(function)
+                positions[name].append(calls[key])
+        multicall = next(iter(self.markets.values())).multicall
+        with self.transport.stats.tagged(SHARED):
+            block_number, resp = multicall.aggregate(unique, block_identifier=block_identifier)
+        snapshots = {}
+        for name, engine in self.markets.items():
+            with self.transport.stats.tagged(name):
+                snapshots[name] = engine.parse_snapshot(block_number, [resp[i] for i in positions[name]])
+        return snapshots
+
+    def run_market(self, name, snapshot):
+        engine = self.markets[name]
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        with self.transport.stats.tagged(name), engine.metrics.tick() as trace:
+            engine.safe_on_snapshot(snapshot)
+        engine.end_tick(trace)
+        self.costs[name].record(time.thread_time() - cpu_start, time.perf_counter() - start)
+
+    def on_block(self, block_number=None):
+        try:
+            snapshots = self.snapshots(block_identifier=block_number or 'latest')
+        except Exception as e:
+            for engine in self.markets.values():
+                engine.status_logger.log_warning('~'.join(['error', str(e)]))
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers or len(self.markets))
+        futures = [self.executor.submit(self.run_market, name, snapshot) for name, snapshot in snapshots.items()]
+        for future in futures:
+            future.result()
+
+    def start_feeds(self):
+        for feed in self.price_feeds.values():
+            feed.start()
+        for engine in self.markets.values():
+            if engine.price_feed not in self.price_feeds.values():
+                engine.price_feed.start()
+            if engine.mempool is not None:
+                engine.mempool.start()
+            if engine.premium_recorder is not None:
+                engine.premium_recorder.start()
+            engine.warm_up()
+
+    def start(self):
+        self.start_feeds()
+        while True:
+            self.on_block()
+            time.sleep(0.5)
+
+    def start_async(self, ws_url=None):
+        """Event driven loop, every market runs once per new head of one shared subscription"""
+        self.start_feeds()
+        w3 = self.transport.web3(self.provider)
+        self.engine = RoundEngine(self.on_block, new_heads(w3=w3, ws_url=ws_url))
+        asyncio.run(self.engine.run())
+
+    def cost(self):
+        """Per market blocks handled, CPU and wall ms per block and RPC requests, shared requests split evenly"""
+        requests = self.transport.stats.by_tag()
+        shared = requests.get(SHARED, 0) / max(len(self.markets), 1)
+        rows = []
+        for name, cost in self.costs.items():
+            latencies = sorted(cost.latencies)
+            rows.append({'market': name,
+                         'blocks': cost.blocks,
+                         'cpu_ms_per_block': cost.cpu_time / max(cost.blocks, 1) * 1000,
+                         'wall_ms_p50': latencies[len(latencies) // 2] * 1000 if latencies else None,
+                         'rpc_requests': requests.get(name, 0),
+                         'rpc_shared': shared,
+                         'rpc_per_block': (requests.get(name, 0) + shared) / max(cost.blocks, 1)})
+        return pd.DataFrame(rows)
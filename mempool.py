@@ -0,0 +1,118 @@
+import threading
+import time
+
+from eth_utils import function_abi_to_4byte_selector
+
+# bet functions of the prediction contracts and the side they add to
+BET_FUNCTIONS = {'betBull': 'bull', 'betBear': 'bear'}
+
+
+class PendingBet:
+    def __init__(self, tx_hash, sender, direction, value):
+        self.tx_hash = tx_hash
+        self.sender = sender
+        self.direction = direction
+        self.value = value
+        self.seen_at = time.time()
+
+
+class MempoolWatcher:
+    """
+    Bets on one prediction contract that are pending in the node's txpool, kept as projected pool additions
+    Every poll diffs txpool_content against the bets already known by hash, so each pending transaction is decoded
+    once and a mined or dropped one is taken off the projection when it leaves the pool
+    """
+
+    def __init__(self, w3, contract, poll_interval=0.2):
+        self.w3 = w3
+        self.address = contract.address.lower()
+        self.poll_interval = poll_interval
+        self.selectors = {'0x' + function_abi_to_4byte_selector(fn).hex(): BET_FUNCTIONS[fn['name']]
+                          for fn in contract.abi if fn.get('type') == 'function' and fn.get('name') in BET_FUNCTIONS}
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.amounts = {'bull': 0, 'bear': 0}
+        self.updated_at = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            # already polling, a supervised restart of the bot must not add a second poller
+            return self
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception:
+                # the node is unreachable or has no txpool api, retry on the next poll
+                pass
+
+    def fetch(self):
+        resp = self.w3.provider.make_request('txpool_content', [])
+        if 'error' in resp:
+            raise ValueError(resp['error'])
+        return resp['result']
+
+    def decode(self, tx):
+        """(direction, value in wei) of a pending transaction, None when it is not a bet on the contract"""
+        if (tx.get('to') or '').lower() != self.address:
+            return None
+        direction = self.selectors.get((tx.get('input') or tx.get('data') or '0x')[:10])
+        if direction is None:
+            return None
+        return direction, int(tx['value'], 16)
+
+    def poll(self):
+        """Fetch the txpool and update the projection, returns the number of new pending bets"""
+        return self.update(self.fetch())
+
+    def update(self, content):
+        txs = {}
+        for sender_txs in content.get('pending', {}).values():
+            for tx in sender_txs.values():
+                txs[tx['hash']] = tx
+        added = 0
+        with self.lock:
+            for tx_hash in [tx_hash for tx_hash in self.pending if tx_hash not in txs]:
+                bet = self.pending.pop(tx_hash)
+                self.amounts[bet.direction] -= bet.value
+            for tx_hash, tx in txs.items():
+                if tx_hash in self.pending:
+                    continue
+                resp = self.decode(tx)
+                if resp is None:
+                    continue
+                bet = PendingBet(tx_hash, tx['from'], *resp)
+                self.pending[tx_hash] = bet
+                self.amounts[bet.direction] += bet.value
+                added += 1
+            self.updated_at = time.time()
+        return added
+
+    def pending_amounts(self):
+        """(bull, bear) wei waiting in the mempool"""
+        with self.lock:
+            return self.amounts['bull'], self.amounts['bear']
+
+    def project(self, resp):
+        """A parsed round (amounts in BNB) with the pending bets added, as it would be if they all land before lock"""
+        bull, bear = self.pending_amounts()
+        if not bull and not bear:
+            return resp
+        resp = dict(resp)
+        resp['bull_amount'] += float(self.w3.fromWei(bull, 'ether'))
+        resp['bear_amount'] += float(self.w3.fromWei(bear, 'ether'))
+        resp['total_amount'] += float(self.w3.fromWei(bull + bear, 'ether'))
+        return resp
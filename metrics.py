@@ -0,0 +1,322 @@
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# values are kept in microseconds with 7 bits of sub-bucket precision (64 buckets per power of two past 128us), every
+# bucket is within 1/64 of its value
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT // 2
+# upper bounds of the Prometheus buckets, in seconds
+EXPORT_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+# JSON-RPC methods timed per contract function, by the selector of their calldata
+CALL_METHODS = ('eth_call', 'eth_estimateGas')
+# contract function names by '0x' prefixed selector, filled as contracts are loaded
+FUNCTION_NAMES = {}
+
+
+def register_functions(names):
+    FUNCTION_NAMES.update(names)
+
+
+def rpc_label(method, params):
+    """method, or method:function for a contract call, the selector itself when its abi was never loaded"""
+    if method not in CALL_METHODS or not params or not isinstance(params[0], dict):
+        return method
+    data = params[0].get('data') or params[0].get('input')
+    if not data:
+        return method
+    selector = data[:10] if isinstance(data, str) else '0x' + bytes(data[:4]).hex()
+    return '%s:%s' % (method, FUNCTION_NAMES.get(selector, selector))
+
+
+def bucket_index(value):
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKET_COUNT + (shift - 1) * SUB_BUCKET_HALF + (value >> shift) - SUB_BUCKET_HALF
+
+
+def bucket_bounds(index):
+    """[lower, upper) in microseconds of the values counted in a bucket"""
+    if index < SUB_BUCKET_COUNT:
+        return index, index + 1
+    shift, sub_bucket = divmod(index - SUB_BUCKET_COUNT, SUB_BUCKET_HALF)
+    mantissa = sub_bucket + SUB_BUCKET_HALF
+    return mantissa << (shift + 1), (mantissa + 1) << (shift + 1)
+
+
+class Histogram:
+    """HDR style log-linear histogram of durations in seconds, sparse so an idle stage costs nothing"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        index = bucket_index(max(int(seconds * 1e6), 0))
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, q):
+        """Upper bound in seconds of the bucket holding the q-th percentile (0-100)"""
+        with self.lock:
+            items = sorted(self.counts.items())
+            count = self.count
+        if not count:
+            return None
+        rank = max(int(round(count * q / 100.0)), 1)
+        seen = 0
+        for index, bucket_count in items:
+            seen += bucket_count
+            if seen >= rank:
+                return bucket_bounds(index)[1] / 1e6
+        return self.max
+
+    def cumulative(self, bounds=EXPORT_BUCKETS):
+        """Counts at or below each bound, a bucket is counted when its upper bound is within the bound"""
+        with self.lock:
+            items = sorted(self.counts.items())
+        resp = []
+        for bound in bounds:
+            resp.append(sum(count for index, count in items if bucket_bounds(index)[1] <= bound * 1e6))
+        return resp
+
+    def summary(self):
+        return {'count': self.count,
+                'mean_ms': self.total / self.count * 1000 if self.count else None,
+                'p50_ms': _ms(self.percentile(50)),
+                'p90_ms': _ms(self.percentile(90)),
+                'p99_ms': _ms(self.percentile(99)),
+                'max_ms': self.max * 1000}
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+class _NullStage:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class Stage:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        self.metrics.observe('stage', self.name, elapsed)
+        trace = getattr(self.metrics.local, 'trace', None)
+        if trace is not None:
+            trace[self.name] = trace.get(self.name, 0.0) + elapsed
+        return False
+
+
+class Tick:
+    """One pass of the round logic, collects the time of every stage run inside it"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.trace = {}
+
+    def __enter__(self):
+        self.previous = getattr(self.metrics.local, 'trace', None)
+        self.metrics.local.trace = self.trace
+        self.start = time.perf_counter()
+        return self.trace
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        self.metrics.local.trace = self.previous
+        self.metrics.observe('stage', 'tick', elapsed)
+        self.trace['tick'] = elapsed
+        return False
+
+
+class Metrics:
+    """
+    Stage and RPC timing histograms plus event counters, keyed by (metric, label)
+    Disabled, stage() and tick() hand back a shared no-op context manager and observe() returns at once
+    """
+
+    def __init__(self, enabled=False, namespace='pancake'):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = collections.Counter()
+        # Prometheus label name of each metric's label
+        self.label_names = {'stage': 'stage', 'rpc': 'method'}
+        self.local = threading.local()
+        self.server = None
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        return self
+
+    def histogram(self, metric, label):
+        key = (metric, label)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, metric, label, seconds):
+        if self.enabled:
+            self.histogram(metric, label).record(seconds)
+
+    def count(self, metric, label, value=1, label_name='stage'):
+        """Add value to a counter, label_name is the name its label is exported under"""
+        if self.enabled:
+            with self.lock:
+                self.counters[(metric, label)] += value
+                self.label_names.setdefault(metric, label_name)
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def tick(self):
+        if not self.enabled:
+            return NULL_STAGE
+        return Tick(self)
+
+    def middleware(self, make_request, w3):
+        """web3 middleware timing every JSON-RPC request by method, and contract calls by function as well"""
+        def middleware(method, params):
+            if not self.enabled:
+                return make_request(method, params)
+            start = time.perf_counter()
+            try:
+                return make_request(method, params)
+            finally:
+                self.histogram('rpc', rpc_label(method, params)).record(time.perf_counter() - start)
+        return middleware
+
+    def snapshot(self):
+        with self.lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+        resp = {'time': time.time(), 'histograms': {}, 'counters': {}}
+        for (metric, label), histogram in sorted(histograms.items()):
+            resp['histograms'].setdefault(metric, {})[label] = histogram.summary()
+        for (metric, label), value in sorted(counters.items()):
+            resp['counters'].setdefault(metric, {})[label] = value
+        return resp
+
+    def dump(self, path):
+        """Write the summary of every histogram and counter to a JSON file"""
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+
+    def prometheus(self):
+        """Prometheus text exposition of the histograms (seconds) and counters"""
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            label_names = dict(self.label_names)
+        lines = []
+        typed = set()
+        for (metric, label), histogram in histograms:
+            name = '%s_%s_seconds' % (self.namespace, metric)
+            label_name = label_names.get(metric, 'label')
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            labels = _labels(label_name, label)
+            for bound, count in zip(EXPORT_BUCKETS, histogram.cumulative()):
+                lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, bound, count))
+            lines.append('%s_bucket{%s,le="+Inf"} %s' % (name, labels, histogram.count))
+            lines.append('%s_sum{%s} %s' % (name, labels, histogram.total))
+            lines.append('%s_count{%s} %s' % (name, labels, histogram.count))
+        for (metric, label), value in counters:
+            name = '%s_%s_total' % (self.namespace, metric)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s{%s} %s' % (name, _labels(label_names.get(metric, 'label'), label), value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host='127.0.0.1', port=9108):
+        """Serve prometheus() on http://host:port/metrics from a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+
+default_metrics = Metrics()
+
+
+def _labels(label_name, label):
+    if label_name == 'method' and ':' in label:
+        method, function = label.split(':', 1)
+        return 'method="%s",function="%s"' % (method, function)
+    return '%s="%s"' % (label_name, label)
+
+
+def slowest_stage(trace):
+    """Stage that took the most time in a tick trace, the tick total itself excluded"""
+    stages = {name: elapsed for name, elapsed in (trace or {}).items() if name != 'tick'}
+    if not stages:
+        return 'unknown'
+    return max(stages, key=stages.get)
+
+
+if __name__ == '__main__':
+    metrics = Metrics(enabled=True)
+    disabled = Metrics()
+    n = 200000
+    for name, registry in [('disabled', disabled), ('enabled', metrics)]:
+        start = time.perf_counter()
+        for _ in range(n):
+            with registry.stage('noop'):
+                pass
+        print('%-8s %.3f us per stage' % (name, (time.perf_counter() - start) / n * 1e6))
+    histogram = metrics.histogram('stage', 'noop')
+    print(histogram.summary())
+    print(metrics.prometheus()[:500])
@@ -0,0 +1,31 @@
+from web3._utils.abi import get_abi_output_types
+from connect.web3_client import load_contract, address_dict
+
+
+def decode_function_output(w3, function, data):
+    """Decode raw eth_call return data the same way ContractFunction.call() does."""
+    output_types = get_abi_output_types(function.abi)
+    resp = w3.codec.decode_abi(output_types, data)
+    if len(resp) == 1:
+        return resp[0]
+    return list(resp)
+
+
+class Multicall:
+    def __init__(self, w3, address=address_dict['multicall3_address']):
+        self.w3 = w3
+        self.contract = load_contract(self.w3, 'multicall.abi', address)
+
+    def aggregate(self, functions, block_identifier='latest'):
+        """
+        Execute a list of contract function calls in a single eth_call
+        Returns (block_number, results), a failed call returns None in its slot
+        """
+        calls = [(self.contract.address, False, self.contract.encodeABI(fn_name='getBlockNumber'))]
+        calls += [(function.address, True, function._encode_transaction_data()) for function in functions]
+        resp = self.contract.functions.aggregate3(calls).call(block_identifier=block_identifier)
+        block_number = self.w3.codec.decode_abi(['uint256'], resp[0][1])[0]
+        results = []
+        for function, (success, data) in zip(functions, resp[1:]):
+            results.append(decode_function_output(self.w3, function, data) if success else None)
+        return block_number, results
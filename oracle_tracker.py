@@ -0,0 +1,182 @@
+import collections
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# BSC block time in seconds
+BLOCK_TIME = 3
+# proxy round ids are (phase id << 64) | aggregator round id
+PHASE_OFFSET = 64
+
+
+def split_round_id(round_id):
+    return round_id >> PHASE_OFFSET, round_id & ((1 << PHASE_OFFSET) - 1)
+
+
+def conditional_probability(samples, elapsed, horizon):
+    """
+    Empirical P(X <= horizon | X > elapsed) of a waiting time X from its samples
+    None when there are no samples, 1.0 when the wait already outlasted every sample
+    """
+    if len(samples) == 0:
+        return None
+    remaining = samples[samples > elapsed]
+    if len(remaining) == 0:
+        return 1.0
+    return float(np.mean(remaining <= horizon))
+
+
+class OracleTracker:
+    """
+    Update history of a Chainlink feed cached on disk by round id, with the estimates the bet trigger needs
+    heartbeat and deviation threshold are estimated from the history unless given. The update latency is the time
+    from the Binance price moving past the deviation threshold to the oracle publishing the next round, observed
+    tick by tick in observe()
+    """
+
+    def __init__(self, path, heartbeat=None, deviation=None, history=2000, max_latencies=1000):
+        self.path = path
+        self.history = history
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            # round ids are uint80, too wide for an sqlite integer, so they are keyed by phase and aggregator round
+            self.conn.execute('CREATE TABLE IF NOT EXISTS oracle_rounds (phase INTEGER, aggregator_round INTEGER, '
+                              'answer REAL, started_at REAL, updated_at REAL, PRIMARY KEY (phase, aggregator_round))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS oracle_latencies (updated_at REAL PRIMARY KEY, '
+                              'latency REAL)')
+        self.fixed_heartbeat = heartbeat
+        self.fixed_deviation = deviation
+        self.heartbeat = heartbeat
+        self.deviation = deviation
+        self.intervals = np.array([])
+        self.last = None
+        self.crossed_at = None
+        with self.lock:
+            rows = self.conn.execute('SELECT latency FROM oracle_latencies ORDER BY updated_at DESC LIMIT ?',
+                                     (max_latencies,)).fetchall()
+        self.latencies = collections.deque(reversed([row[0] for row in rows]), maxlen=max_latencies)
+        self.refresh()
+
+    def high_water_mark(self):
+        """(phase, aggregator round) of the newest cached round, (0, 0) when the cache is empty"""
+        with self.lock:
+            row = self.conn.execute('SELECT phase, aggregator_round FROM oracle_rounds '
+                                    'ORDER BY phase DESC, aggregator_round DESC LIMIT 1').fetchone()
+        return row or (0, 0)
+
+    def store(self, rounds):
+        """Store parsed round data dicts as returned by ChainlinkConnectivity.parse_round_data"""
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO oracle_rounds VALUES (?, ?, ?, ?, ?)',
+                                  [split_round_id(resp['round_id']) + (float(resp['answer']),
+                                                                       resp['started_at'].timestamp(),
+                                                                       resp['update_at'].timestamp())
+                                   for resp in rounds])
+
+    def sync(self, cl, multicall, batch_size=200):
+        """
+        Fetch the rounds missing between the cache and the latest round with batched getRoundData multicalls
+        An empty cache or a new aggregator phase is backfilled with the last `history` rounds of the phase,
+        returns the number of rounds written
+        """
+        latest = cl.latest_round_data()
+        phase, latest_round = split_round_id(latest['round_id'])
+        cached_phase, cached_round = self.high_water_mark()
+        start = cached_round + 1 if cached_phase == phase else 1
+        start = max(start, latest_round - self.history + 1, 1)
+        round_ids = [(phase << PHASE_OFFSET) | aggregator_round for aggregator_round in range(start, latest_round)]
+        written = 0
+        for offset in range(0, len(round_ids), batch_size):
+            chunk = round_ids[offset:offset + batch_size]
+            _, resp = multicall.aggregate([cl.contract.functions.getRoundData(round_id) for round_id in chunk])
+            # rounds that were never answered revert or come back with a zero timestamp
+            rounds = [cl.parse_round_data(round_resp) for round_resp in resp
+                      if round_resp is not None and round_resp[3] > 0]
+            self.store(rounds)
+            written += len(rounds)
+        self.store([latest])
+        self.refresh()
+        return written
+
+    def frame(self):
+        with self.lock:
+            return pd.read_sql_query('SELECT * FROM oracle_rounds ORDER BY phase, aggregator_round', self.conn)
+
+    def refresh(self):
+        """Recompute update intervals, heartbeat and deviation threshold from the cached history"""
+        with self.lock:
+            rows = self.conn.execute('SELECT phase, aggregator_round, answer, updated_at FROM oracle_rounds '
+                                     'ORDER BY phase DESC, aggregator_round DESC LIMIT ?',
+                                     (self.history,)).fetchall()
+        if not rows:
+            return
+        phase, aggregator_round, answer, updated_at = rows[0]
+        round_id = (phase << PHASE_OFFSET) | aggregator_round
+        if self.last is None or round_id > self.last[0]:
+            self.last = (round_id, answer, updated_at)
+        if len(rows) < 2:
+            return
+        rows = np.array([row[2:] for row in rows[::-1]], dtype=np.float64)
+        intervals = np.diff(rows[:, 1])
+        changes = np.abs(np.diff(rows[:, 0]) / rows[:-1, 0])
+        self.intervals = intervals[intervals > 0]
+        if self.fixed_heartbeat is None and len(self.intervals):
+            # heartbeat updates pile up at the heartbeat, everything shorter was a deviation update
+            self.heartbeat = float(np.quantile(self.intervals, 0.95))
+        if self.fixed_deviation is None and self.heartbeat is not None:
+            deviation_changes = changes[(intervals > 0) & (intervals < self.heartbeat * 0.9)]
+            if len(deviation_changes):
+                self.deviation = float(np.quantile(deviation_changes, 0.05))
+
+    def observe(self, chainlink, binance_price=None, now=None):
+        """
+        Feed one tick: the chainlink round data of the snapshot and the Binance price if one is at hand
+        A new round id is stored and closes a pending deviation, whose latency is recorded
+        """
+        now = now or time.time()
+        round_id = chainlink['round_id']
+        answer = float(chainlink['answer'])
+        if self.last is None or round_id > self.last[0]:
+            updated_at = chainlink['update_at'].timestamp()
+            if self.last is not None:
+                interval = updated_at - self.last[2]
+                if interval > 0:
+                    self.intervals = np.append(self.intervals[-(self.history - 1):], interval)
+            if self.crossed_at is not None:
+                latency = max(updated_at - self.crossed_at, 0.0)
+                self.latencies.append(latency)
+                with self.lock, self.conn:
+                    self.conn.execute('INSERT OR REPLACE INTO oracle_latencies VALUES (?, ?)', (updated_at, latency))
+            self.crossed_at = None
+            self.last = (round_id, answer, updated_at)
+            self.store([chainlink])
+        if binance_price is not None and self.deviation is not None:
+            if abs(binance_price - answer) / answer >= self.deviation:
+                if self.crossed_at is None:
+                    self.crossed_at = now
+            else:
+                self.crossed_at = None
+
+    def update_probability(self, binance_price, seconds_left, now=None):
+        """
+        Probability that the oracle publishes a new round within seconds_left, None while there is no history
+        Certain when the heartbeat falls in the window. Past the deviation threshold it is the share of observed
+        latencies that end in the window given the time already waited, otherwise the same over update intervals
+        """
+        if self.last is None:
+            return None
+        now = now or time.time()
+        _, answer, updated_at = self.last
+        age = now - updated_at
+        if self.heartbeat is not None and age + seconds_left >= self.heartbeat:
+            return 1.0
+        if self.deviation is not None and abs(binance_price - answer) / answer >= self.deviation:
+            waited = now - (self.crossed_at or now)
+            probability = conditional_probability(np.array(self.latencies), waited, waited + seconds_left)
+            if probability is not None:
+                return probability
+        return conditional_probability(self.intervals, age, age + seconds_left)
@@ -1,9 +1,31 @@
-import _thread
+import asyncio
+import collections
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import os
 import datetime as dt
-from connect.web3_client import ContractConnectivity
+from typing import NamedTuple
+from connect.multicall import Multicall, decode_function_output
+from connect.transport import default_transport
+from connect.tx_manager import NonceManager, PresignedBets
+from connect.receipt_tracker import ReceiptTracker
+from connect.mempool import MempoolWatcher
+from connect.gas_oracle import GasOracle, FeeBumper
+from connect.block_feed import new_heads
+from core.round_engine import RoundEngine
+from core.claimer import BetIndex, Claimer
+from core.round_archive import RoundArchive
+from core.journal import Journal, convert_logs
+from core.premium_recorder import PremiumRecorder
+from core.price_feed import PriceFeed
+from core.task_runtime import TaskRuntime, CRITICAL
+from core.metrics import default_metrics, slowest_stage
+from core.oracle_tracker import OracleTracker, BLOCK_TIME
+from core import sizing
+from core import signals
+from connect.web3_client import ContractConnectivity, ChainConstants, CallCache
 from connect.web3_client import ChainlinkConnectivity
 from connect.web3_client import address_dict, wallet
 from core import root
@@ -14,13 +36,39 @@ from utils import config_parser
 from tg_bot import tg_message_bot
 
 
+class ChainSnapshot(NamedTuple):
+    """Chain state read in a single aggregated eth_call, shared by the triggers of one tick"""
+    epoch: int
+    round: dict
+    paused: bool
+    block_number: int
+    chainlink: dict
+    fetched_at: float
+
+
 class PancakePrediction(ContractConnectivity):
     def __init__(self, abi_name, address, config, provider="https://bsc-dataseed.binance.org:443", logging=False,
-                 live=False, claim=False):
-        super(PancakePrediction, self).__init__(abi_name=abi_name, address=address, provider=provider)
+                 live=False, claim=False, transport=default_transport, chainlink_abi='chainlink_bnb_usd_pricefeed.abi',
+                 chainlink_address=address_dict['chainlink_bnb_usd_address'], symbol='BNBUSDT', price_feed=None,
+                 metrics=default_metrics, nonces=None, constants=None):
         config_file = config_parser.parse(config)
-        self.cl = ChainlinkConnectivity(abi_name='chainlink_bnb_usd_pricefeed.abi',
-                                        address=address_dict['chainlink_bnb_usd_address'])
+        # Ended rounds and past block timestamps are cached for good on disk, live reads for one block
+        cache = CallCache(path=os.path.join(root.ROOT_DIR, config_file['execution'].get('call_cache',
+                                                                                        'pancake_bnb_calls.db')))
+        super(PancakePrediction, self).__init__(abi_name=abi_name, address=address, provider=provider,
+                                                transport=transport, cache=cache)
+        self.cl = ChainlinkConnectivity(abi_name=chainlink_abi, address=chainlink_address, provider=provider,
+                                        transport=transport, cache=cache)
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        # Binance price streamed into memory, REST is only used while the stream is stale
+        self.symbol = symbol
+        self.price_feed = price_feed or PriceFeed(symbol=symbol)
+        self.multicall = Multicall(self.w3)
+        self.epoch_hint = None
+        # Stage timings of the decision pipeline, no-ops unless metrics is enabled
+        self.metrics = metrics
+        self.last_trace = None
+        self.window_state = None
         # Params
         self.win_probability = float(config_file['params']['win_probability'])
         self.bet_threshold = float(config_file['params']['bet_threshold'])
@@ -30,6 +78,19 @@ class PancakePrediction(ContractConnectivity):
         self.default_bet_size = float(config_file['params']['default_bet_size'])
         self.min_pool_size = float(config_file['params']['min_pool_size'])
         self.min_balance = float(config_file['params']['min_balance'])
+        # Share of Kelly staked live, 0 bets the flat live bet size
+        self.kelly_fraction = float(config_file['params'].get('kelly_fraction', 0))
+        self.kelly_cap = float(config_file['params'].get('kelly_cap', 1))
+        # Skip bets when the oracle is this likely to update before lock, 1 never skips
+        self.max_update_probability = float(config_file['params'].get('max_update_probability', 1))
+        # Features of every snapshot, a named pipeline strategy replaces bet_trigger and odds_trigger when set
+        self.signals = signals.SignalPipeline()
+        self.strategy = config_file['params'].get('strategy')
+        if self.strategy:
+            self.signals.add_strategy(self.strategy, signals.STRATEGIES[self.strategy](
+                bet_threshold=self.bet_threshold, min_bet_odds=self.min_bet_odds, min_pool_size=self.min_pool_size,
+                max_update_probability=self.max_update_probability,
+                min_velocity=float(config_file['params'].get('min_velocity', 0))))
         logger.Logger.log_message(
             'params: win prob: %s, bet thres: %s, min bet odds: %s, default bet size: %s, min bet: %s, max bet: %s, '
             'min pool: %s, min balance: %s' % (
@@ -43,30 +104,106 @@ class PancakePrediction(ContractConnectivity):
         # Execution Details
         self.blocks_away = int(config_file['execution']['blocks_away'])
         self.execution_block = int(config_file['execution']['execution_block'])
+        self.price_max_age = float(config_file['execution'].get('price_max_age', 2))
         logger.Logger.log_message('execution: gas price: %s, gas: %s, blocks away: %s, execution block: %s' % (
             str(self.gas_price), str(self.gas), str(self.blocks_away), str(self.execution_block)))
 
-        self.nonce = self.w3.eth.getTransactionCount(wallet[0])
-
-        # Triggers for real time betting
-        self.balance = self.get_balance()
+        # Nonces are tracked locally, bets are signed ahead of the lock window for the live bet sizes. Markets betting
+        # from the same wallet must share one NonceManager
+        self.nonces = nonces or NonceManager(self.w3, wallet[0])
+        self.live_bet_size = min(max(0.2, self.min_bet_size), self.max_bet_size)
+        presign_sizes = config_file['execution'].get('presign_sizes', str(self.live_bet_size))
+        self.presigned = PresignedBets(self.w3,
+                                       functions={'bull': self.contract.functions.betBull,
+                                                  'bear': self.contract.functions.betBear},
+                                       nonces=self.nonces, private_key=wallet[1],
+                                       sizes=[float(size) for size in presign_sizes.split(',')],
+                                       gas=self.gas, gas_price=self.w3.toWei(self.gas_price, 'gwei'))
+        # Decision to transaction sent, in seconds
+        self.send_latencies = collections.deque(maxlen=1000)
+        # Receipts are confirmed off the betting loop
+        self.receipts = ReceiptTracker(self.w3)
+        # Bets bid the gas price that lands them before lock with gas_target probability, gas_price is the floor,
+        # and are replaced at a higher price when still pending bump_blocks after sending
+        self.gas_oracle = None
+        self.fee_bumper = None
+        if config_file['execution'].get('gas_oracle', 'off') == 'on':
+            self.gas_target = float(config_file['execution'].get('gas_target', 0.99))
+            self.gas_oracle = GasOracle(self.w3, min_gas_price=self.w3.toWei(self.gas_price, 'gwei'),
+                                        max_gas_price=self.w3.toWei(
+                                            float(config_file['execution'].get('max_gas_price', 20)), 'gwei'))
+            self.fee_bumper = FeeBumper(self.w3, wallet[1], self.gas_oracle, target=self.gas_target,
+                                        stuck_blocks=int(config_file['execution'].get('bump_blocks', 2)),
+                                        on_replaced=self.on_bet_replaced)
+        # Pending bets in the node's txpool, odds are gated on the pools projected at lock. Needs a node exposing
+        # txpool_content, public BSC endpoints do not
+        self.mempool = MempoolWatcher(self.w3, self.contract) if config_file['execution'].get(
+            'mempool', 'off') == 'on' else None
+        # Placed bets are indexed on disk, winnings are claimed in bulk on the claimer thread
+        self.bet_index = BetIndex(os.path.join(root.ROOT_DIR,
+                                               config_file['execution'].get('bet_index', 'pancake_bnb_bets.db')))
+        self.claimer = Claimer(self, self.bet_index)
+        # Ended rounds are archived locally for analysis
+        self.round_archive = RoundArchive(os.path.join(root.ROOT_DIR, config_file['execution'].get(
+            'round_archive', 'pancake_bnb_rounds.db')))
+        # Typed epoch, premium, bet, receipt and claim records for analysis
+        self.journal = Journal(os.path.join(root.ROOT_DIR, config_file['execution'].get(
+            'journal', 'pancake_bnb_journal.bin')))
+        # Premium path sampled every premium_interval seconds off the betting loop, aligned to blocks and epochs
+        self.premium_recorder = None
+        if config_file['execution'].get('premium_recorder', 'off') == 'on':
+            premium_history = config_file['execution'].get('premium_history', 'pancake_bnb_premium.bin')
+            self.premium_recorder = PremiumRecorder(
+                os.path.join(root.ROOT_DIR, premium_history), self.price_feed,
+                interval=float(config_file['execution'].get('premium_interval', 0.25)), max_age=self.price_max_age)
+        # Chainlink update history, heartbeat, deviation threshold and update latency
+        oracle_heartbeat = config_file['execution'].get('oracle_heartbeat')
+        oracle_deviation = config_file['execution'].get('oracle_deviation')
+        self.oracle = OracleTracker(os.path.join(root.ROOT_DIR, config_file['execution'].get(
+            'oracle_history', 'pancake_bnb_oracle.db')),
+                                    heartbeat=float(oracle_heartbeat) if oracle_heartbeat else None,
+                                    deviation=float(oracle_deviation) if oracle_deviation else None)
+
+        # Min bet amount and chain id, kept on disk across restarts
+        self.constants = constants or ChainConstants(os.path.join(root.ROOT_DIR, config_file['execution'].get(
+            'chain_constants', 'pancake_bnb_constants.json')),
+                                        ttl=float(config_file['execution'].get('chain_constants_ttl', 86400)))
+
+        # Triggers for real time betting, the balance is fetched on first use or by warm_up()
+        self._balance = None
         self.live = live
         self.claim = claim
+        self.epoch = None
+        self.placed = False
+        # set when hosted by a TaskRuntime, background tasks are held back during the bet window
+        self.runtime = None
+        self.engine = None
+        self._stopped = threading.Event()
         logger.Logger.log_message('status: live: %s, claim: %s' % (str(self.live), str(self.claim)))
 
         self.logging = logging
         if self.logging:
             self.logger = logger.Logger(log_name=config_file['logging']['log_name'])
             self.status_logger = logger.Logger(log_name=config_file['logging']['status_log_name'])
+            # history logged before the journal existed, imported once
+            try:
+                convert_logs(self.journal, prediction_log=config_file['logging']['log_name'],
+                             status_log=config_file['logging']['status_log_name'])
+            except Exception as e:
+                logger.Logger.log_message('journal log conversion failed: %s' % str(e))
 
     def current_epoch(self):
-        resp = self.contract.functions.currentEpoch().call()
+        resp = self.cached_call(self.contract.functions.currentEpoch())
         return resp
 
-    def round_details(self, epoch):
+    def round_details(self, epoch, block_identifier='latest'):
+        # oracle called rounds are final
+        return self.parse_round(self.cached_call(self.contract.functions.rounds(epoch),
+                                                 block_identifier=block_identifier, final=lambda resp: resp[11]))
+
+    def parse_round(self, resp):
         keys = ['epoch', 'start_block', 'lock_block', 'end_block', 'lock_price', 'close_price', 'total_amount',
                 'bull_amount', 'bear_amount', 'reward_base_cal_amount', 'reward_amount', 'oracle_called']
-        resp = self.contract.functions.rounds(epoch).call()
         resp = dict(zip(keys, resp))
         for ether in ['total_amount', 'bull_amount', 'bear_amount',
                       'reward_base_cal_amount', 'reward_amount']:
@@ -76,20 +213,76 @@ class PancakePrediction(ContractConnectivity):
         return resp
 
     def paused(self):
-        resp = self.contract.functions.paused().call()
+        resp = self.cached_call(self.contract.functions.paused())
         return resp
 
+    def snapshot(self, block_identifier='latest'):
+        """
+        Read epoch, round, paused, block number and chainlink answer in one multicall
+        The current and next epoch rounds are both requested so an epoch change needs no extra round trip
+        """
+        block_number, resp = self.multicall.aggregate(self.snapshot_calls(), block_identifier=block_identifier)
+        return self.parse_snapshot(block_number, resp)
+
+    def snapshot_calls(self):
+        """Contract calls of one snapshot, a scheduler can aggregate those of several markets in one multicall"""
+        if self.epoch_hint is None:
+            self.epoch_hint = self.current_epoch()
+        return [self.contract.functions.currentEpoch(),
+                self.contract.functions.paused(),
+                self.cl.contract.functions.latestRoundData(),
+                self.contract.functions.rounds(self.epoch_hint),
+                self.contract.functions.rounds(self.epoch_hint + 1)]
+
+    def parse_snapshot(self, block_number, resp):
+        epoch, paused, chainlink = resp[:3]
+        if epoch == self.epoch_hint:
+            round_resp = resp[3]
+        elif epoch == self.epoch_hint + 1:
+            round_resp = resp[4]
+        else:
+            round_resp = self.cached_call(self.contract.functions.rounds(epoch), block_identifier=block_number,
+                                          final=lambda resp: resp[11])
+        self.epoch_hint = epoch
+        self.set_head(block_number)
+        self.cl.set_head(block_number)
+        return ChainSnapshot(epoch=epoch,
+                             round=self.parse_round(round_resp),
+                             paused=paused,
+                             block_number=block_number,
+                             chainlink=self.cl.parse_round_data(chainlink),
+                             fetched_at=time.time())
+
     def min_bet_amount(self):
-        resp = self.w3.fromWei(self.contract.functions.minBetAmount().call(), 'ether')
+        resp = self.w3.fromWei(self.constants.get('min_bet_amount:%s' % self.contract.address,
+                                                  self.contract.functions.minBetAmount().call), 'ether')
         return resp
 
+    def update_bet_limits(self):
+        """Raise min_bet_size to the contract's minBetAmount, a smaller bet reverts"""
+        self.min_bet_size = max(self.min_bet_size, float(self.min_bet_amount()))
+        self.live_bet_size = max(self.live_bet_size, self.min_bet_size)
+
+    def chain_id(self):
+        return self.constants.get('chain_id:%s' % self.provider, lambda: self.w3.eth.chain_id)
+
+    @property
+    def balance(self):
+        if self._balance is None:
+            self._balance = self.get_balance()
+        return self._balance
+
+    @balance.setter
+    def balance(self, balance):
+        self._balance = balance
+
     def _get_tx_params(self, value=0):
         """Get generic transaction parameters."""
         resp = {"from": wallet[0],
                 "value": value,
                 "gas": self.gas,
                 "gasPrice": self.w3.toWei(self.gas_price, 'gwei'),
-                "nonce": max(self.w3.eth.getTransactionCount(wallet[0]), self.nonce)
+                "nonce": self.nonces.reserve()
                 }
         return resp
 
@@ -101,18 +294,31 @@ class PancakePrediction(ContractConnectivity):
         base_tx_params = self._get_tx_params()
         if tx_params is not None:
             base_tx_params.update(tx_params)
-        tx = function.buildTransaction(base_tx_params)
-        self.logger.log_message('building tx: %s' % tx)
-        signed_txn = self.w3.eth.account.sign_transaction(tx, private_key=wallet[1])
         try:
-            return self.w3.eth.sendRawTransaction(signed_txn.rawTransaction)
-        finally:
-            self.nonce += 1
-
-    def place_bet(self, bet_size, direction):
+            with self.metrics.stage('build_tx'):
+                tx = function.buildTransaction(base_tx_params)
+            self.logger.log_message('building tx: %s' % tx)
+            with self.metrics.stage('sign'):
+                signed_txn = self.w3.eth.account.sign_transaction(tx, private_key=wallet[1])
+            with self.metrics.stage('send'):
+                return self.w3.eth.sendRawTransaction(signed_txn.rawTransaction)
+        except Exception:
+            self.nonces.resync()
+            raise
+
+    def place_bet(self, bet_size, direction, decided_at=None):
         if bet_size > 0:
-            bet_function = {'bull': self.contract.functions.betBull, 'bear': self.contract.functions.betBear}
-            return self._build_and_send_tx(bet_function[direction](), tx_params={'value': self.w3.toWei(bet_size, 'ether')})
+            with self.metrics.stage('send_presigned'):
+                tx_hash = self.presigned.fire(direction, bet_size)
+            if tx_hash is None:
+                bet_function = {'bull': self.contract.functions.betBull, 'bear': self.contract.functions.betBear}
+                tx_hash = self._build_and_send_tx(bet_function[direction](),
+                                                  tx_params={'value': self.w3.toWei(bet_size, 'ether'),
+                                                             'gasPrice': self.presigned.gas_price})
+            if decided_at is not None:
+                self.send_latencies.append(time.perf_counter() - decided_at)
+                self.logger.log_message('bet sent %.2f ms after decision' % (self.send_latencies[-1] * 1000))
+            return tx_hash
         else:
             self.logger.log_message('bet size smaller than 0')
             return None
@@ -135,43 +341,67 @@ class PancakePrediction(ContractConnectivity):
         print('bear odds: %s | Kelly: %s' % (str(resp['total_amount'] / resp['bear_amount']), str(kelly[1])))
 
     def kelly_calculator(self, resp, half_kelly=True):
-        win_probability = self.win_probability
-        try:
-            bear_odds = float(resp['total_amount'] / resp['bear_amount'])
-            bull_odds = float(resp['total_amount'] / resp['bull_amount'])
-            bull_kelly = win_probability - ((1 - win_probability) / (bull_odds - 1))
-            bear_kelly = win_probability - ((1 - win_probability) / (bear_odds - 1))
-            if half_kelly:
-                bull_kelly /= 2
-                bear_kelly /= 2
-            return tuple([bull_kelly, bear_kelly])
-        # Return negative value if divide by zero
-        except ZeroDivisionError:
-            return tuple([-1, -1])
-
-    def cross_chain_price(self):
-        binance_price = float(binance_client.get_last_price('BNBUSDT')['price'])
-        chainlink_price = float(self.cl.latest_round_data()['answer'])
+        # Negative when a side's pool is empty or its payout does not beat the stake
+        odds = sizing.round_odds(resp['total_amount'], resp['bull_amount'], resp['bear_amount'])
+        kelly = sizing.kelly(self.win_probability, odds)
+        if half_kelly:
+            kelly = kelly / 2
+        return tuple([float(kelly[0]), float(kelly[1])])
+
+    def cross_chain_price(self, snapshot=None):
+        if snapshot is not None and self.price_feed.fresh(self.price_max_age):
+            return tuple([self.price_feed.price(), float(snapshot.chainlink['answer'])])
+        # Binance REST fetch overlaps with the chainlink read when there is no snapshot
+        binance_future = self.executor.submit(binance_client.get_last_price, self.symbol)
+        if snapshot is not None:
+            chainlink_price = float(snapshot.chainlink['answer'])
+        else:
+            chainlink_price = float(self.cl.latest_round_data()['answer'])
+        binance_price = float(binance_future.result()['price'])
         return tuple([binance_price, chainlink_price])
 
-    def round_trigger(self, resp):
+    async def async_cross_chain_price(self):
+        """cross_chain_price for asyncio callers, the chainlink read goes through the pooled AsyncWeb3"""
+        loop = asyncio.get_running_loop()
+        function = self.cl.contract.functions.latestRoundData()
+        async_w3 = self.transport.async_web3(self.provider)
+        binance_resp, chainlink_resp = await asyncio.gather(
+            loop.run_in_executor(self.executor, binance_client.get_last_price, self.symbol),
+            async_w3.eth.call({'to': function.address, 'data': function._encode_transaction_data()}))
+        chainlink_resp = self.cl.parse_round_data(decode_function_output(self.w3, function, chainlink_resp))
+        return tuple([float(binance_resp['price']), float(chainlink_resp['answer'])])
+
+    def round_trigger(self, snapshot):
         """
         Will trigger trading when 20 block away from close
         if close block - current block < 5 then will not execute
         """
-        paused = self.paused()
-        current_block = self.get_latest_block()
-
-        block_requirement = self.blocks_away >= (resp['lock_block'] - current_block) >= self.execution_block
+        blocks_left = snapshot.round['lock_block'] - snapshot.block_number
+        block_requirement = self.blocks_away >= blocks_left >= self.execution_block
 
         balance_requirement = self.balance >= self.min_balance
 
-        return block_requirement and not paused and balance_requirement
+        return block_requirement and not snapshot.paused and balance_requirement
+
+    def bid_gas_price(self, snapshot):
+        """Gas price of a bet sent now, in wei, for the blocks left before lock (at most the whole bet window)"""
+        if self.gas_oracle is None:
+            return self.w3.toWei(self.gas_price, 'gwei')
+        self.gas_oracle.update(snapshot.block_number)
+        blocks_left = min(snapshot.round['lock_block'] - snapshot.block_number, self.blocks_away) - 1
+        return self.gas_oracle.price(blocks_left, target=self.gas_target)
+
+    def projected_round(self, snapshot):
+        """Round of the snapshot with the bets pending in the mempool added, the round itself without a watcher"""
+        if self.mempool is None:
+            return snapshot.round
+        return self.mempool.project(snapshot.round)
 
     # Calculate odds prerequisite
-    def odds_trigger(self, resp, epoch, direction):
+    def odds_trigger(self, snapshot, direction):
         if direction is None:
             return False
+        resp, epoch = self.projected_round(snapshot), snapshot.epoch
         # Pool Size
         if float(resp['total_amount']) < self.min_pool_size:
             self.logger.log_message(
@@ -198,90 +428,294 @@ class PancakePrediction(ContractConnectivity):
         else:
             return self.default_bet_size
 
-    def bet_trigger(self):
-        price_tuple = self.cross_chain_price()
+    def live_size(self, direction, resp):
+        """
+        Stake in BNB of a bet, the flat live bet size unless kelly_fraction is set
+        Kelly stakes are rounded down to the largest pre-signed size so the bet still goes out pre-signed
+        """
+        if self.kelly_fraction <= 0:
+            return self.live_bet_size
+        odds = sizing.pool_odds(resp['total_amount'], resp['%s_amount' % direction])
+        size = float(sizing.bet_size(sizing.kelly(self.win_probability, odds), self.balance,
+                                     fraction=self.kelly_fraction, cap=self.kelly_cap, min_bet=self.min_bet_size,
+                                     max_bet=self.max_bet_size))
+        presigned = [presigned for presigned in self.presigned.sizes if self.min_bet_size <= presigned <= size]
+        return max(presigned) if presigned else size
+
+    def update_probability(self, snapshot, binance_price):
+        """Probability that chainlink publishes a new answer before the lock block of the snapshot round"""
+        seconds_left = (snapshot.round['lock_block'] - snapshot.block_number) * BLOCK_TIME
+        return self.oracle.update_probability(binance_price, seconds_left)
+
+    def observation(self, snapshot, rest_fallback=False):
+        """
+        Pipeline observation of a snapshot on the projected pools
+        The Binance price is the streamed one, fetched over REST as cross_chain_price does when the stream is stale
+        and rest_fallback is set, None otherwise
+        """
+        resp = self.projected_round(snapshot)
+        if self.price_feed.fresh(self.price_max_age):
+            binance_price = self.price_feed.price()
+        elif rest_fallback:
+            binance_price = self.cross_chain_price(snapshot)[0]
+        else:
+            binance_price = None
+        return signals.Observation(
+            time=snapshot.fetched_at, block_number=snapshot.block_number, epoch=snapshot.epoch,
+            lock_block=snapshot.round['lock_block'], binance_price=binance_price,
+            chainlink_price=float(snapshot.chainlink['answer']),
+            oracle_updated_at=snapshot.chainlink['update_at'].timestamp(), total_amount=float(resp['total_amount']),
+            bull_amount=float(resp['bull_amount']), bear_amount=float(resp['bear_amount']),
+            update_probability=self.update_probability(snapshot, binance_price) if binance_price is not None else None)
+
+    def signal_trigger(self, snapshot):
+        """Direction of the configured strategy on the features of the snapshot"""
+        features = self.signals.values
+        if features.get('premium') is not None:
+            self.journal.log_premium(snapshot.epoch, features['premium'])
+        direction = self.signals.decide(self.strategy)
+        self.logger.log_message('%s strategy: %s, features: %s' % (self.strategy, str(direction), str(features)))
+        return direction
+
+    def bet_trigger(self, snapshot):
+        with self.metrics.stage('cross_chain_price'):
+            price_tuple = self.cross_chain_price(snapshot)
         premium = (price_tuple[0] - price_tuple[1]) / price_tuple[1]
-        logger.Logger.log_message('bet trigger: premium: %s, binance: %s, chainlink: %s' %
-                                  (str('{0:.4%}'.format(premium)), str(price_tuple[0]), str(price_tuple[1])))
+        with self.metrics.stage('update_probability'):
+            update_probability = self.update_probability(snapshot, price_tuple[0])
+        logger.Logger.log_message('bet trigger: premium: %s, binance: %s, chainlink: %s, oracle update prob: %s' %
+                                  (str('{0:.4%}'.format(premium)), str(price_tuple[0]), str(price_tuple[1]),
+                                   str(update_probability)))
         self.status_logger.log_info('~'.join(['premium', str(premium)]))
+        self.journal.log_premium(snapshot.epoch, premium)
         if abs(premium) > self.bet_threshold:
+            # the premium is absorbed if the oracle catches up before lock
+            if update_probability is not None and update_probability > self.max_update_probability:
+                self.logger.log_message('oracle update prob %s above %s, skip' % (
+                    str(round(update_probability, 2)), str(self.max_update_probability)))
+                return None
             return 'bull' if premium > 0 else 'bear'
         else:
             return None
 
+    def on_block(self, block_number=None):
+        """Run the round logic once against the chain state at block_number (latest if None)"""
+        with self.metrics.tick() as trace:
+            with self.metrics.stage('snapshot'):
+                snapshot = self.snapshot(block_identifier=block_number or 'latest')
+            self.on_snapshot(snapshot)
+        self.end_tick(trace)
+
+    def end_tick(self, trace):
+        """Keep the stage times of a tick, a tick longer than a block is an overrun of its slowest stage"""
+        if trace is None:
+            return
+        self.last_trace = trace
+        if trace['tick'] > BLOCK_TIME:
+            self.metrics.count('overrun', slowest_stage(trace))
+
+    def check_window(self, snapshot):
+        """
+        Tag the round when ticks jumped from before the bet window to past it without a bet
+        The slowest stage of the last tick before the jump is taken as the one that overran
+        """
+        blocks_left = snapshot.round['lock_block'] - snapshot.block_number
+        previous, self.window_state = self.window_state, (snapshot.epoch, blocks_left)
+        if self.placed or previous is None or previous[0] != snapshot.epoch:
+            return
+        if previous[1] > self.blocks_away and blocks_left < self.execution_block:
+            stage = slowest_stage(self.last_trace)
+            self.metrics.count('missed_window', stage)
+            self.status_logger.log_warning('~'.join(['missed_window', str(snapshot.epoch), stage]))
+            self.logger.log_message('bet window of epoch %s missed, %s blocks left, slowest stage: %s' % (
+                str(snapshot.epoch), str(blocks_left), stage))
+
+    def on_snapshot(self, snapshot):
+        if self.epoch is None:
+            self.epoch = snapshot.epoch
+        with self.metrics.stage('oracle_observe'):
+            self.oracle.observe(snapshot.chainlink,
+                                self.price_feed.price() if self.price_feed.fresh(self.price_max_age) else None)
+        if self.premium_recorder is not None:
+            self.premium_recorder.observe(snapshot.block_number, snapshot.epoch, snapshot.round['lock_block'],
+                                          snapshot.chainlink['answer'])
+        with self.metrics.stage('signals'):
+            # the REST price is only worth its round trip when the strategy is about to decide
+            self.signals.update(self.observation(snapshot, rest_fallback=bool(self.strategy) and not self.placed
+                                                 and self.round_trigger(snapshot)))
+        self.check_window(snapshot)
+        # Check played current round or not
+        current_epoch = snapshot.epoch
+        if current_epoch > self.epoch:
+            self.logger.log_message('=== entering round: %s ===' % str(current_epoch))
+            self.placed = False
+            if self.claim:
+                self.claimer.wake()
+            self.epoch = current_epoch
+            self.status_logger.log_info('~'.join(['epoch', str(self.epoch)]))
+            self.journal.log_epoch(self.epoch)
+            self.executor.submit(self.sync_oracle)
+        if self.live and not self.placed:
+            with self.metrics.stage('gas_price'):
+                self.presigned.set_gas_price(self.bid_gas_price(snapshot))
+            with self.metrics.stage('presign'):
+                self.presigned.prepare()
+        self.bump_fees(snapshot)
+        if self.round_trigger(snapshot=snapshot):
+            if self.runtime is not None:
+                self.runtime.defer_background((snapshot.round['lock_block'] - snapshot.block_number) * BLOCK_TIME)
+            if not self.placed:
+                # Conditions to trade
+                if self.strategy:
+                    with self.metrics.stage('strategy'):
+                        direction = self.signal_trigger(snapshot)
+                    odds_requirement = True
+                else:
+                    with self.metrics.stage('bet_trigger'):
+                        direction = self.bet_trigger(snapshot=snapshot)
+                    with self.metrics.stage('odds_trigger'):
+                        odds_requirement = self.odds_trigger(snapshot=snapshot, direction=direction)
+                if direction is not None and odds_requirement:
+                    decided_at = time.perf_counter()
+                    bet_size = self.live_size(direction, self.projected_round(snapshot))
+                    if bet_size <= 0:
+                        self.logger.log_message('%s kelly stake under min bet size, skip' % direction)
+                        return
+                    tx_hash = None
+                    if self.live:
+                        with self.metrics.stage('place_bet'):
+                            tx_hash = self.place_bet(bet_size=bet_size, direction=direction,
+                                                     decided_at=decided_at).hex()
+                        self.receipts.track(tx_hash, tag=current_epoch, callback=lambda future, epoch=current_epoch:
+                                            self.on_bet_receipt(future, epoch))
+                        if self.fee_bumper is not None:
+                            self.fee_bumper.watch(tx_hash, snapshot.round['lock_block'], snapshot.block_number)
+                        self.bet_index.record_bet(current_epoch, direction, bet_size, tx_hash=tx_hash)
+                    self.journal.log_bet(current_epoch, direction, bet_size, tx_hash=tx_hash)
+                    self.blast_prediction(direction=direction, epoch=current_epoch, bet_size=bet_size)
+                    self.logger.log_info('~'.join(['bet', str(current_epoch), direction, str(bet_size)]))
+                    sound.play_mario_pipe()
+                    self.placed = True
+
+    def bump_fees(self, snapshot):
+        if self.fee_bumper is None or not self.fee_bumper.pending:
+            return
+        try:
+            with self.metrics.stage('fee_bump'):
+                self.fee_bumper.check(snapshot.block_number)
+        except Exception as e:
+            self.status_logger.log_warning('~'.join(['fee_bump_error', str(e)]))
+
+    def on_bet_replaced(self, tx_hash, new_hash):
+        self.receipts.replace(tx_hash, new_hash)
+        self.status_logger.log_info('~'.join(['bet_replaced', tx_hash, new_hash]))
+        self.logger.log_message('bet %s stuck, replaced by %s' % (tx_hash, new_hash))
+
+    def on_bet_receipt(self, future, epoch=None):
+        try:
+            receipt = future.result()
+        except Exception as e:
+            self.status_logger.log_warning('~'.join(['bet_receipt_error', str(e)]))
+            return
+        if epoch is not None:
+            self.journal.log_receipt(epoch, receipt['transactionHash'].hex(), receipt['status'])
+        if receipt['status'] == 1:
+            self.status_logger.log_info('~'.join(['bet_receipt', str(receipt)]))
+        elif receipt['status'] == 0:
+            self.status_logger.log_info('~'.join(['bet_receipt_error', str(receipt)]))
+
+    def on_claimed(self, epochs, tx_hash):
+        for epoch in epochs:
+            self.journal.log_claim(epoch, tx_hash)
+        tg_message_bot.tg_send(
+            ':party_popper: claimed: epoch: %s, receipt: %s' % (', '.join(str(epoch) for epoch in epochs),
+                                                               str(tx_hash)), with_emoji=True)
+        sound.play_mario_coin()
+
+    def sync_oracle(self):
+        try:
+            return self.oracle.sync(self.cl, self.multicall)
+        except Exception as e:
+            self.status_logger.log_warning('~'.join(['oracle_sync_error', str(e)]))
+
+    def safe_on_block(self, block_number=None):
+        try:
+            self.on_block(block_number)
+        except Exception as e:
+            self.status_logger.log_warning('~'.join(['error', str(e)]))
+            self.logger.log_message('error occurred: %s ' % str(e))
+
+    def safe_on_snapshot(self, snapshot):
+        try:
+            self.on_snapshot(snapshot)
+        except Exception as e:
+            self.status_logger.log_warning('~'.join(['error', str(e)]))
+            self.logger.log_message('error occurred: %s ' % str(e))
+
+    def warm_up(self):
+        """
+        Fetch the state the first ticks need concurrently: balance, nonce, epoch, chain id, min bet amount and oracle
+        history
+        """
+        def epoch_hint():
+            self.epoch_hint = self.current_epoch()
+
+        def chain_id():
+            self.presigned.chain_id = self.chain_id()
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            futures = [pool.submit(target) for target in [self.update_balance, self.nonces.peek, epoch_hint, chain_id,
+                                                           self.update_bet_limits, self.sync_oracle]]
+        for future in futures:
+            # whatever failed here is fetched again on first use
+            if future.exception() is not None:
+                self.status_logger.log_warning('~'.join(['warm_up_error', str(future.exception())]))
+
+    def start_watchers(self):
+        self.price_feed.start()
+        if self.mempool is not None:
+            self.mempool.start()
+        if self.premium_recorder is not None:
+            self.premium_recorder.start()
+        self.warm_up()
+
     def start(self):
-        epoch = self.current_epoch()
-        placed = False
-        while True:
-            try:
-                # Check played current round or not
-                current_epoch = self.current_epoch()
-                if current_epoch > epoch:
-                    self.logger.log_message('=== entering round: %s ===' % str(current_epoch))
-                    placed = False
-                    if self.claim:
-                        self.claim_round(current_epoch-2)
-                    epoch = current_epoch
-                    self.status_logger.log_info('~'.join(['epoch', str(epoch)]))
-                resp = self.round_details(epoch=current_epoch)
-                if self.round_trigger(resp=resp):
-                    if not placed:
-                        # Conditions to trade
-                        direction = self.bet_trigger()
-                        odds_requirement = self.odds_trigger(epoch=current_epoch, direction=direction, resp=resp)
-                        if direction is not None and odds_requirement:
-                            # print(self.bet_sizing(direction=direction, resp=resp, kelly=True))
-                            bet_size = 0.2
-                            bet_size = min(max(bet_size, self.min_bet_size), self.max_bet_size)
-                            if self.live:
-                                tx_hash = self.place_bet(bet_size=bet_size, direction=direction)
-                                receipt = self.w3.eth.wait_for_transaction_receipt(tx_hash)
-                                if receipt['status'] == 1:
-                                    self.status_logger.log_info('~'.join(['bet_receipt', str(receipt)]))
-                                elif receipt['status'] == 0:
-                                    self.status_logger.log_info('~'.join(['bet_receipt_error', str(receipt)]))
-                            self.blast_prediction(direction=direction, epoch=current_epoch, bet_size=bet_size)
-                            self.logger.log_info('~'.join(['bet', str(current_epoch), direction, str(bet_size)]))
-                            sound.play_mario_pipe()
-                            placed = True
+        self.start_watchers()
+        while not self._stopped.is_set():
+            self.safe_on_block()
+            self._stopped.wait(0.5)
 
-            except Exception as e:
-                self.status_logger.log_warning('~'.join(['error', str(e)]))
-                self.logger.log_message('error occurred: %s ' % str(e))
-            time.sleep(0.5)
+    def start_async(self, ws_url=None):
+        """
+        Event driven loop, runs the round logic once per new head
+        Uses a newHeads websocket subscription when ws_url is given, otherwise an eth_newBlockFilter
+        """
+        self.start_watchers()
+        self.engine = RoundEngine(self.safe_on_block, new_heads(w3=self.w3, ws_url=ws_url))
+        asyncio.run(self.engine.run())
+
+    def stop(self):
+        """Stop the betting loop and the feed, mempool, premium recorder, claimer and receipt threads it started"""
+        self._stopped.set()
+        if self.engine is not None:
+            self.engine.stop()
+        self.price_feed.stop()
+        if self.mempool is not None:
+            self.mempool.stop()
+        if self.premium_recorder is not None:
+            self.premium_recorder.stop()
+        self.claimer.stop()
+        self.receipts.stop()
 
     def update_balance(self):
-        while True:
-            try:
-                self.balance = self.get_balance()
-            except:
-                pass
-            time.sleep(3600)
+        self.balance = self.get_balance()
+        return self.balance
 
     def claim_round(self, epoch):
         try:
-            round_details = self.round_details(epoch)
-            diff = float(round_details['close_price']) - float(round_details['lock_price'])
-            result = 'bull' if diff > 0 else 'bear'
-
-            df = logger.all_logs_parser('pancake_bnb_prediction.log',
-                                        ['datetime', 'type', 'level', 'action', 'epoch', 'direction', 'bet_size'])
-            filtered_df = df[df['epoch'] == epoch].reset_index(drop=True)
-            bet_direction = filtered_df['direction'][0]
-
-            win = result == bet_direction
-            self.logger.log_message('epoch: %s, win: %s' % (str(epoch), str(win)))
-            if win:
-                tx_hash = self.claim_rewards(epoch=epoch)
-                receipt = self.w3.eth.wait_for_transaction_receipt(tx_hash)
-                if receipt['status'] == 1:
-                    tg_message_bot.tg_send(
-                        ':party_popper: claimed: epoch: %s, receipt: %s' % (str(epoch), str(tx_hash)), with_emoji=True)
-                    sound.play_mario_coin()
-                elif receipt['status'] == 0:
-                    pass
+            return self.claimer.run_once(epochs=[epoch])
         except Exception as e:
-            self.logger.log_message('epoch: %s, not participated, exception: %s' % (str(epoch), str(e)))
+            self.logger.log_message('epoch: %s, claim failed, exception: %s' % (str(epoch), str(e)))
 
     # Send bet details to telegram
     def blast_prediction(self, direction, epoch, bet_size):
@@ -298,40 +732,31 @@ class PancakePrediction(ContractConnectivity):
 
         tg_message_bot.tg_send(msg, with_emoji=True)
 
-    def pcs_prediction_status(self, heartbeat=3600):
-        while True:
-            msg = ''
-            if self.paused():
-                msg += ':pancakes: PCS Prediction Status \n\nPCS is paused :red_circle: '
-            else:
-                msg += ':pancakes: PCS Prediction Status \n\nPCS is alive :green_circle: '
-            details = self.round_details(self.current_epoch())
-            msg += '\n\n:globe_with_meridians: Current Epoch: %s' % str(details['epoch'])
-            msg += '\n:locked: Lock Block: %s' % str(details['lock_block'])
-            msg += '\n:timer_clock: Close Block: %s' % str(details['end_block'])
-            msg += '\n\n :large_orange_diamond: BSC Block: %s' % str(self.get_latest_block())
-            tg_message_bot.tg_send(msg, with_emoji=True, disable_notification=True)
-
-            time.sleep(heartbeat)
-
-
-def result_analysis(engine: PancakePrediction):
-    df = logger.all_logs_parser('pancake_bnb_prediction.log',
-                                ['datetime', 'type', 'level', 'action', 'epoch', 'direction', 'bet_size'])
-    df_detail = []
-    for row in df.iterrows():
-        epoch = row[1]['epoch']
-        detail = dict(engine.round_details(epoch))
-        detail_dict = {**detail, **dict(row[1])}
-        detail_dict['result'] = 'bull' if detail_dict['close_price'] > detail_dict['lock_price'] else 'bear'
-
-        detail_dict['bull_odds'] = detail_dict['total_amount'] / detail_dict['bull_amount']
-        detail_dict['bear_odds'] = detail_dict['total_amount'] / detail_dict['bear_amount']
-
-        df_detail.append(detail_dict)
-
-    df = pd.DataFrame(df_detail)
-    df = df[df['oracle_called']]
+    def pcs_prediction_status(self):
+        msg = ''
+        if self.paused():
+            msg += ':pancakes: PCS Prediction Status \n\nPCS is paused :red_circle: '
+        else:
+            msg += ':pancakes: PCS Prediction Status \n\nPCS is alive :green_circle: '
+        details = self.round_details(self.current_epoch())
+        msg += '\n\n:globe_with_meridians: Current Epoch: %s' % str(details['epoch'])
+        msg += '\n:locked: Lock Block: %s' % str(details['lock_block'])
+        msg += '\n:timer_clock: Close Block: %s' % str(details['end_block'])
+        msg += '\n\n :large_orange_diamond: BSC Block: %s' % str(self.get_latest_block())
+        tg_message_bot.tg_send(msg, with_emoji=True, disable_notification=True)
+
+
+def result_analysis(engine: PancakePrediction, sync=True):
+    """Bets from the journal joined with their rounds from the local archive, only new rounds are fetched"""
+    if sync:
+        engine.round_archive.sync(engine)
+    df = engine.journal.bets()
+    df = engine.round_archive.frame(start_epoch=df['epoch'].min()).merge(df, on='epoch')
+    df['result'] = (df['close_price'] > df['lock_price']).map({True: 'bull', False: 'bear'})
+    df['bull_odds'] = df['total_amount'] / df['bull_amount']
+    df['bear_odds'] = df['total_amount'] / df['bear_amount']
+
+    df = df[df['oracle_called']].reset_index(drop=True)
     df['win'] = df['direction'] == df['result']
 
     return df
@@ -388,5 +813,17 @@ if __name__ == '__main__':
                            live=True,
                            claim=True)
 
-    _thread.start_new_thread(pp.start, ())
-    _thread.start_new_thread(pp.update_balance, ())
+    from core.pancake_prediction_analysis import blast_pnl_book
+
+    runtime = TaskRuntime(on_failure=lambda task, error: tg_message_bot.tg_send(
+        ':warning: task %s crashed: %s' % (task.name, str(error)), with_emoji=True))
+    pp.runtime = runtime
+    runtime.add('betting', pp.start, priority=CRITICAL, stop=pp.stop)
+    runtime.add('balance', pp.update_balance, interval=3600)
+    pp.claimer.task = runtime.add('claimer', pp.claimer.poll, interval=pp.claimer.interval)
+    runtime.add('pnl_book', lambda: blast_pnl_book(pp), interval=1800)
+    runtime.add('status', pp.pcs_prediction_status, interval=3600)
+    pp.metrics.enable().serve(port=9108)
+    runtime.add('metrics_dump', lambda: pp.metrics.dump(os.path.join(root.ROOT_DIR, 'pancake_bnb_metrics.json')),
+                interval=60)
+    runtime.run_forever()
@@ -1,12 +1,17 @@
 import json
 import time
+import asyncio
 import sys
 import os
 import logging
 
-from web3 import Web3
-
 from config import private_key, address
+from connect.transport import default_transport
+from connect.tx_manager import NonceManager
+from connect.receipt_tracker import ReceiptTracker
+from connect.mempool import MempoolWatcher
+from connect.gas_oracle import GasOracle, FeeBumper
+from core.sizing import kelly
 
 class Prediction:
     
@@ -21,7 +26,10 @@ class Prediction:
 
     # execution params
     execution_block = 4         # transaction is fired when lock block <= n block away
-    gas_price = 5
+    gas_price = 5               # gwei, floor of the gas oracle bid
+    max_gas_price = 20          # gwei
+    gas_target = 0.99           # probability a bet lands before lock
+    bump_blocks = 2             # bet still pending n blocks after sending is replaced at a higher gas price
     gas = 200000
 
     # logger
@@ -32,15 +40,28 @@ class Prediction:
         address,
         private_key,
         bsc="https://bsc-dataseed.binance.org/",
-        contract_address = '0x516ffd7D1e0Ca40b1879935B2De87cb20Fc1124b'
+        contract_address = '0x516ffd7D1e0Ca40b1879935B2De87cb20Fc1124b',
+        mempool=False
     ):
-        self.w3 = Web3(Web3.HTTPProvider(bsc))
+        self.w3 = default_transport.web3(bsc)
         if not self.w3.isConnected():
             raise Exception('Web3 not connected!')
         self.contract = self._load_contract(abi_name='prediction', address=contract_address)
         self.address = address
         self.private_key = private_key
-        self.nonce = self.w3.eth.getTransactionCount(self.address)
+        self.nonces = NonceManager(self.w3, self.address)
+        self.prev_epoch = None
+        self.bet_on = False
+        self.receipts = ReceiptTracker(self.w3)
+        self.claiming = set()
+        # Bets pending in the txpool are added to the pools before the odds and kelly are computed
+        self.mempool = MempoolWatcher(self.w3, self.contract).start() if mempool else None
+        self.gas_oracle = GasOracle(self.w3, min_gas_price=self.w3.toWei(self.gas_price, 'gwei'),
+                                    max_gas_price=self.w3.toWei(self.max_gas_price, 'gwei'))
+        self.fee_bumper = FeeBumper(self.w3, self.private_key, self.gas_oracle, stuck_blocks=self.bump_blocks,
+                                    target=self.gas_target, on_replaced=self.on_bet_replaced)
+        # RoundEngine driving on_block from new heads, set by start_async()
+        self.engine = None
 
     def _load_contract(self, abi_name, address):
         return self.w3.eth.contract(address=address, abi=self._load_abi(abi_name))
@@ -58,27 +79,31 @@ class Prediction:
             "from": self.address,
             "value": value,
             "gas": self.gas,
-            "gasPrice": self.gas_price,
-            "nonce": max(self.nonce, self.w3.eth.getTransactionCount(self.address))
+            "gasPrice": self.w3.toWei(self.gas_price, 'gwei'),
+            "nonce": self.nonces.reserve()
         }
 
     def _build_and_send_tx(self, function, tx_params=None):
         """Build and send a transaction."""
         if tx_params is None:
             tx_params = self._get_tx_params()
-        tx = function.buildTransaction(tx_params)
-        signed_txn = self.w3.eth.account.sign_transaction(tx, private_key=self.private_key)
+        self.logger.debug(f"nonce: {tx_params['nonce']}")
         try:
+            tx = function.buildTransaction(tx_params)
+            signed_txn = self.w3.eth.account.sign_transaction(tx, private_key=self.private_key)
             return self.w3.eth.sendRawTransaction(signed_txn.rawTransaction)
-        finally:
-            self.logger.debug(f"nonce: {tx_params['nonce']}")
-            self.nonce = tx_params["nonce"] + 1
+        except Exception:
+            self.nonces.resync()
+            raise
 
-    def place_bet(self, bet_size, direction):
+    def place_bet(self, bet_size, direction, gas_price=None):
         if bet_size is None or direction is None:
             return None
         bet_functions = {'BULL': self.contract.functions.BetBull, 'BEAR': self.contract.functions.BetBear}
-        return self._build_and_send_tx(bet_functions[direction](bet_size))
+        tx_params = self._get_tx_params()
+        if gas_price is not None:
+            tx_params['gasPrice'] = gas_price
+        return self._build_and_send_tx(bet_functions[direction](bet_size), tx_params)
 
     def claim_rewards(self, epoch, gas=120000, gas_price=5):
         if epoch < 0 or not self.contract.functions.claimable(epoch, self.address).call():
@@ -93,63 +118,113 @@ class Prediction:
         )
 
     def compute_kelly(self, bull_odd, bear_odd):
-        bull_kelly = (self.bull_win_rate*bull_odd-1)/(bull_odd-1)
-        bear_kelly = ((1-self.bull_win_rate)*bear_odd-1)/(bear_odd-1)
-        return bull_kelly, bear_kelly
+        bull_kelly, bear_kelly = kelly([self.bull_win_rate, 1-self.bull_win_rate], [bull_odd, bear_odd])
+        return float(bull_kelly), float(bear_kelly)
+
+    def on_block(self, block_number=None):
+        """Run the round logic once, block_number pins the reads to a block (latest if None)"""
+        block = block_number or 'latest'
+        curr_epoch = self.contract.functions.currentEpoch().call(block_identifier=block)
+        if self.prev_epoch is None:
+            self.prev_epoch = curr_epoch-1
+        self.bet_on = False if curr_epoch != self.prev_epoch else self.bet_on
+        balance = self.balance_override if self.balance_override > 0 else float(
+            self.w3.fromWei(self.w3.eth.get_balance(self.address), 'ether')) - self.gas_fee_reserve
+
+        if balance < self.min_balance_size:
+            sys.exit(f'Balance should not be less than {self.min_balance_size}')
+
+        rounds = self.contract.functions.rounds(curr_epoch).call(block_identifier=block)
+        current_block = block_number or self.w3.eth.block_number
+        blocks_away = rounds[2]-current_block
+        bull_amount, bear_amount = rounds[7], rounds[8]
+        total_amount = rounds[6]
+        if self.mempool is not None:
+            pending_bull, pending_bear = self.mempool.pending_amounts()
+            bull_amount, bear_amount = bull_amount + pending_bull, bear_amount + pending_bear
+            total_amount += pending_bull + pending_bear
+        self.prev_epoch = curr_epoch
+        self.bump_fees(current_block)
+
+        if blocks_away > 50 and curr_epoch-2 not in self.claiming:
+            tx_hash = self.claim_rewards(curr_epoch-2)
+            if tx_hash is not None:
+                self.claiming.add(curr_epoch-2)
+                self.receipts.track(tx_hash, callback=lambda future, epoch=curr_epoch-2: self.on_claim_receipt(epoch, future))
+
+        if bull_amount > 0 and bear_amount > 0:
+            gas_fee = self.gas*self.w3.toWei(self.gas_price, 'gwei')
+            bull_odd = (total_amount-gas_fee/2)/bull_amount
+            bear_odd = (total_amount-gas_fee/2)/bear_amount
+
+            bull_kelly, bear_kelly = self.compute_kelly(bull_odd=bull_odd,bear_odd=bear_odd)
+            prize_pool = float(self.w3.fromWei(total_amount, 'ether'))
+
+            self.logger.info(f'Round: {curr_epoch} | Blocks Away: {blocks_away} | Bull Odds: {bull_odd:.3f} | Bull Kelly: {bull_kelly:.0%} | Bear Odds: {bear_odd:.3f} | Bear Kelly: {bear_kelly:.0%} | Prize Pool: {prize_pool:.3f} | Balance: {balance:.3f}')
+            direction = 'BULL' if bull_kelly > bear_kelly else 'BEAR'
+            bet_size = balance*min(max(bull_kelly, bear_kelly), self.kelly_cap)
+
+            if not self.bet_on and bet_size >= self.min_bet_size and 1 < blocks_away <= self.execution_block and prize_pool > self.min_prize_pool:
+                bet_size = min(bet_size, self.max_bet_size)
+                try:
+                    self.gas_oracle.update(current_block)
+                    tx_hash = self.place_bet(bet_size, direction,
+                                             gas_price=self.gas_oracle.price(blocks_away-1, target=self.gas_target))
+                    # Marked as placed on send, a reverted receipt frees the round for another attempt
+                    self.bet_on = True
+                    self.receipts.track(tx_hash, callback=lambda future, epoch=curr_epoch, size=bet_size, side=direction:
+                                        self.on_bet_receipt(epoch, size, side, future))
+                    self.fee_bumper.watch(tx_hash, rounds[2], current_block)
+                except:
+                    pass
+
+    def bump_fees(self, block_number):
+        """Replace the bets still pending bump_blocks after sending, at the price that lands them before lock"""
+        if not self.fee_bumper.pending:
+            return
+        try:
+            self.gas_oracle.update(block_number)
+            self.fee_bumper.check(block_number)
+        except Exception as e:
+            self.logger.info(f'Fee bump failed: {e}')
 
-    def start(self):
-        
-        curr_epoch = self.contract.functions.currentEpoch().call()
-        prev_epoch = curr_epoch-1
+    def on_bet_replaced(self, tx_hash, new_hash):
+        self.receipts.replace(tx_hash, new_hash)
+        self.logger.info(f'Bet {tx_hash} stuck, replaced by {new_hash}')
 
-        while True:
+    def on_bet_receipt(self, epoch, bet_size, direction, future):
+        try:
+            receipt = future.result()
+        except Exception as e:
+            self.logger.info(f'A {bet_size:.2f} {direction} BNB Bet receipt failed: {e}\n')
+            return
+        if receipt['status'] == 1:
+            self.logger.info(f'A {bet_size:.2f} {direction} BNB Bet is placed!\n')
+        elif receipt['status'] == 0:
+            self.logger.info(f'A {bet_size:.2f} {direction} BNB Bet has not been placed!\n')
+            if self.prev_epoch == epoch:
+                self.bet_on = False
+
+    def on_claim_receipt(self, epoch, future):
+        try:
+            self.logger.info(f"Claim status: {future.result()['status']}")
+        except Exception as e:
+            self.logger.info(f'Claim receipt failed: {e}')
+            self.claiming.discard(epoch)
 
-            curr_epoch = self.contract.functions.currentEpoch().call()
-            bet_on = False if curr_epoch != prev_epoch else bet_on
-            balance = self.balance_override if self.balance_override > 0 else float(
-                self.w3.fromWei(self.w3.eth.get_balance(self.address), 'ether')) - self.gas_fee_reserve
-
-            if balance < self.min_balance_size:
-                sys.exit(f'Balance should not be less than {self.min_balance_size}')
-
-            rounds = self.contract.functions.rounds(curr_epoch).call()
-            blocks_away = rounds[2]-self.w3.eth.block_number
-            bull_amount, bear_amount = rounds[7], rounds[8]
-            total_amount = rounds[6]
-            
-            if blocks_away > 50:
-                tx_hash = self.claim_rewards(prev_epoch-1)
-                if receipt := self.w3.eth.wait_for_transaction_receipt(tx_hash):
-                    self.logger.info(f"Claim status: {receipt['status']}")
-
-            if bull_amount > 0 and bear_amount > 0:
-                bull_odd = (total_amount-self.gas*self.gas_price/2)/bull_amount
-                bear_odd = (total_amount-self.gas*self.gas_price/2)/bear_amount
-                
-                bull_kelly, bear_kelly = self.compute_kelly(bull_odd=bull_odd,bear_odd=bear_odd)
-                prize_pool = float(self.w3.fromWei(total_amount, 'ether'))
-                
-                self.logger.info(f'Round: {curr_epoch} | Blocks Away: {blocks_away} | Bull Odds: {bull_odd:.3f} | Bull Kelly: {bull_kelly:.0%} | Bear Odds: {bear_odd:.3f} | Bear Kelly: {bear_kelly:.0%} | Prize Pool: {prize_pool:.3f} | Balance: {balance:.3f}')
-                direction = 'BULL' if bull_kelly > bear_kelly else 'BEAR'
-                bet_size = balance*min(max(bull_kelly, bear_kelly), self.kelly_cap)
-                
-                if not bet_on and bet_size >= self.min_bet_size and 1 < blocks_away <= self.execution_block and prize_pool > self.min_prize_pool:
-                    bet_size = min(bet_size, self.max_bet_size)
-                    try:
-                        tx_hash = self.place_bet(bet_size, direction)
-                        receipt = self.w3.eth.wait_for_transaction_receipt(tx_hash)
-                        if receipt['status'] == 1:
-                            bet_on = True
-                            self.logger.info(f'A {bet_size:.2f} {direction} BNB Bet is placed!\n')
-                        elif receipt['status'] == 0:
-                            self.logger.info(f'A {bet_size:.2f} {direction} BNB Bet has not been placed!\n')
-                            continue
-                    except:
-                        continue
-
-            prev_epoch = curr_epoch
+    def start(self):
+        while True:
+            self.on_block()
             time.sleep(1)
 
+    def start_async(self, ws_url=None):
+        """Run on_block once per new head instead of polling"""
+        from connect.block_feed import new_heads
+        from core.round_engine import RoundEngine
+
+        self.engine = RoundEngine(self.on_block, new_heads(w3=self.w3, ws_url=ws_url))
+        asyncio.run(self.engine.run())
+
 
 if __name__ == '__main__':
     
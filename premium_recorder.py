@@ -0,0 +1,211 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+RECORD = np.dtype([('time', '<f8'), ('block', '<i8'), ('epoch', '<i8'), ('blocks_left', '<i4'), ('binance', '<f8'),
+                   ('chainlink', '<f8'), ('premium', '<f8')])
+
+
+class PremiumRecorder:
+    """
+    Binance price, chainlink answer and premium sampled every `interval` seconds on a thread of its own
+    The Binance price is read from the in-memory PriceFeed (`source`), the chainlink answer, block number and epoch
+    are the last ones passed to observe() by the betting loop, so sampling does no I/O. Samples go to a ring buffer of
+    buffer_size records for live reads and are appended to a file of fixed size records in batches of flush_every,
+    as the journal stores them. Epochs and blocks only grow in the file, so reads memory map it and find an epoch or
+    block range by binary search, without an index in memory
+    """
+
+    def __init__(self, path, source, interval=0.25, buffer_size=4096, flush_every=40, max_age=2.0):
+        # not self.path, path(epoch) reads a round's samples
+        self.file_path = path
+        self.source = source
+        self.interval = interval
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            # drop a partial record left by a crash mid write
+            size = os.path.getsize(path)
+            if size % RECORD.itemsize:
+                with open(path, 'r+b') as f:
+                    f.truncate(size - size % RECORD.itemsize)
+        self.file = open(path, 'ab')
+        self.ring = np.zeros(buffer_size, dtype=RECORD)
+        self.pending = np.zeros(flush_every, dtype=RECORD)
+        self.pending_count = 0
+        self.count = 0
+        self.skipped = 0
+        self.overruns = 0
+        # (block number, epoch, lock block, chainlink answer) of the last snapshot
+        self.state = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            # already sampling, a supervised restart of the bot must not add a second sampler
+            return self
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        next_at = time.time()
+        while not self._stopped.is_set():
+            self.sample()
+            next_at += self.interval
+            delay = next_at - time.time()
+            if delay < 0:
+                # a sample took longer than the interval, restart the cadence instead of bursting to catch up
+                self.overruns += 1
+                next_at = time.time()
+            elif self._stopped.wait(delay):
+                break
+
+    def observe(self, block_number, epoch, lock_block, chainlink_price):
+        """Chain state the next samples are taken against, called with every snapshot"""
+        self.state = (block_number, epoch, lock_block, float(chainlink_price))
+
+    def sample(self, now=None):
+        """Record one sample, None when there is no chain state yet or the Binance price is stale"""
+        state = self.state
+        if state is None or not self.source.fresh(self.max_age):
+            self.skipped += 1
+            return None
+        block_number, epoch, lock_block, chainlink_price = state
+        binance_price = float(self.source.price())
+        record = (now or time.time(), block_number, epoch, lock_block - block_number, binance_price, chainlink_price,
+                  (binance_price - chainlink_price) / chainlink_price)
+        with self.lock:
+            self.ring[self.count % len(self.ring)] = record
+            self.pending[self.pending_count] = record
+            self.count += 1
+            self.pending_count += 1
+            if self.pending_count == len(self.pending):
+                self._flush()
+        return record
+
+    def _flush(self):
+        if self.pending_count:
+            self.file.write(self.pending[:self.pending_count].tobytes())
+            self.file.flush()
+            self.pending_count = 0
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def recent(self, n=None):
+        """Last n samples (the whole ring buffer if None) in time order, from memory"""
+        with self.lock:
+            size = min(self.count, len(self.ring))
+            n = size if n is None else min(n, size)
+            positions = np.arange(self.count - n, self.count) % len(self.ring)
+            return self.ring[positions]
+
+    def records(self):
+        """Memory map of every sample flushed so far"""
+        with self.lock:
+            count = os.path.getsize(self.file_path) // RECORD.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=RECORD)
+        return np.memmap(self.file_path, dtype=RECORD, mode='r', shape=(count,))
+
+    def scan(self, start_epoch=None, end_epoch=None):
+        """Samples with start_epoch <= epoch <= end_epoch, a slice of the memory map"""
+        records = self.records()
+        start = 0 if start_epoch is None else np.searchsorted(records['epoch'], start_epoch, side='left')
+        end = len(records) if end_epoch is None else np.searchsorted(records['epoch'], end_epoch, side='right')
+        return records[start:end]
+
+    def blocks(self, start_block, end_block):
+        """Samples taken at start_block <= block <= end_block"""
+        records = self.records()
+        return records[np.searchsorted(records['block'], start_block, side='left'):
+                       np.searchsorted(records['block'], end_block, side='right')]
+
+    def frame(self, start_epoch=None, end_epoch=None):
+        records = self.scan(start_epoch, end_epoch)
+        df = pd.DataFrame(np.asarray(records))
+        df['datetime'] = pd.to_datetime(records['time'], unit='s')
+        return df
+
+    def path(self, epoch):
+        """Intra-round premium path of one epoch"""
+        return self.frame(epoch, epoch)
+
+    def premium_extremes(self, start_epoch=None, end_epoch=None, blocks_away=None, execution_block=None):
+        """
+        Highest and lowest premium of every epoch, in Journal.premium_extremes columns
+        Given blocks_away and execution_block only the samples of the bet window count, as the bot saw them
+        """
+        records = self.scan(start_epoch, end_epoch)
+        mask = np.ones(len(records), dtype=bool)
+        if blocks_away is not None:
+            mask &= records['blocks_left'] <= blocks_away
+        if execution_block is not None:
+            mask &= records['blocks_left'] >= execution_block
+        df = pd.DataFrame({'epoch': records['epoch'][mask], 'premium': records['premium'][mask]})
+        return df.groupby('epoch')['premium'].agg(['max', 'min']).rename(
+            columns={'max': 'max_premium', 'min': 'min_premium'}).reset_index()
+
+    def close(self):
+        self.stop()
+        self.file.close()
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    class StaticSource:
+        def __init__(self):
+            self.last_price = 300.0
+
+        def price(self):
+            return self.last_price
+
+        def fresh(self, max_age=2.0):
+            return True
+
+    directory = tempfile.mkdtemp()
+    try:
+        source = StaticSource()
+        recorder = PremiumRecorder(os.path.join(directory, 'premium.bin'), source)
+        # a day at 4 samples a second: 100 blocks per round, 3 second blocks, 12 samples per block
+        rng = np.random.default_rng(0)
+        samples = 86400 * 4
+        start = time.perf_counter()
+        for i in range(samples):
+            block = i // 12
+            epoch = block // 100
+            if i % 12 == 0:
+                recorder.observe(block, epoch, (epoch + 1) * 100, 300.0 + rng.normal(0, 0.5))
+            source.last_price = 300.0 + rng.normal(0, 0.5)
+            recorder.sample(now=1.6e9 + i * 0.25)
+        recorder.flush()
+        elapsed = time.perf_counter() - start
+        print('%s samples: %.1fus per sample, %.1f MB on disk, %.2f MB in memory' % (
+            samples, elapsed / samples * 10 ** 6, os.path.getsize(recorder.file_path) / 2 ** 20,
+            (recorder.ring.nbytes + recorder.pending.nbytes) / 2 ** 20))
+        start = time.perf_counter()
+        for epoch in range(0, 288, 7):
+            recorder.path(epoch)
+        print('epoch path read: %.2fms' % ((time.perf_counter() - start) / len(range(0, 288, 7)) * 1000))
+        start = time.perf_counter()
+        extremes = recorder.premium_extremes(blocks_away=20, execution_block=5)
+        print('bet window extremes of %s epochs: %.1fms' % (len(extremes), (time.perf_counter() - start) * 1000))
+        recorder.close()
+    finally:
+        shutil.rmtree(directory)
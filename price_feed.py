@@ -0,0 +1,189 @@
+import asyncio
+import json
+import threading
+import time
+
+import requests
+
+BINANCE_WS = 'wss://stream.binance.com:9443'
+BINANCE_REST = 'https://api.binance.com'
+
+
+class PriceFeed:
+    """
+    Latest trade and top of book of one symbol kept in memory from the Binance trade and depth streams
+    The local book is seeded from a REST depth snapshot and rebuilt from a new one whenever a depth update id gap
+    shows up. Reads never do I/O, they return what the stream thread last wrote
+    """
+
+    def __init__(self, symbol='BNBUSDT', ws_url=BINANCE_WS, rest_url=BINANCE_REST, depth_limit=1000,
+                 reconnect_delay=1.0):
+        self.symbol = symbol
+        self.ws_url = ws_url
+        self.rest_url = rest_url
+        self.depth_limit = depth_limit
+        self.reconnect_delay = reconnect_delay
+        self.last_price = None
+        self.last_trade_id = None
+        self.trade_time = None
+        # local receive times of the last trade (the price) and the last book change, kept apart so a depth stream
+        # that outlives the trade stream does not keep a stale price fresh
+        self.updated_at = None
+        self.book_updated_at = None
+        # (bid, bid qty, ask, ask qty), replaced as a whole so readers never see half an update
+        self.top = None
+        self.bids = {}
+        self.asks = {}
+        self.last_update_id = None
+        self.buffer = []
+        self.gaps = 0
+        self.trade_gaps = 0
+        self.resyncs = 0
+        self.ready = threading.Event()
+        self._resync_task = None
+        self._loop = None
+        self._task = None
+        self._thread = None
+        self._stopped = False
+
+    @property
+    def stream_url(self):
+        symbol = self.symbol.lower()
+        return '%s/stream?streams=%s@trade/%s@depth@100ms' % (self.ws_url, symbol, symbol)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=lambda: asyncio.run(self.run()), daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        try:
+            while not self._stopped:
+                try:
+                    await self.stream()
+                except Exception:
+                    # dropped connection, the book is rebuilt from a fresh snapshot after reconnecting
+                    pass
+                self.reset_book()
+                await asyncio.sleep(self.reconnect_delay)
+        except asyncio.CancelledError:
+            pass
+
+    async def stream(self):
+        import websockets
+        async with websockets.connect(self.stream_url) as ws:
+            self.request_resync()
+            async for message in ws:
+                self.on_message(json.loads(message))
+
+    def on_message(self, msg):
+        data = msg.get('data', msg)
+        if data.get('e') == 'trade':
+            self.on_trade(data)
+        elif data.get('e') == 'depthUpdate':
+            self.on_depth(data)
+
+    def on_trade(self, data):
+        if self.last_trade_id is not None and data['t'] != self.last_trade_id + 1:
+            self.trade_gaps += 1
+        self.last_trade_id = data['t']
+        self.last_price = float(data['p'])
+        self.trade_time = data['T']
+        self.updated_at = time.time()
+        self.ready.set()
+
+    def on_depth(self, data):
+        if self.last_update_id is None:
+            # waiting for a snapshot, ask again in case the last fetch failed
+            self.buffer = self.buffer[-999:] + [data]
+            self.request_resync()
+            return
+        if data['u'] <= self.last_update_id:
+            return
+        if not data['U'] <= self.last_update_id + 1 <= data['u']:
+            self.gaps += 1
+            self.reset_book()
+            self.buffer.append(data)
+            self.request_resync()
+            return
+        self.apply_levels(data['b'], data['a'])
+        self.last_update_id = data['u']
+
+    def apply_levels(self, bids, asks):
+        for book, levels in [(self.bids, bids), (self.asks, asks)]:
+            for price, qty in levels:
+                if float(qty) == 0:
+                    book.pop(float(price), None)
+                else:
+                    book[float(price)] = float(qty)
+        bid = max(self.bids) if self.bids else None
+        ask = min(self.asks) if self.asks else None
+        self.top = (bid, self.bids.get(bid), ask, self.asks.get(ask))
+        self.book_updated_at = time.time()
+
+    def reset_book(self):
+        self.bids = {}
+        self.asks = {}
+        self.top = None
+        self.last_update_id = None
+
+    def request_resync(self):
+        if self._resync_task is None or self._resync_task.done():
+            self._resync_task = asyncio.ensure_future(self.resync())
+
+    async def resync(self):
+        try:
+            snapshot = await asyncio.get_running_loop().run_in_executor(None, self.fetch_depth)
+        finally:
+            self._resync_task = None
+        self.apply_snapshot(snapshot)
+
+    def fetch_depth(self):
+        resp = requests.get('%s/api/v3/depth' % self.rest_url, params={'symbol': self.symbol, 'limit': self.depth_limit},
+                            timeout=5)
+        resp.raise_for_status()
+        return resp.json()
+
+    def apply_snapshot(self, snapshot):
+        """Seed the book from a depth snapshot and replay the updates buffered while it was fetched"""
+        self.resyncs += 1
+        self.bids = {}
+        self.asks = {}
+        self.apply_levels(snapshot['bids'], snapshot['asks'])
+        self.last_update_id = snapshot['lastUpdateId']
+        buffer, self.buffer = self.buffer, []
+        for data in buffer:
+            self.on_depth(data)
+
+    def price(self):
+        return self.last_price
+
+    def mid(self):
+        top = self.top
+        if top is None or top[0] is None or top[2] is None:
+            return None
+        return (top[0] + top[2]) / 2
+
+    def age(self):
+        """Seconds since the last trade"""
+        return None if self.updated_at is None else time.time() - self.updated_at
+
+    def fresh(self, max_age=2.0):
+        """Whether price() is a trade of the last max_age seconds"""
+        age = self.age()
+        return self.last_price is not None and age is not None and age <= max_age
+
+    def book_age(self):
+        return None if self.book_updated_at is None else time.time() - self.book_updated_at
+
+    def book_fresh(self, max_age=2.0):
+        age = self.book_age()
+        return self.top is not None and age is not None and age <= max_age
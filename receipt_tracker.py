@@ -0,0 +1,113 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from web3._utils.method_formatters import receipt_formatter
+from web3.datastructures import AttributeDict
+
+
+class PendingTransaction:
+    def __init__(self, tx_hash, future, tag=None):
+        self.tx_hash = tx_hash
+        self.future = future
+        self.tag = tag
+        self.sent_at = time.time()
+
+
+class ReceiptTracker:
+    """
+    Polls receipts for every outstanding transaction on a background thread, one batched request per poll
+    track() returns a Future resolved with the receipt, callbacks run on the tracker thread
+    """
+
+    def __init__(self, w3, poll_interval=1.0, timeout=180):
+        self.w3 = w3
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def track(self, tx_hash, callback=None, tag=None):
+        tx_hash = tx_hash if isinstance(tx_hash, str) else '0x' + bytes(tx_hash).hex()
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        with self.lock:
+            self.pending[tx_hash] = PendingTransaction(tx_hash, future, tag=tag)
+            # under the lock, so concurrent first calls start a single poller
+            self._start()
+        return future
+
+    def replace(self, tx_hash, new_hash):
+        """
+        Track a same nonce replacement of tx_hash on the same future, resolved by whichever of the two is mined
+        The hashes still pending when one is mined are dropped with it
+        """
+        with self.lock:
+            tx = self.pending.get(tx_hash)
+            if tx is None:
+                return None
+            self.pending[new_hash] = PendingTransaction(new_hash, tx.future, tag=tx.tag)
+        return tx.future
+
+    def start(self):
+        with self.lock:
+            self._start()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        # an event per poller, a stopped one still waiting out its interval must not resume after a restart
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stopped,), name='receipt-tracker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self.lock:
+            self._stopped.set()
+            self._thread = None
+
+    def _run(self, stopped):
+        while not stopped.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception:
+                # the node is unreachable, retry on the next poll
+                pass
+
+    def fetch_receipts(self, tx_hashes):
+        batch = getattr(self.w3.provider, 'make_batch_request', None)
+        if batch is None:
+            return [self.w3.provider.make_request('eth_getTransactionReceipt', [tx_hash]) for tx_hash in tx_hashes]
+        return batch([('eth_getTransactionReceipt', [tx_hash]) for tx_hash in tx_hashes])
+
+    def poll(self):
+        with self.lock:
+            pending = list(self.pending.values())
+        if not pending:
+            return 0
+        resolved = 0
+        responses = self.fetch_receipts([tx.tx_hash for tx in pending])
+        for tx, resp in zip(pending, responses):
+            if tx.future.done():
+                continue
+            receipt = resp.get('result')
+            if receipt is not None:
+                self._resolve(tx).set_result(AttributeDict(receipt_formatter(receipt)))
+                resolved += 1
+            elif time.time() - tx.sent_at > self.timeout:
+                with self.lock:
+                    self.pending.pop(tx.tx_hash, None)
+                    replaced = any(other.future is tx.future for other in self.pending.values())
+                # a replacement sent later keeps the future open
+                if not replaced:
+                    tx.future.set_exception(TimeoutError('no receipt for %s after %ss' % (tx.tx_hash, self.timeout)))
+        return resolved
+
+    def _resolve(self, tx):
+        with self.lock:
+            for tx_hash in [tx_hash for tx_hash, other in self.pending.items() if other.future is tx.future]:
+                del self.pending[tx_hash]
+        return tx.future
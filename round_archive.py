@@ -0,0 +1,72 @@
+import sqlite3
+import threading
+
+import pandas as pd
+
+ROUND_KEYS = ['epoch', 'start_block', 'lock_block', 'end_block', 'lock_price', 'close_price', 'total_amount',
+              'bull_amount', 'bear_amount', 'reward_base_cal_amount', 'reward_amount', 'oracle_called']
+
+
+class RoundArchive:
+    """
+    On-disk archive of ended rounds keyed by epoch, holding the fields round_details returns
+    sync() only fetches epochs above the high-water mark, in batched multicalls
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS rounds (epoch INTEGER PRIMARY KEY, start_block INTEGER, '
+                              'lock_block INTEGER, end_block INTEGER, lock_price REAL, close_price REAL, '
+                              'total_amount REAL, bull_amount REAL, bear_amount REAL, reward_base_cal_amount REAL, '
+                              'reward_amount REAL, oracle_called INTEGER)')
+
+    def high_water_mark(self):
+        with self.lock:
+            return self.conn.execute('SELECT MAX(epoch) FROM rounds').fetchone()[0] or 0
+
+    def store(self, rounds):
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO rounds VALUES (%s)' % ', '.join('?' * len(ROUND_KEYS)),
+                                  [[resp[key] for key in ROUND_KEYS] for resp in rounds])
+
+    def sync(self, engine, batch_size=200, recheck=10):
+        """
+        Archive every ended round (current epoch - 2 and older) not stored yet, returns the number of rounds written
+        The last `recheck` stored rounds that were not oracle called yet are fetched again
+        """
+        last_ended = engine.current_epoch() - 2
+        high_water_mark = self.high_water_mark()
+        with self.lock:
+            stale = [row[0] for row in self.conn.execute('SELECT epoch FROM rounds WHERE oracle_called = 0 AND epoch > ?',
+                                                         (high_water_mark - recheck,)).fetchall()]
+        epochs = stale + list(range(high_water_mark + 1, last_ended + 1))
+        written = 0
+        for start in range(0, len(epochs), batch_size):
+            chunk = epochs[start:start + batch_size]
+            _, resp = engine.multicall.aggregate([engine.contract.functions.rounds(epoch) for epoch in chunk])
+            rounds = [engine.parse_round(round_resp) for round_resp in resp if round_resp is not None]
+            # epoch 0 in the struct means the round was never started
+            rounds = [round_resp for round_resp in rounds if round_resp['epoch'] > 0]
+            self.store(rounds)
+            written += len(rounds)
+        return written
+
+    def get(self, epoch):
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM rounds WHERE epoch = ?', (epoch,)).fetchone()
+        if row is None:
+            return None
+        resp = dict(zip(ROUND_KEYS, row))
+        resp['oracle_called'] = bool(resp['oracle_called'])
+        return resp
+
+    def frame(self, start_epoch=None, end_epoch=None):
+        """Rounds as a DataFrame sorted by epoch, optionally limited to an epoch range"""
+        query = 'SELECT * FROM rounds WHERE epoch >= ? AND epoch <= ? ORDER BY epoch'
+        with self.lock:
+            df = pd.read_sql_query(query, self.conn, params=(int(start_epoch or 0), int(end_epoch or 2 ** 62)))
+        df['oracle_called'] = df['oracle_called'].astype(bool)
+        return df
@@ -0,0 +1,83 @@
+import asyncio
+import collections
+import time
+
+
+class RoundEngine:
+    """
+    Runs a block handler exactly once per new head
+    Heads that arrive while the handler is busy are coalesced so the next run always sees the newest block
+    """
+
+    def __init__(self, handler, heads, history=1000):
+        self.handler = handler
+        self.heads = heads
+        self.last_block = None
+        self.skipped = 0
+        self.latencies = collections.deque(maxlen=history)
+        self._latest = None
+        self._new_head = None
+        self._stopped = False
+
+    async def _produce(self):
+        async for head in self.heads:
+            self._latest = head
+            self._new_head.set()
+            if self._stopped:
+                break
+
+    async def run(self, max_blocks=None):
+        loop = asyncio.get_running_loop()
+        self._new_head = asyncio.Event()
+        producer = asyncio.ensure_future(self._produce())
+        processed = 0
+        try:
+            while not self._stopped and (max_blocks is None or processed < max_blocks):
+                waiter = asyncio.ensure_future(self._new_head.wait())
+                await asyncio.wait([waiter, producer], return_when=asyncio.FIRST_COMPLETED)
+                if producer.done():
+                    waiter.cancel()
+                    producer.result()
+                    break
+                self._new_head.clear()
+                head = self._latest
+                if self.last_block is not None and head.number <= self.last_block:
+                    continue
+                if self.last_block is not None:
+                    self.skipped += head.number - self.last_block - 1
+                self.last_block = head.number
+                await loop.run_in_executor(None, self.handler, head.number)
+                self.latencies.append(time.perf_counter() - head.received_at)
+                processed += 1
+        finally:
+            producer.cancel()
+        return processed
+
+    def stop(self):
+        self._stopped = True
+
+    def latency_stats(self):
+        """Block-to-decision latency in milliseconds"""
+        if not self.latencies:
+            return {}
+        resp = sorted(self.latencies)
+        return {'count': len(resp),
+                'p50': resp[len(resp) // 2] * 1000,
+                'p99': resp[min(int(len(resp) * 0.99), len(resp) - 1)] * 1000,
+                'max': resp[-1] * 1000,
+                'skipped_blocks': self.skipped}
+
+
+if __name__ == '__main__':
+    from web3 import Web3
+    from connect.block_feed import new_heads
+    from connect.stub_node import StubNode
+
+    node = StubNode().start().start_mining(0.05)
+    ws_url = node.serve_websocket()
+    w3 = Web3(Web3.HTTPProvider(node.url))
+    for name, heads in [('block filter', new_heads(w3=w3, poll_interval=0.01)), ('websocket', new_heads(ws_url=ws_url))]:
+        engine = RoundEngine(lambda block_number: None, heads)
+        asyncio.run(engine.run(max_blocks=50))
+        print(name, engine.latency_stats())
+    node.stop()
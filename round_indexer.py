@@ -0,0 +1,292 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import requests
+from eth_utils import event_abi_to_log_topic
+
+from core.round_archive import ROUND_KEYS
+
+WEI = 10 ** 18
+# chainlink prices carry 8 decimals
+PRICE_UNIT = 10 ** 8
+START, LOCK, END, REWARDS = range(4)
+ROUND_EVENTS = {'StartRound': START, 'LockRound': LOCK, 'EndRound': END, 'RewardsCalculated': REWARDS}
+
+TABLES = {'rounds': np.dtype([('block', '<i8'), ('event', 'u1'), ('epoch', '<i8'), ('round_block', '<i8'),
+                              ('price', '<f8'), ('reward_base_cal_amount', '<f8'), ('reward_amount', '<f8')]),
+          'bets': np.dtype([('block', '<i8'), ('log_index', '<i4'), ('epoch', '<i8'), ('sender', 'u1', (20,)),
+                            ('direction', 'i1'), ('amount', '<f8')]),
+          'claims': np.dtype([('block', '<i8'), ('log_index', '<i4'), ('epoch', '<i8'), ('sender', 'u1', (20,)),
+                              ('amount', '<f8')])}
+
+# error messages of providers refusing an eth_getLogs query for its block range or result count
+RANGE_ERRORS = ['block range', 'range is too', 'range too', 'more than', 'too many results', 'query returned',
+                'response size']
+# throttled or timed out requests, retried at the same range after a backoff rather than split
+RATE_LIMIT_CODES = [429, -32029]
+RATE_LIMIT_ERRORS = ['rate limit', 'rate-limit', 'too many requests', 'request count exceeded', 'timeout',
+                     'timed out']
+
+
+class RangeTooWide(Exception):
+    pass
+
+
+class RateLimited(Exception):
+    pass
+
+
+def _word(data, i, signed=False):
+    return int.from_bytes(data[i * 32:(i + 1) * 32], 'big', signed=signed)
+
+
+class RoundIndexer:
+    """
+    Prediction contract history rebuilt from its event logs instead of one rounds(epoch) call per epoch
+    StartRound / LockRound / EndRound / RewardsCalculated, BetBull / BetBear and Claim logs are pulled in wide
+    eth_getLogs block ranges on a thread pool. A range the provider refuses is split in half until it passes, and
+    later ranges start from the narrower size. Logs are decoded into fixed size records, one append-only file per
+    table as the journal does, and a checkpoint of the last indexed block and record counts is written after every
+    batch so an interrupted sync resumes where it stopped. A rate limited query is retried after an exponential
+    backoff, up to `retries` times
+    """
+
+    def __init__(self, path, w3, contract, start_block=0, max_range=5000, workers=4, confirmations=15, retries=5,
+                 backoff=0.5):
+        self.path = path
+        self.w3 = w3
+        self.address = contract.address
+        self.start_block = start_block
+        self.max_range = max_range
+        self.range = max_range
+        self.workers = workers
+        self.confirmations = confirmations
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.events = {}
+        for fn_abi in contract.abi:
+            if fn_abi.get('type') == 'event' and fn_abi['name'] in list(ROUND_EVENTS) + ['BetBull', 'BetBear', 'Claim']:
+                self.events['0x' + event_abi_to_log_topic(fn_abi).hex()] = fn_abi['name']
+        os.makedirs(path, exist_ok=True)
+        self.checkpoint = self.load_checkpoint()
+        # drop records written after the last checkpoint by an interrupted batch
+        for table, dtype in TABLES.items():
+            table_path = self.table_path(table)
+            size = self.checkpoint['counts'][table] * dtype.itemsize
+            if os.path.exists(table_path) and os.path.getsize(table_path) > size:
+                with open(table_path, 'r+b') as f:
+                    f.truncate(size)
+
+    def table_path(self, table):
+        return os.path.join(self.path, '%s.bin' % table)
+
+    def load_checkpoint(self):
+        try:
+            with open(os.path.join(self.path, 'checkpoint.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'block': self.start_block - 1, 'counts': {table: 0 for table in TABLES}}
+
+    def save_checkpoint(self, block, counts):
+        checkpoint = {'block': block, 'counts': counts, 'updated_at': time.time()}
+        tmp_path = os.path.join(self.path, 'checkpoint.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, os.path.join(self.path, 'checkpoint.json'))
+        self.checkpoint = checkpoint
+
+    def get_logs(self, start, end):
+        try:
+            resp = self.w3.provider.make_request('eth_getLogs', [{'address': self.address,
+                                                                  'fromBlock': hex(start),
+                                                                  'toBlock': hex(end),
+                                                                  'topics': [list(self.events)]}])
+        except requests.exceptions.Timeout as e:
+            raise RateLimited(str(e))
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 429:
+                raise RateLimited(str(e))
+            raise
+        if 'error' in resp:
+            code = resp['error'].get('code')
+            message = str(resp['error'].get('message', resp['error'])).lower()
+            # checked first, some providers throttle with -32005 as well
+            if code in RATE_LIMIT_CODES or any(error in message for error in RATE_LIMIT_ERRORS):
+                raise RateLimited(message)
+            if code == -32005 or any(error in message for error in RANGE_ERRORS):
+                raise RangeTooWide(message)
+            raise ValueError(resp['error'])
+        return resp['result']
+
+    def fetch(self, start, end):
+        """Logs of [start, end], split in halves while the provider refuses the range"""
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    return self.get_logs(start, end)
+                except RateLimited:
+                    if attempt == self.retries:
+                        raise
+                    time.sleep(self.backoff * 2 ** attempt)
+        except RangeTooWide:
+            if start == end:
+                raise
+            middle = (start + end) // 2
+            with self.lock:
+                self.range = max(min(self.range, middle - start + 1), 1)
+            return self.fetch(start, middle) + self.fetch(middle + 1, end)
+
+    def decode(self, logs):
+        """Records of every table from a list of logs"""
+        rows = {table: [] for table in TABLES}
+        for log in logs:
+            name = self.events.get(log['topics'][0])
+            if name is None:
+                continue
+            block = int(log['blockNumber'], 16)
+            epoch = int(log['topics'][-1] if name in ROUND_EVENTS else log['topics'][2], 16)
+            data = bytes.fromhex(log['data'][2:])
+            if name in ROUND_EVENTS:
+                event = ROUND_EVENTS[name]
+                if event == REWARDS:
+                    rows['rounds'].append((block, event, epoch, block, 0.0, _word(data, 0) / WEI, _word(data, 1) / WEI))
+                else:
+                    price = _word(data, 1, signed=True) / PRICE_UNIT if event != START else 0.0
+                    rows['rounds'].append((block, event, epoch, _word(data, 0), price, 0.0, 0.0))
+            else:
+                sender = np.frombuffer(bytes.fromhex(log['topics'][1][-40:]), dtype='u1')
+                log_index = int(log['logIndex'], 16)
+                if name == 'Claim':
+                    rows['claims'].append((block, log_index, epoch, sender, _word(data, 0) / WEI))
+                else:
+                    rows['bets'].append((block, log_index, epoch, sender, 1 if name == 'BetBull' else -1,
+                                         _word(data, 0) / WEI))
+        return {table: np.array(rows[table], dtype=TABLES[table]) for table in TABLES}
+
+    def store(self, records, block):
+        counts = dict(self.checkpoint['counts'])
+        for table, table_records in records.items():
+            if len(table_records):
+                with open(self.table_path(table), 'ab') as f:
+                    f.write(table_records.tobytes())
+                counts[table] += len(table_records)
+        self.save_checkpoint(block, counts)
+
+    def sync(self, end_block=None, progress=None):
+        """
+        Index every block after the checkpoint up to end_block (the head less `confirmations` by default)
+        Returns the number of logs indexed, progress(block, logs) is called after every batch
+        """
+        if end_block is None:
+            end_block = self.w3.eth.block_number - self.confirmations
+        indexed = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while self.checkpoint['block'] < end_block:
+                ranges = []
+                start = self.checkpoint['block'] + 1
+                while start <= end_block and len(ranges) < self.workers * 2:
+                    end = min(start + self.range - 1, end_block)
+                    ranges.append((start, end))
+                    start = end + 1
+                logs = [log for resp in pool.map(lambda block_range: self.fetch(*block_range), ranges) for log in resp]
+                self.store(self.decode(logs), ranges[-1][1])
+                indexed += len(logs)
+                if progress is not None:
+                    progress(ranges[-1][1], indexed)
+                with self.lock:
+                    # widen again after a batch without refusals
+                    self.range = min(self.range * 2, self.max_range)
+        return indexed
+
+    def table(self, name):
+        """Records of a table as a structured array, memory mapped up to the checkpoint"""
+        count = self.checkpoint['counts'][name]
+        if not count:
+            return np.zeros(0, dtype=TABLES[name])
+        return np.memmap(self.table_path(name), dtype=TABLES[name], mode='r', shape=(count,))
+
+    def bets(self):
+        records = self.table('bets')
+        df = pd.DataFrame({'block': records['block'], 'epoch': records['epoch'],
+                           'sender': ['0x' + sender.tobytes().hex() for sender in records['sender']],
+                           'direction': np.where(records['direction'] > 0, 'bull', 'bear'),
+                           'amount': records['amount']})
+        return df
+
+    def frame(self):
+        """Rounds in the RoundArchive layout, lock and end blocks are the blocks the round was locked and ended at"""
+        records = self.table('rounds')
+        df = pd.DataFrame(np.asarray(records))
+        resp = pd.DataFrame({'epoch': np.unique(records['epoch'])}).set_index('epoch')
+        for event, column in [(START, 'start_block'), (LOCK, 'lock_block'), (END, 'end_block')]:
+            resp[column] = df[df['event'] == event].groupby('epoch')['round_block'].last()
+        resp['lock_price'] = df[df['event'] == LOCK].groupby('epoch')['price'].last()
+        resp['close_price'] = df[df['event'] == END].groupby('epoch')['price'].last()
+        rewards = df[df['event'] == REWARDS].groupby('epoch')
+        resp['reward_base_cal_amount'] = rewards['reward_base_cal_amount'].last()
+        resp['reward_amount'] = rewards['reward_amount'].last()
+        bets = self.table('bets')
+        flows = pd.DataFrame({'epoch': bets['epoch'], 'bull': np.where(bets['direction'] > 0, bets['amount'], 0.0),
+                              'bear': np.where(bets['direction'] < 0, bets['amount'], 0.0)}).groupby('epoch').sum()
+        resp['bull_amount'] = flows['bull']
+        resp['bear_amount'] = flows['bear']
+        resp = resp.fillna({'bull_amount': 0.0, 'bear_amount': 0.0, 'reward_base_cal_amount': 0.0,
+                            'reward_amount': 0.0, 'lock_price': 0.0, 'close_price': 0.0})
+        resp['total_amount'] = resp['bull_amount'] + resp['bear_amount']
+        resp['oracle_called'] = resp['end_block'].notna()
+        return resp.reset_index()[ROUND_KEYS]
+
+    def bettors(self):
+        """Per bettor flow over ended rounds: bets, volume, bull share, wins and PnL before gas"""
+        rounds = self.frame()
+        rounds = rounds[rounds['oracle_called']]
+        df = self.bets().merge(rounds[['epoch', 'lock_price', 'close_price', 'total_amount', 'bull_amount',
+                                       'bear_amount', 'reward_amount']], on='epoch')
+        won = np.where(df['direction'] == 'bull', df['close_price'] > df['lock_price'],
+                       df['close_price'] < df['lock_price'])
+        winning_pool = np.where(df['direction'] == 'bull', df['bull_amount'], df['bear_amount'])
+        df['win'] = won
+        df['pnl'] = np.where(won, df['amount'] * df['reward_amount'] / np.where(winning_pool > 0, winning_pool, 1),
+                             0.0) - df['amount']
+        df['bull_volume'] = np.where(df['direction'] == 'bull', df['amount'], 0.0)
+        resp = df.groupby('sender').agg(bets=('epoch', 'count'), volume=('amount', 'sum'),
+                                        bull_volume=('bull_volume', 'sum'), wins=('win', 'sum'), pnl=('pnl', 'sum'))
+        resp['bull_share'] = resp['bull_volume'] / resp['volume']
+        resp['hit_rate'] = resp['wins'] / resp['bets']
+        return resp.drop(columns='bull_volume').sort_values('volume', ascending=False)
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    from connect.simulator import Simulator, synthetic_history
+    from connect.transport import Transport
+    from connect.web3_client import load_contract, address_dict
+
+    # a simulated market served by a node that caps log queries like a public endpoint
+    sim = Simulator(synthetic_history(200), interval_blocks=20).start()
+    sim.node.max_log_range = 500
+    sim.node.log_limit = 1000
+    sim.run()
+    w3 = Transport().web3(sim.node.url)
+    contract = load_contract(w3, 'pancake_bnb_prediction.abi', address_dict['pancake_bnb_prediction_address'])
+    path = tempfile.mkdtemp()
+    try:
+        indexer = RoundIndexer(path, w3, contract, start_block=1, confirmations=0)
+        start = time.perf_counter()
+        logs = indexer.sync(end_block=sim.block // 2)
+        # a new indexer on the same path resumes from the checkpoint
+        indexer = RoundIndexer(path, w3, contract, start_block=1, confirmations=0)
+        logs += indexer.sync(end_block=sim.block)
+        print('%s logs over %s blocks in %.3fs, range settled at %s blocks' % (
+            logs, sim.block, time.perf_counter() - start, indexer.range))
+        print(indexer.frame().tail())
+    finally:
+        sim.stop()
+        shutil.rmtree(path)
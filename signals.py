@@ -0,0 +1,368 @@
+import abc
+import collections
+import time
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class Observation(NamedTuple):
+    """What the pipeline sees of one block: prices, the round being bet and its (projected) pools"""
+    time: float
+    block_number: int
+    epoch: int
+    lock_block: int
+    binance_price: Optional[float]
+    chainlink_price: float
+    oracle_updated_at: Optional[float]
+    total_amount: float
+    bull_amount: float
+    bear_amount: float
+    # probability the oracle publishes a new answer before lock, None when unknown (no oracle history, batch runs)
+    update_probability: Optional[float] = None
+
+
+class Feature(abc.ABC):
+    """
+    One value per observation, updated from the previous state in O(1)
+    values holds the features computed before this one for the same observation
+    """
+    name = None
+
+    @abc.abstractmethod
+    def update(self, observation, values):
+        pass
+
+    def reset(self):
+        pass
+
+
+class Premium(Feature):
+    name = 'premium'
+
+    def update(self, observation, values):
+        if observation.binance_price is None:
+            return None
+        return (observation.binance_price - observation.chainlink_price) / observation.chainlink_price
+
+
+class PremiumVelocity(Feature):
+    """Change of the premium per second between observations, smoothed with an EMA of weight alpha"""
+    name = 'premium_velocity'
+
+    def __init__(self, alpha=0.5):
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self.last = None
+        self.velocity = None
+
+    def update(self, observation, values):
+        premium = values.get('premium')
+        if premium is None:
+            return self.velocity
+        if self.last is not None and observation.time > self.last[0]:
+            velocity = (premium - self.last[1]) / (observation.time - self.last[0])
+            self.velocity = velocity if self.velocity is None else (
+                self.alpha * velocity + (1 - self.alpha) * self.velocity)
+        self.last = (observation.time, premium)
+        return self.velocity
+
+
+class OracleAge(Feature):
+    """
+    Seconds since the chainlink answer was updated
+    Without oracle_updated_at (batch runs over sampled prices) the update is taken at the first observation of a new
+    answer
+    """
+    name = 'oracle_age'
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.answer = None
+        self.changed_at = None
+
+    def update(self, observation, values):
+        if observation.oracle_updated_at is not None:
+            return observation.time - observation.oracle_updated_at
+        if observation.chainlink_price != self.answer:
+            self.answer = observation.chainlink_price
+            self.changed_at = observation.time
+        return observation.time - self.changed_at
+
+
+class PoolImbalance(Feature):
+    """Bull minus bear pool over the total, in [-1, 1]"""
+    name = 'pool_imbalance'
+
+    def update(self, observation, values):
+        if observation.total_amount <= 0:
+            return 0.0
+        return (observation.bull_amount - observation.bear_amount) / observation.total_amount
+
+
+class PoolSize(Feature):
+    name = 'pool_size'
+
+    def update(self, observation, values):
+        return observation.total_amount
+
+
+class UpdateProbability(Feature):
+    name = 'update_probability'
+
+    def update(self, observation, values):
+        return observation.update_probability
+
+
+class BlocksRemaining(Feature):
+    name = 'blocks_remaining'
+
+    def update(self, observation, values):
+        return observation.lock_block - observation.block_number
+
+
+class ProjectedOdds(Feature):
+    """Decimal odds of one side on the projected pools, 0 when the side's pool is empty"""
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.name = '%s_odds' % direction
+
+    def update(self, observation, values):
+        side_amount = observation.bull_amount if self.direction == 'bull' else observation.bear_amount
+        return observation.total_amount / side_amount if side_amount > 0 else 0.0
+
+
+def default_features():
+    return [Premium(), PremiumVelocity(), OracleAge(), UpdateProbability(), PoolImbalance(), PoolSize(),
+            BlocksRemaining(), ProjectedOdds('bull'), ProjectedOdds('bear')]
+
+
+# Strategies are functions of the feature values returning 'bull', 'bear' or None, filters are functions of the
+# feature values and a direction returning whether a bet that way is allowed
+
+
+def premium_threshold(threshold):
+    """Bet the side of the premium when it is beyond threshold, the rule of bet_trigger"""
+    def strategy(features):
+        premium = features['premium']
+        if premium is None or abs(premium) <= threshold:
+            return None
+        return 'bull' if premium > 0 else 'bear'
+    return strategy
+
+
+def premium_momentum(min_velocity):
+    """Bet the side the premium is moving to when it moves faster than min_velocity per second"""
+    def strategy(features):
+        velocity = features['premium_velocity']
+        if velocity is None or abs(velocity) <= min_velocity:
+            return None
+        return 'bull' if velocity > 0 else 'bear'
+    return strategy
+
+
+def min_odds(min_bet_odds):
+    return lambda features, direction: features['%s_odds' % direction] >= min_bet_odds
+
+
+def min_pool(min_pool_size):
+    return lambda features, direction: features['pool_size'] >= min_pool_size
+
+
+def bet_window(blocks_away, execution_block):
+    return lambda features, direction: blocks_away >= features['blocks_remaining'] >= execution_block
+
+
+def max_oracle_age(seconds):
+    return lambda features, direction: features['oracle_age'] <= seconds
+
+
+def oracle_lag(max_update_probability):
+    """Bet only while the oracle is unlikely to absorb the premium before lock, as bet_trigger does, unknown passes"""
+    return lambda features, direction: (features['update_probability'] is None
+                                        or features['update_probability'] <= max_update_probability)
+
+
+def compose(strategy, *filters):
+    """strategy's direction when every filter allows it"""
+    def composed(features):
+        direction = strategy(features)
+        if direction is None:
+            return None
+        for allowed in filters:
+            if not allowed(features, direction):
+                return None
+        return direction
+    return composed
+
+
+def agree(*strategies):
+    """The direction every strategy returns, None when one abstains or they disagree"""
+    def agreed(features):
+        direction = None
+        for strategy in strategies:
+            resp = strategy(features)
+            if resp is None or (direction is not None and resp != direction):
+                return None
+            direction = resp
+        return direction
+    return agreed
+
+
+def premium_strategy(bet_threshold, min_bet_odds=1.0, min_pool_size=0.0, max_update_probability=1.0,
+                     blocks_away=None, execution_block=None, **params):
+    """bet_trigger and odds_trigger as a pipeline strategy"""
+    filters = [oracle_lag(max_update_probability), min_pool(min_pool_size),
+               min_odds(min_bet_odds)]
+    if blocks_away is not None:
+        filters.append(bet_window(blocks_away, execution_block or 0))
+    return compose(premium_threshold(bet_threshold), *filters)
+
+
+def momentum_strategy(bet_threshold, min_velocity=0.0, min_bet_odds=1.0, min_pool_size=0.0,
+                      max_update_probability=1.0, blocks_away=None, execution_block=None, **params):
+    """A premium beyond bet_threshold that is still widening"""
+    filters = [oracle_lag(max_update_probability), min_pool(min_pool_size),
+               min_odds(min_bet_odds)]
+    if blocks_away is not None:
+        filters.append(bet_window(blocks_away, execution_block or 0))
+    return compose(agree(premium_threshold(bet_threshold), premium_momentum(min_velocity)), *filters)
+
+
+# strategies a config can name under [params] strategy
+STRATEGIES = {'premium': premium_strategy, 'momentum': momentum_strategy}
+
+
+class SignalPipeline:
+    """
+    Features updated once per observation and shared by every strategy
+    Live, update() is called with the observation of each snapshot and decide() reads a strategy's direction. run()
+    feeds a whole history through the same features and strategies and returns one row per observation
+    """
+
+    def __init__(self, features=None):
+        self.features = list(features) if features is not None else default_features()
+        self.strategies = collections.OrderedDict()
+        self.values = {}
+
+    def add_strategy(self, name, strategy):
+        self.strategies[name] = strategy
+        return self
+
+    def reset(self):
+        for feature in self.features:
+            feature.reset()
+        self.values = {}
+
+    def update(self, observation):
+        values = {}
+        for feature in self.features:
+            values[feature.name] = feature.update(observation, values)
+        self.values = values
+        return values
+
+    def decide(self, name):
+        """Direction of one strategy on the last update"""
+        return self.strategies[name](self.values)
+
+    def evaluate(self):
+        return {name: strategy(self.values) for name, strategy in self.strategies.items()}
+
+    def run(self, observations):
+        """Features and every strategy's direction for each observation of a history, from a fresh state"""
+        self.reset()
+        rows = []
+        for observation in observations:
+            row = observation._asdict()
+            row.update(self.update(observation))
+            row.update(self.evaluate())
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+
+def observations_from_history(samples, rounds, bets=None):
+    """
+    Observations of a history, the last premium recorder sample of every block
+    Pools are the bets placed up to the block when the indexed bets (RoundIndexer.bets()) are given, otherwise the
+    final pools of the rounds (a RoundArchive or RoundIndexer frame), which look ahead of the block
+    """
+    samples = samples[np.append(samples['block'][1:] != samples['block'][:-1], True)]
+    epochs = samples['epoch'].astype(np.int64)
+    blocks = samples['block'].astype(np.int64)
+    if bets is not None and len(bets):
+        bets = bets.sort_values(['epoch', 'block'])
+        keys = bets['epoch'].to_numpy(np.int64) * 2 ** 32 + bets['block'].to_numpy(np.int64)
+        bull = np.concatenate([[0.0], np.cumsum(np.where(bets['direction'] == 'bull', bets['amount'], 0.0))])
+        bear = np.concatenate([[0.0], np.cumsum(np.where(bets['direction'] == 'bear', bets['amount'], 0.0))])
+        end = np.searchsorted(keys, epochs * 2 ** 32 + blocks, side='right')
+        start = np.searchsorted(keys, epochs * 2 ** 32, side='left')
+        bull_amount, bear_amount = bull[end] - bull[start], bear[end] - bear[start]
+    else:
+        pools = rounds.set_index('epoch').reindex(epochs)
+        bull_amount = pools['bull_amount'].fillna(0.0).to_numpy(np.float64)
+        bear_amount = pools['bear_amount'].fillna(0.0).to_numpy(np.float64)
+    return [Observation(time=float(samples['time'][i]), block_number=int(blocks[i]), epoch=int(epochs[i]),
+                        lock_block=int(blocks[i] + samples['blocks_left'][i]),
+                        binance_price=float(samples['binance'][i]), chainlink_price=float(samples['chainlink'][i]),
+                        oracle_updated_at=None, total_amount=float(bull_amount[i] + bear_amount[i]),
+                        bull_amount=float(bull_amount[i]), bear_amount=float(bear_amount[i]))
+            for i in range(len(samples))]
+
+
+def first_decisions(df, rounds, strategies):
+    """First direction of each named strategy in every epoch of a run() frame, and whether it won the round"""
+    outcome = rounds.set_index('epoch')
+    resp = []
+    for name in strategies:
+        bets = df[df[name].notna()].groupby('epoch')[name].first()
+        won = outcome.reindex(bets.index)
+        bull_won = (won['close_price'] > won['lock_price']).to_numpy()
+        resp.append(pd.DataFrame({'strategy': name, 'epoch': bets.index, 'direction': bets.values,
+                                  'win': (bets == 'bull').to_numpy() == bull_won}))
+    return pd.concat(resp, ignore_index=True)
+
+
+def synthetic_observations(n, interval_blocks=100, seed=0):
+    """n blocks of a random walk Binance price, a lagging oracle and growing pools"""
+    rng = np.random.default_rng(seed)
+    binance = 300 * np.exp(np.cumsum(rng.normal(0, 0.0005, n)))
+    resp, answer, updated_at = [], binance[0], 0.0
+    bull = bear = 0.0
+    for block in range(n):
+        now = block * 3.0
+        if abs(binance[block] - answer) / answer > 0.005 or now - updated_at >= 60:
+            answer, updated_at = binance[block], now
+        if block % interval_blocks == 0:
+            bull = bear = 0.0
+        bull += rng.exponential(0.05)
+        bear += rng.exponential(0.05)
+        resp.append(Observation(time=now, block_number=block, epoch=block // interval_blocks,
+                                lock_block=(block // interval_blocks + 1) * interval_blocks,
+                                binance_price=float(binance[block]), chainlink_price=float(answer),
+                                oracle_updated_at=updated_at, total_amount=bull + bear, bull_amount=bull,
+                                bear_amount=bear))
+    return resp
+
+
+if __name__ == '__main__':
+    observations = synthetic_observations(100000)
+    variants = [premium_strategy(threshold, min_bet_odds=odds, blocks_away=20, execution_block=5)
+                for threshold in [0.002, 0.003, 0.005, 0.008] for odds in [1.0, 1.8]]
+    variants += [momentum_strategy(threshold, min_velocity=velocity, blocks_away=20, execution_block=5)
+                 for threshold in [0.002, 0.003, 0.005, 0.008] for velocity in [0.0, 1e-5]]
+    for count in [0, 1, 2, 4, 8, 16]:
+        pipeline = SignalPipeline()
+        for i in range(count):
+            pipeline.add_strategy('strategy_%s' % i, variants[i])
+        start = time.perf_counter()
+        for observation in observations:
+            pipeline.update(observation)
+            pipeline.evaluate()
+        elapsed = time.perf_counter() - start
+        print('%2s strategies: %.1fus per block' % (count, elapsed / len(observations) * 10 ** 6))
@@ -0,0 +1,228 @@
+import random
+import threading
+import time
+
+from connect.stub_node import StubNode, PredictionState, BinanceReplay
+
+WEI = 10 ** 18
+# chainlink answers and round prices carry 8 decimals
+PRICE_UNIT = 10 ** 8
+
+
+def synthetic_history(n, price=300.0, volatility=0.003, pool=10.0, seed=0):
+    """n rounds of a random walk market with random crowd pools, in the fields RoundArchive.frame() holds"""
+    rng = random.Random(seed)
+    history = []
+    for _ in range(n):
+        close = price * (1 + rng.gauss(0, volatility))
+        history.append({'lock_price': price, 'close_price': close,
+                        'bull_amount': rng.gammavariate(2, pool / 4), 'bear_amount': rng.gammavariate(2, pool / 4)})
+        price = close
+    return history
+
+
+def history_from_archive(df):
+    """Recorded rounds (a RoundArchive frame) as a simulator history"""
+    df = df[df['oracle_called']].sort_values('epoch')
+    return df[['lock_price', 'close_price', 'bull_amount', 'bear_amount']].to_dict('records')
+
+
+def price_path(history, interval_blocks, noise=0.0005, seed=0):
+    """
+    Binance price per block: round i is live over blocks [(i + 1), (i + 2)) * interval_blocks and moves from its lock
+    to its close price along a brownian bridge, the first interval is flat at the first lock price
+    """
+    rng = random.Random(seed)
+    path = [history[0]['lock_price']] * interval_blocks
+    for resp in history:
+        start, end = resp['lock_price'], resp['close_price']
+        walk = [0.0]
+        for _ in range(interval_blocks):
+            walk.append(walk[-1] + rng.gauss(0, noise * start))
+        for k in range(interval_blocks):
+            weight = k / interval_blocks
+            path.append(start + (end - start) * weight + walk[k] - weight * walk[-1])
+    path.append(history[-1]['close_price'])
+    return path
+
+
+class Simulator:
+    """
+    Deterministic local chain and exchange for the bot, driven block by block from a round history
+    Each block moves the Binance price along the path and publishes it as a trade, the oracle follows once the
+    price has deviated by more than `deviation` for `oracle_delay` blocks or after `heartbeat` blocks, and rounds are
+    locked, ended and started at their lock blocks as executeRound does, with the crowd pools of the history
+    run() can call a handler after every block (lockstep, reproducible), start() produces blocks on a thread for bots
+    that run their own loop
+    """
+
+    def __init__(self, history, interval_blocks=20, deviation=0.001, oracle_delay=2, heartbeat=20, noise=0.0005,
+                 symbol='BNBUSDT', seed=0):
+        self.history = history
+        self.interval_blocks = interval_blocks
+        self.deviation = deviation
+        self.oracle_delay = oracle_delay
+        self.heartbeat = heartbeat
+        self.symbol = symbol
+        self.path = price_path(history, interval_blocks, noise=noise, seed=seed)
+        self.node = StubNode(seed=seed)
+        self.state = PredictionState(interval_blocks=interval_blocks,
+                                     answer=int(self.path[0] * PRICE_UNIT)).attach(self.node)
+        self.binance = BinanceReplay({'lastUpdateId': 1, 'bids': [], 'asks': []}, [])
+        self.block = 0
+        self.trade_id = 0
+        self.deviated_for = 0
+        self.since_update = 0
+        self.next_execute = 0
+        self.locked = None
+        self.rounds_started = 0
+        self.rounds_settled = 0
+        self.finished = False
+        self.latencies = []
+        self.elapsed = 0.0
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self, block_interval=None):
+        """Serve the node and Binance, and produce blocks every block_interval seconds if one is given"""
+        self.node.start()
+        self.binance.start()
+        if block_interval is not None:
+            self._thread = threading.Thread(target=self.run, kwargs={'block_interval': block_interval}, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.node.stop()
+        self.binance.stop()
+
+    def publish_price(self, price):
+        self.trade_id += 1
+        now = int(time.time() * 1000)
+        self.binance.publish({'stream': '%s@trade' % self.symbol.lower(),
+                              'data': {'e': 'trade', 'E': now, 's': self.symbol, 't': self.trade_id,
+                                       'p': '%.4f' % price, 'q': '1.000', 'T': now}})
+
+    def oracle_step(self, price):
+        answer = self.state.answer / PRICE_UNIT
+        self.deviated_for = self.deviated_for + 1 if abs(price - answer) / answer >= self.deviation else 0
+        self.since_update += 1
+        if self.deviated_for > self.oracle_delay or self.since_update >= self.heartbeat:
+            self.state.update_answer(int(price * PRICE_UNIT))
+            self.deviated_for = 0
+            self.since_update = 0
+
+    def execute_round(self):
+        """Lock the current round, end the previous one and start the next, at the oracle's current answer"""
+        epoch, answer = self.state.epoch, self.state.answer
+        if self.rounds_started == len(self.history) and self.locked == epoch:
+            # nothing left to start, the last round ends one interval after its lock
+            self.state.settle(epoch, self.state.rounds[epoch][4], answer)
+            self.rounds_settled += 1
+            self.finished = True
+            return
+        if epoch >= 1:
+            self.state.lock_round(epoch, answer)
+            self.locked = epoch
+        if epoch >= 2:
+            self.state.settle(epoch - 1, self.state.rounds[epoch - 1][4], answer)
+            self.rounds_settled += 1
+        if self.rounds_started == len(self.history):
+            return
+        resp = self.history[self.rounds_started]
+        epoch = self.state.start_round()
+        round_resp = self.state.rounds[epoch]
+        round_resp[7] = int(resp['bull_amount'] * WEI)
+        round_resp[8] = int(resp['bear_amount'] * WEI)
+        round_resp[6] = round_resp[7] + round_resp[8]
+        self.rounds_started += 1
+
+    def step(self):
+        """Produce one block, returns its number"""
+        number = self.node.mine()
+        self.block += 1
+        price = self.path[min(self.block, len(self.path) - 1)]
+        self.publish_price(price)
+        with self.node.lock:
+            self.oracle_step(price)
+            if number >= self.next_execute:
+                self.execute_round()
+                self.next_execute = number + self.interval_blocks
+        return number
+
+    def run(self, handler=None, block_interval=0.0, feed=None, max_blocks=None, timeout=5.0):
+        """
+        Produce blocks until every round of the history is settled
+        handler(block_number) runs after each block and is timed as the decision latency. Given the bot's PriceFeed,
+        each block waits until the feed has seen the block's trade so runs are reproducible
+        """
+        start = time.perf_counter()
+        blocks = 0
+        while not self.finished and not self._stopped.is_set() and (max_blocks is None or blocks < max_blocks):
+            number = self.step()
+            blocks += 1
+            if feed is not None:
+                deadline = time.time() + timeout
+                while (feed.last_trade_id or 0) < self.trade_id and time.time() < deadline:
+                    time.sleep(0.0005)
+            if handler is not None:
+                decision_start = time.perf_counter()
+                handler(number)
+                self.latencies.append(time.perf_counter() - decision_start)
+            if block_interval:
+                time.sleep(block_interval)
+        self.elapsed += time.perf_counter() - start
+        return blocks
+
+    def pnl(self, address):
+        """Bets, wins and net BNB of an account over the settled rounds, from the contract ledgers"""
+        bets, wins, pnl = 0, 0, 0.0
+        for (epoch, user), (position, amount, claimed) in self.state.ledgers.items():
+            resp = self.state.rounds[epoch]
+            if user != address.lower() or not resp[11]:
+                continue
+            bets += 1
+            if self.state.claimable(epoch, address) or claimed:
+                wins += 1
+                pnl += (amount * resp[10] / resp[9] - amount) / WEI
+            else:
+                pnl -= amount / WEI
+        return {'bets': bets, 'wins': wins, 'pnl': pnl}
+
+    def report(self, address=None):
+        latencies = sorted(self.latencies)
+        resp = {'blocks': self.block,
+                'rounds': self.rounds_settled,
+                'elapsed_s': self.elapsed,
+                'blocks_per_s': self.block / self.elapsed if self.elapsed else None,
+                'rounds_per_s': self.rounds_settled / self.elapsed if self.elapsed else None,
+                'decision_p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else None,
+                'decision_p99_ms': latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000
+                if latencies else None,
+                'decision_max_ms': latencies[-1] * 1000 if latencies else None}
+        if address is not None:
+            resp.update(self.pnl(address))
+        return resp
+
+
+if __name__ == '__main__':
+    import sys
+    from connect.transport import Transport
+    from connect.web3_client import address_dict, wallet
+    from core.pancake_prediction import PancakePrediction
+    from core.price_feed import PriceFeed
+
+    # a config of its own so the run never touches the live bet index, archive or journal
+    config = sys.argv[1] if len(sys.argv) > 1 else 'pancake_bnb_simulation.ini'
+    sim = Simulator(synthetic_history(100), interval_blocks=20).start()
+    feed = PriceFeed(ws_url=sim.binance.ws_url, rest_url=sim.binance.rest_url).start()
+    while not feed.ready.is_set():
+        sim.publish_price(sim.path[0])
+        time.sleep(0.05)
+    pp = PancakePrediction(abi_name='pancake_bnb_prediction.abi', address=address_dict['pancake_bnb_prediction_address'],
+                           config=config, provider=sim.node.url, transport=Transport(), logging=True, live=True,
+                           price_feed=feed)
+    sim.run(handler=pp.safe_on_block, feed=feed)
+    print(sim.report(address=wallet[0]))
+    sim.stop()
@@ -0,0 +1,156 @@
+import time
+
+import numpy as np
+
+from core.equity_curve import PAYOUT_RATIO, GAS_FEE
+
+
+def pool_odds(total, side_amount):
+    """Decimal odds of a side (total pool over the side's pool), 0 where the side's pool is empty"""
+    total = np.asarray(total, dtype=np.float64)
+    side_amount = np.asarray(side_amount, dtype=np.float64)
+    out = np.zeros(np.broadcast(total, side_amount).shape)
+    return np.divide(total, side_amount, out=out, where=side_amount > 0)
+
+
+def round_odds(total, bull_amount, bear_amount):
+    """(bull odds, bear odds) of every round"""
+    return pool_odds(total, bull_amount), pool_odds(total, bear_amount)
+
+
+def kelly(win_probability, odds, payout_ratio=PAYOUT_RATIO):
+    """
+    Kelly fraction of a bet winning with win_probability and paying odds x payout_ratio of the stake back
+    -1 where the payout does not beat the stake (empty or one sided pools), as kelly_calculator did on a zero division
+    """
+    win_probability = np.asarray(win_probability, dtype=np.float64)
+    net_odds = np.asarray(odds, dtype=np.float64) * payout_ratio - 1
+    out = np.full(np.broadcast(win_probability, net_odds).shape, -1.0)
+    return np.divide(win_probability * net_odds - (1 - win_probability), net_odds, out=out, where=net_odds > 0)
+
+
+def bet_size(kelly_fraction, bankroll, fraction=0.5, cap=1.0, min_bet=0.0, max_bet=np.inf):
+    """
+    Stake of `fraction` Kelly on the bankroll, at most cap x bankroll and max_bet
+    0 where Kelly is not positive or the stake falls under min_bet
+    """
+    size = np.minimum(np.clip(np.asarray(kelly_fraction) * fraction, 0, cap) * bankroll, max_bet)
+    return np.where((size > 0) & (size >= min_bet), size, 0.0)
+
+
+def expected_pnl(size, win_probability, odds, gas_fee=GAS_FEE, payout_ratio=PAYOUT_RATIO):
+    """Expected PnL of a stake net of the bet and claim gas, 0 for no stake"""
+    size = np.asarray(size, dtype=np.float64)
+    pnl = size * (np.asarray(win_probability) * np.asarray(odds) * payout_ratio - 1) - gas_fee
+    return np.where(size > 0, pnl, 0.0)
+
+
+def size_rounds(total, bull_amount, bear_amount, bull_probability, bear_probability=None, bankroll=1.0, fraction=0.5,
+                cap=1.0, min_bet=0.0, max_bet=np.inf, gas_fee=GAS_FEE, payout_ratio=PAYOUT_RATIO):
+    """
+    Odds, Kelly and stakes of both sides for arrays of rounds in one pass
+    Every argument broadcasts, e.g. rounds along one axis and win probability or bankroll scenarios along another.
+    bear_probability defaults to bull_probability (a signal that is right with the same probability either way).
+    A side is staked only when its expected PnL covers the gas
+    """
+    if bear_probability is None:
+        bear_probability = bull_probability
+    bull_odds, bear_odds = round_odds(total, bull_amount, bear_amount)
+    resp = {'bull_odds': bull_odds, 'bear_odds': bear_odds}
+    for side, odds, win_probability in [('bull', bull_odds, bull_probability), ('bear', bear_odds, bear_probability)]:
+        side_kelly = kelly(win_probability, odds, payout_ratio=payout_ratio)
+        size = bet_size(side_kelly, bankroll, fraction=fraction, cap=cap, min_bet=min_bet, max_bet=max_bet)
+        profitable = expected_pnl(size, win_probability, odds, gas_fee=gas_fee, payout_ratio=payout_ratio) > 0
+        resp['%s_kelly' % side] = side_kelly
+        resp['%s_size' % side] = np.where(profitable, size, 0.0)
+    return resp
+
+
+def simulate_bankroll(odds, win_probability, true_probability=None, bankroll=1.0, n_paths=10 ** 6, n_rounds=288,
+                      fraction=0.5, cap=1.0, min_bet=0.0, max_bet=np.inf, gas_fee=GAS_FEE,
+                      payout_ratio=PAYOUT_RATIO, seed=0):
+    """
+    Monte Carlo bankroll paths of the Kelly sizing, one round of every path per step
+    Each round draws the odds of the side bet from `odds` (e.g. the bet odds of past rounds), stakes on the
+    win_probability estimate and wins with true_probability (the estimate itself when None), so estimation error
+    can be priced in. Kelly and the edge only depend on the drawn odds and are computed once per distinct value
+    Returns the final bankroll and the max drawdown (share of the peak) of every path
+    """
+    if true_probability is None:
+        true_probability = win_probability
+    rng = np.random.default_rng(seed)
+    odds = np.asarray(odds, dtype=np.float64)
+    stake = np.clip(kelly(win_probability, odds, payout_ratio=payout_ratio) * fraction, 0, cap)
+    edge = win_probability * odds * payout_ratio - 1
+    payout = odds * payout_ratio
+    wealth = np.full(n_paths, float(bankroll))
+    peak = wealth.copy()
+    max_drawdown = np.zeros(n_paths)
+    for _ in range(n_rounds):
+        index = rng.integers(len(odds), size=n_paths)
+        size = np.minimum(np.minimum(stake[index] * wealth, max_bet), np.maximum(wealth - gas_fee, 0))
+        bet = (size > 0) & (size >= min_bet) & (size * edge[index] > gas_fee)
+        win = rng.random(n_paths) < true_probability
+        wealth += np.where(bet, size * (np.where(win, payout[index], 0.0) - 1) - gas_fee, 0.0)
+        np.maximum(peak, wealth, out=peak)
+        np.maximum(max_drawdown, 1 - wealth / peak, out=max_drawdown)
+    return wealth, max_drawdown
+
+
+def bankroll_summary(wealth, max_drawdown, bankroll=1.0, ruin=0.1):
+    """Distribution of simulate_bankroll paths, ruin is a final bankroll under `ruin` x the starting one"""
+    growth = np.log(np.maximum(wealth, 1e-12) / bankroll)
+    return {'paths': len(wealth),
+            'median': float(np.median(wealth)),
+            'p5': float(np.percentile(wealth, 5)),
+            'p95': float(np.percentile(wealth, 95)),
+            'mean_log_growth': float(growth.mean()),
+            'ruin_probability': float(np.mean(wealth < ruin * bankroll)),
+            'median_max_drawdown': float(np.median(max_drawdown))}
+
+
+def _loop_kelly(total, bull_amount, bear_amount, win_probability):
+    # kelly_calculator(half_kelly=True) style reference loop
+    resp = []
+    for i in range(len(total)):
+        try:
+            bull_odds = total[i] / bull_amount[i]
+            bear_odds = total[i] / bear_amount[i]
+            resp.append((win_probability - (1 - win_probability) / (bull_odds * PAYOUT_RATIO - 1),
+                         win_probability - (1 - win_probability) / (bear_odds * PAYOUT_RATIO - 1)))
+        except ZeroDivisionError:
+            resp.append((-1, -1))
+    return resp
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    n = 100000
+    bull_amount = rng.gamma(2, 5, n)
+    bear_amount = rng.gamma(2, 5, n)
+    bull_amount[::1000] = 0
+    total = bull_amount + bear_amount
+
+    start = time.perf_counter()
+    loop = _loop_kelly(total.tolist(), bull_amount.tolist(), bear_amount.tolist(), 0.55)
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    resp = size_rounds(total, bull_amount, bear_amount, 0.55, fraction=1.0)
+    vector_time = time.perf_counter() - start
+    valid = bull_amount > 0
+    assert np.allclose(np.array(loop)[valid, 0], resp['bull_kelly'][valid])
+    print('%s rounds: loop %.3fs, vectorised %.3fs' % (n, loop_time, vector_time))
+
+    probabilities = np.linspace(0.5, 0.6, 11)[:, None]
+    start = time.perf_counter()
+    resp = size_rounds(total, bull_amount, bear_amount, probabilities, bankroll=10.0, min_bet=0.001)
+    print('%s win probabilities x %s rounds: %.3fs' % (len(probabilities), n, time.perf_counter() - start))
+
+    odds = np.concatenate([resp['bull_odds'], resp['bear_odds']])
+    odds = odds[odds > 1]
+    for fraction in [0.25, 0.5, 1.0]:
+        start = time.perf_counter()
+        wealth, drawdown = simulate_bankroll(odds, 0.55, true_probability=0.53, bankroll=10.0, n_paths=10 ** 6,
+                                             n_rounds=100, fraction=fraction, cap=0.2, min_bet=0.001)
+        print('fraction %s, 10^6 paths x 100 rounds: %.2fs' % (fraction, time.perf_counter() - start),
+              bankroll_summary(wealth, drawdown, bankroll=10.0))
@@ -0,0 +1,64 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from connect import web3_client
+from connect.stub_node import StubNode, PredictionState
+from connect.transport import Transport
+from connect.web3_client import address_dict, ChainConstants
+from core.pancake_prediction import PancakePrediction
+
+
+def start_once(config, provider, transport, constants_path):
+    """Milliseconds spent building a PancakePrediction, warming it up and running its first tick"""
+    requests = sum(transport.stats.by_tag().values())
+    start = time.perf_counter()
+    pp = PancakePrediction(abi_name='pancake_bnb_prediction.abi', address=address_dict['pancake_bnb_prediction_address'],
+                           config=config, provider=provider, transport=transport, logging=True,
+                           constants=ChainConstants(constants_path))
+    built = time.perf_counter()
+    pp.warm_up()
+    warm = time.perf_counter()
+    pp.on_block()
+    done = time.perf_counter()
+    pp.stop()
+    return {'construct_ms': (built - start) * 1000,
+            'warm_up_ms': (warm - built) * 1000,
+            'first_tick_ms': (done - warm) * 1000,
+            'total_ms': (done - start) * 1000,
+            'rpc_requests': sum(transport.stats.by_tag().values()) - requests}
+
+
+def startup_time(config, delay=0.05):
+    """
+    Cold start cost against a local node answering every request after `delay` seconds
+    first start has no cached chain constants, restart has them on disk but a new process (ABI and contract caches
+    cleared), second market is another instance in the same process on the same transport. The chain constants go
+    to a temporary file, the one the config names is left alone
+    """
+    directory = tempfile.mkdtemp()
+    constants_path = os.path.join(directory, 'constants.json')
+    node = StubNode(delay=delay).start()
+    PredictionState().attach(node).start_round()
+    resp = {}
+    try:
+        transport = None
+        for name in ['first_start', 'restart', 'second_market']:
+            if name != 'second_market':
+                web3_client._load_abi.cache_clear()
+                web3_client._contracts.clear()
+                transport = Transport()
+            resp[name] = start_once(config, node.url, transport, constants_path)
+    finally:
+        node.stop()
+        shutil.rmtree(directory)
+    return resp
+
+
+if __name__ == '__main__':
+    # a config of its own, the call cache and oracle history it names are written to by every start
+    config = sys.argv[1] if len(sys.argv) > 1 else 'pancake_bnb_simulation.ini'
+    for name, resp in startup_time(config).items():
+        print('%-14s %s' % (name, ', '.join('%s: %.1f' % (key, value) for key, value in resp.items())))
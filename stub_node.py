@@ -0,0 +1,781 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rlp
+from eth_abi import decode_abi, encode_abi
+from eth_account import Account
+from eth_account._utils.legacy_transactions import Transaction
+from eth_account._utils.typed_transactions import TypedTransaction
+from eth_utils import event_abi_to_log_topic, function_abi_to_4byte_selector, keccak, to_hex
+from web3._utils.abi import get_abi_input_types, get_abi_output_types
+
+from connect.web3_client import _load_abi, address_dict
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super(RPCError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+def decode_raw_transaction(raw):
+    """Fields of a signed legacy or typed transaction, plus its sender and hash"""
+    if raw[0] >= 0xc0:
+        tx = rlp.decode(raw, Transaction).as_dict()
+    else:
+        tx = dict(TypedTransaction.from_bytes(raw).as_dict())
+    tx['from'] = Account.recover_transaction(raw)
+    tx['hash'] = to_hex(keccak(raw))
+    return tx
+
+
+class StubNode:
+    """
+    Local JSON-RPC node for exercising the clients without mainnet
+    Node methods live in self.methods, contract reads are served by python handlers registered per address
+    delay adds latency to every http request, block_lag makes the node report a stale head
+    Sent transactions are mined confirm_blocks later and revert with probability failure_rate
+    With a fee_market, a transaction is only mined in a block whose clearing gas price it reaches
+    eth_getLogs fails like a public endpoint when a query spans more than max_log_range blocks or log_limit logs
+    """
+    block_time = 3
+
+    def __init__(self, host='127.0.0.1', port=0, chain_id=56, block_number=1, delay=0.0, block_lag=0,
+                 confirm_blocks=1, failure_rate=0.0, seed=0, fee_market=None, max_log_range=None, log_limit=None):
+        self.chain_id = chain_id
+        self.block_number = block_number
+        self.delay = delay
+        self.block_lag = block_lag
+        self.genesis_time = int(time.time()) - block_number * self.block_time
+        self.request_count = 0
+        self.lock = threading.RLock()
+        self.contracts = {}
+        self.filters = {}
+        self.nonces = {}
+        self.transactions = {}
+        self.confirm_blocks = confirm_blocks
+        self.failure_rate = failure_rate
+        self.fee_market = fee_market
+        self.logs = []
+        self.max_log_range = max_log_range
+        self.log_limit = log_limit
+        self.random = random.Random(seed)
+        self.head_listeners = []
+        self._mining = None
+        self._ws_loop = None
+        self.methods = {'eth_chainId': lambda: hex(self.chain_id),
+                        'net_version': lambda: str(self.chain_id),
+                        'eth_blockNumber': lambda: hex(self.head()),
+                        'eth_getBlockByNumber': self.eth_get_block_by_number,
+                        'eth_getBalance': lambda account, block='latest': hex(10 ** 18),
+                        'eth_getTransactionCount': lambda account, block='latest': hex(self.nonces.get(account.lower(), 0)),
+                        'eth_sendRawTransaction': self.eth_send_raw_transaction,
+                        'eth_getTransactionReceipt': self.eth_get_transaction_receipt,
+                        'eth_getTransactionByHash': self.eth_get_transaction_by_hash,
+                        'eth_gasPrice': lambda: hex(self.clearing_price(self.head())),
+                        'eth_feeHistory': self.eth_fee_history,
+                        'eth_call': self.eth_call,
+                        'eth_newBlockFilter': self.eth_new_block_filter,
+                        'eth_getFilterChanges': self.eth_get_filter_changes,
+                        'eth_getLogs': self.eth_get_logs,
+                        'txpool_content': self.txpool_content,
+                        'eth_uninstallFilter': lambda filter_id: self.filters.pop(filter_id, None) is not None}
+        self.register_contract(address_dict['multicall3_address'], _load_abi('multicall.abi'),
+                               aggregate3=self.aggregate3,
+                               getBlockNumber=self.head,
+                               getCurrentBlockTimestamp=lambda: self.block_timestamp(self.head()))
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.stop_mining()
+        if self._ws_loop is not None:
+            self._ws_loop.call_soon_threadsafe(self._ws_loop.stop)
+        self._server.shutdown()
+        self._server.server_close()
+
+    def start_mining(self, interval):
+        """Produce a block every interval seconds on a background thread"""
+        self._mining = threading.Event()
+        stopped = self._mining
+
+        def produce():
+            while not stopped.wait(interval):
+                self.mine()
+
+        threading.Thread(target=produce, daemon=True).start()
+        return self
+
+    def stop_mining(self):
+        if self._mining is not None:
+            self._mining.set()
+            self._mining = None
+
+    def serve_websocket(self, host='127.0.0.1', port=0):
+        """Serve the same methods over a websocket, with eth_subscribe('newHeads') notifications"""
+        import websockets
+
+        ready = threading.Event()
+        address = {}
+
+        async def session(ws, path=None):
+            subscriptions = []
+            loop = asyncio.get_running_loop()
+
+            def notify(number):
+                for subscription in subscriptions:
+                    msg = {'jsonrpc': '2.0', 'method': 'eth_subscription',
+                           'params': {'subscription': subscription, 'result': self.eth_get_block_by_number(hex(number))}}
+                    loop.call_soon_threadsafe(asyncio.ensure_future, ws.send(json.dumps(msg)))
+
+            self.head_listeners.append(notify)
+            try:
+                async for message in ws:
+                    request = json.loads(message)
+                    if request.get('method') == 'eth_subscribe' and request['params'][0] == 'newHeads':
+                        subscriptions.append(hex(len(subscriptions) + 1))
+                        await ws.send(json.dumps({'jsonrpc': '2.0', 'id': request.get('id'), 'result': subscriptions[-1]}))
+                    else:
+                        await ws.send(json.dumps(self.handle(request)))
+            except websockets.ConnectionClosed:
+                pass
+            finally:
+                self.head_listeners.remove(notify)
+
+        def serve():
+            self._ws_loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._ws_loop)
+            server = self._ws_loop.run_until_complete(websockets.serve(session, host, port))
+            address['port'] = server.sockets[0].getsockname()[1]
+            ready.set()
+            self._ws_loop.run_forever()
+
+        threading.Thread(target=serve, daemon=True).start()
+        ready.wait()
+        return 'ws://%s:%s' % (host, address['port'])
+
+    def head(self):
+        return max(self.block_number - self.block_lag, 0)
+
+    def mine(self, blocks=1):
+        with self.lock:
+            self.block_number += blocks
+            number = self.head()
+            for tx in self.transactions.values():
+                if tx['block_number'] is None and tx['sent_block'] + self.confirm_blocks <= self.block_number:
+                    if self.fee_market is not None:
+                        # priced out transactions wait in the pool for a cheaper block
+                        if tx.get('gasPrice', 0) < self.clearing_price(self.block_number):
+                            continue
+                        tx['block_number'] = self.block_number
+                    else:
+                        tx['block_number'] = tx['sent_block'] + self.confirm_blocks
+                    tx['status'] = 0 if self.random.random() < self.failure_rate else self.execute(tx)
+        for listener in list(self.head_listeners):
+            listener(number)
+        return number
+
+    def block_timestamp(self, block_number):
+        return self.genesis_time + block_number * self.block_time
+
+    def clearing_price(self, block_number):
+        """Lowest gas price a block includes, a flat 5 gwei without a fee market"""
+        if self.fee_market is None:
+            return 5 * 10 ** 9
+        return self.fee_market.clearing_price(block_number)
+
+    def emit_log(self, address, topics, data, block_number, tx_hash=None):
+        """Record an event log of a contract, in block order"""
+        self.logs.append({'address': address,
+                          'topics': [to_hex(topic) for topic in topics],
+                          'data': to_hex(data),
+                          'blockNumber': hex(block_number),
+                          'blockHash': to_hex(keccak(text='block-%s' % block_number)),
+                          'transactionHash': tx_hash or '0x' + '00' * 32,
+                          'transactionIndex': hex(0),
+                          'logIndex': hex(len(self.logs)),
+                          'removed': False})
+
+    def register_contract(self, address, abi, **handlers):
+        """
+        Serve the named functions of a contract
+        View handlers take the decoded args and return the outputs, they answer eth_call
+        Other handlers take (tx, *args) and run when a transaction is mined, raising reverts it
+        """
+        functions = self.contracts.setdefault(address.lower(), {})
+        for fn_abi in abi:
+            if fn_abi.get('type') == 'function' and fn_abi['name'] in handlers:
+                functions[function_abi_to_4byte_selector(fn_abi)] = (fn_abi, handlers[fn_abi['name']])
+
+    def execute(self, tx):
+        """Apply a mined transaction to the registered contract state, returns the receipt status"""
+        functions = self.contracts.get(to_hex(tx['to']).lower(), {}) if tx['to'] else {}
+        data = bytes(tx['data'])
+        if bytes(data[:4]) not in functions:
+            return 1
+        fn_abi, handler = functions[bytes(data[:4])]
+        try:
+            handler(tx, *decode_abi(get_abi_input_types(fn_abi), data[4:]))
+        except Exception:
+            return 0
+        return 1
+
+    def call_contract(self, address, data):
+        functions = self.contracts.get(address.lower(), {})
+        if bytes(data[:4]) not in functions:
+            raise RPCError(-32000, 'execution reverted')
+        fn_abi, handler = functions[bytes(data[:4])]
+        args = decode_abi(get_abi_input_types(fn_abi), bytes(data[4:]))
+        resp = handler(*args)
+        output_types = get_abi_output_types(fn_abi)
+        if len(output_types) == 1:
+            resp = [resp]
+        return encode_abi(output_types, resp)
+
+    # JSON-RPC methods
+    def eth_call(self, tx, block='latest'):
+        data = bytes.fromhex((tx.get('data') or tx.get('input', '0x'))[2:])
+        return to_hex(self.call_contract(tx['to'], data))
+
+    def eth_send_raw_transaction(self, raw):
+        tx = decode_raw_transaction(bytes.fromhex(raw[2:]))
+        sender = tx['from'].lower()
+        if tx['hash'] in self.transactions:
+            raise RPCError(-32000, 'already known')
+        replaced = next((pending for pending in self.transactions.values() if pending['block_number'] is None and
+                         pending['from'].lower() == sender and pending['nonce'] == tx['nonce']), None)
+        if replaced is not None:
+            # same nonce replacement, geth wants a 10% higher gas price
+            if tx.get('gasPrice', 0) < replaced.get('gasPrice', 0) * 11 // 10:
+                raise RPCError(-32000, 'replacement transaction underpriced')
+            del self.transactions[replaced['hash']]
+        elif tx['nonce'] < self.nonces.get(sender, 0):
+            raise RPCError(-32000, 'nonce too low')
+        self.nonces[sender] = max(self.nonces.get(sender, 0), tx['nonce'] + 1)
+        tx['block_number'] = None
+        tx['sent_block'] = self.block_number
+        self.transactions[tx['hash']] = tx
+        return tx['hash']
+
+    def eth_get_transaction_receipt(self, tx_hash):
+        tx = self.transactions.get(tx_hash)
+        if tx is None or tx['block_number'] is None or tx['block_number'] > self.head():
+            return None
+        return {'transactionHash': tx_hash,
+                'transactionIndex': hex(0),
+                'blockHash': self.eth_get_block_by_number(hex(tx['block_number']))['hash'],
+                'blockNumber': hex(tx['block_number']),
+                'from': tx['from'],
+                'to': to_hex(tx['to']) if tx['to'] else None,
+                'cumulativeGasUsed': hex(21000),
+                'gasUsed': hex(21000),
+                'effectiveGasPrice': hex(tx.get('gasPrice', 0)),
+                'contractAddress': None,
+                'logs': [],
+                'logsBloom': '0x' + '00' * 256,
+                'status': hex(tx['status'])}
+
+    def eth_get_transaction_by_hash(self, tx_hash):
+        tx = self.transactions.get(tx_hash)
+        if tx is None:
+            return None
+        mined = tx['block_number'] is not None and tx['block_number'] <= self.head()
+        return {'hash': tx_hash,
+                'from': tx['from'],
+                'to': to_hex(tx['to']) if tx['to'] else None,
+                'value': hex(tx['value']),
+                'input': to_hex(bytes(tx['data'])),
+                'nonce': hex(tx['nonce']),
+                'gas': hex(tx['gas']),
+                'gasPrice': hex(tx.get('gasPrice', 0)),
+                'blockNumber': hex(tx['block_number']) if mined else None}
+
+    def eth_fee_history(self, block_count, newest='latest', percentiles=()):
+        """No base fee, the reward at percentile p is the block's clearing price plus p%"""
+        block_count = int(block_count, 16) if isinstance(block_count, str) else block_count
+        newest = self.head() if newest in ('latest', 'pending') else int(newest, 16)
+        oldest = max(newest - block_count + 1, 1)
+        numbers = range(oldest, newest + 1)
+        return {'oldestBlock': hex(oldest),
+                'baseFeePerGas': [hex(0)] * (len(numbers) + 1),
+                'gasUsedRatio': [0.5] * len(numbers),
+                'reward': [[hex(self.clearing_price(number) * (100 + int(p)) // 100) for p in percentiles]
+                           for number in numbers]}
+
+    def txpool_content(self):
+        """Sent transactions not mined yet, grouped by sender and nonce as geth reports them"""
+        pending = {}
+        for tx_hash, tx in self.transactions.items():
+            if tx['block_number'] is not None:
+                continue
+            pending.setdefault(tx['from'], {})[str(tx['nonce'])] = self.eth_get_transaction_by_hash(tx_hash)
+        return {'pending': pending, 'queued': {}}
+
+    def eth_get_logs(self, log_filter):
+        from_block = log_filter.get('fromBlock', 'latest')
+        to_block = log_filter.get('toBlock', 'latest')
+        from_block = self.head() if from_block in ('latest', 'pending') else int(from_block, 16)
+        to_block = self.head() if to_block in ('latest', 'pending') else int(to_block, 16)
+        if self.max_log_range is not None and to_block - from_block + 1 > self.max_log_range:
+            raise RPCError(-32005, 'block range is too wide, limit is %s blocks' % self.max_log_range)
+        addresses = log_filter.get('address')
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        addresses = None if addresses is None else {address.lower() for address in addresses}
+        topics = log_filter.get('topics') or []
+        resp = []
+        for log in self.logs:
+            if not from_block <= int(log['blockNumber'], 16) <= to_block:
+                continue
+            if addresses is not None and log['address'].lower() not in addresses:
+                continue
+            matched = True
+            for position, topic in enumerate(topics):
+                if topic is None:
+                    continue
+                options = topic if isinstance(topic, list) else [topic]
+                if position >= len(log['topics']) or log['topics'][position] not in options:
+                    matched = False
+                    break
+            if matched:
+                resp.append(log)
+        if self.log_limit is not None and len(resp) > self.log_limit:
+            raise RPCError(-32005, 'query returned more than %s results' % self.log_limit)
+        return resp
+
+    def eth_new_block_filter(self):
+        filter_id = hex(len(self.filters) + 1)
+        self.filters[filter_id] = self.head()
+        return filter_id
+
+    def eth_get_filter_changes(self, filter_id):
+        if filter_id not in self.filters:
+            raise RPCError(-32000, 'filter not found')
+        last, self.filters[filter_id] = self.filters[filter_id], self.head()
+        return [self.eth_get_block_by_number(hex(number))['hash'] for number in range(last + 1, self.head() + 1)]
+
+    def eth_get_block_by_number(self, block='latest', full_transactions=False):
+        number = self.head() if block in ('latest', 'pending') else int(block, 16)
+        if number > self.head():
+            return None
+        return {'number': hex(number),
+                'hash': to_hex(keccak(text='block-%s' % number)),
+                'parentHash': to_hex(keccak(text='block-%s' % (number - 1))),
+                'timestamp': hex(self.block_timestamp(number)),
+                'miner': '0x' + '00' * 20,
+                'extraData': '0x',
+                'gasLimit': hex(30000000),
+                'gasUsed': hex(0),
+                'transactions': []}
+
+    # Multicall3
+    def aggregate3(self, calls):
+        resp = []
+        for target, allow_failure, data in calls:
+            try:
+                resp.append((True, self.call_contract(target, data)))
+            except Exception:
+                if not allow_failure:
+                    raise RPCError(-32000, 'Multicall3: call failed')
+                resp.append((False, b''))
+        return resp
+
+    def handle(self, payload):
+        if isinstance(payload, list):
+            return [self._dispatch(request) for request in payload]
+        return self._dispatch(payload)
+
+    def _dispatch(self, request):
+        resp = {'jsonrpc': '2.0', 'id': request.get('id')}
+        method = self.methods.get(request.get('method'))
+        try:
+            if method is None:
+                raise RPCError(-32601, 'the method %s does not exist/is not available' % request.get('method'))
+            with self.lock:
+                resp['result'] = method(*request.get('params', []))
+        except RPCError as e:
+            resp['error'] = {'code': e.code, 'message': e.message}
+        except Exception as e:
+            resp['error'] = {'code': -32000, 'message': str(e)}
+        return resp
+
+    def _handler_class(self):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                node.request_count += 1
+                if node.delay:
+                    time.sleep(node.delay)
+                body = json.dumps(node.handle(payload)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class PredictionState:
+    """Round and oracle state of the prediction and chainlink contracts, served through a StubNode"""
+
+    def __init__(self, interval_blocks=100, answer=300 * 10 ** 8):
+        self.interval_blocks = interval_blocks
+        self.epoch = 0
+        self.rounds = {}
+        self.paused = False
+        self.answer = answer
+        self.oracle_round_id = 1
+        self.oracle_updated_at = int(time.time())
+        self.oracle_rounds = {self.oracle_round_id: (answer, self.oracle_updated_at)}
+        self.ledgers = {}
+        self.user_rounds = {}
+        self.locked = set()
+
+    def attach(self, node, prediction_address=address_dict['pancake_bnb_prediction_address'],
+               chainlink_address=address_dict['chainlink_bnb_usd_address']):
+        self.node = node
+        self.prediction_address = prediction_address
+        self.events = {fn_abi['name']: fn_abi for fn_abi in _load_abi('pancake_bnb_prediction.abi')
+                       if fn_abi.get('type') == 'event'}
+        node.register_contract(prediction_address, _load_abi('pancake_bnb_prediction.abi'),
+                               currentEpoch=lambda: self.epoch,
+                               rounds=self.round,
+                               paused=lambda: self.paused,
+                               intervalBlocks=lambda: self.interval_blocks,
+                               minBetAmount=lambda: 10 ** 15,
+                               ledger=self.ledger,
+                               claimable=self.claimable,
+                               refundable=lambda epoch, user: False,
+                               getUserRounds=self.get_user_rounds,
+                               betBull=lambda tx: self.bet(tx, 0),
+                               betBear=lambda tx: self.bet(tx, 1),
+                               claim=self.claim)
+        node.register_contract(chainlink_address, _load_abi('chainlink_bnb_usd_pricefeed.abi'),
+                               latestRoundData=self.latest_round_data,
+                               getRoundData=self.get_round_data)
+        return self
+
+    def emit(self, name, block_number, *args, tx=None):
+        """Log a prediction contract event, args in the order of the event inputs"""
+        event_abi = self.events[name]
+        topics = [event_abi_to_log_topic(event_abi)]
+        data_types, data_args = [], []
+        for event_input, arg in zip(event_abi['inputs'], args):
+            if event_input['indexed']:
+                topics.append(encode_abi([event_input['type']], [arg]))
+            else:
+                data_types.append(event_input['type'])
+                data_args.append(arg)
+        self.node.emit_log(self.prediction_address, topics, encode_abi(data_types, data_args), block_number,
+                           tx_hash=tx['hash'] if tx else None)
+
+    def start_round(self):
+        """Start the next epoch at the node's current block"""
+        block = self.node.block_number
+        self.epoch += 1
+        self.rounds[self.epoch] = [self.epoch, block, block + self.interval_blocks, block + 2 * self.interval_blocks,
+                                   0, 0, 0, 0, 0, 0, 0, False]
+        self.emit('StartRound', block, self.epoch, block)
+        return self.epoch
+
+    def lock_round(self, epoch, lock_price):
+        self.rounds[epoch][4] = lock_price
+        self.locked.add(epoch)
+        self.emit('LockRound', self.node.block_number, epoch, self.node.block_number, lock_price)
+
+    def round(self, epoch):
+        return self.rounds.get(epoch, [0] * 11 + [False])
+
+    def settle(self, epoch, lock_price, close_price):
+        """Lock and end a round with the given oracle prices, as executeRound would"""
+        if epoch not in self.locked:
+            self.lock_round(epoch, lock_price)
+        resp = self.rounds[epoch]
+        resp[4], resp[5] = lock_price, close_price
+        winning_amount = resp[7] if close_price > lock_price else resp[8] if close_price < lock_price else 0
+        resp[9], resp[10], resp[11] = winning_amount, resp[6] * 97 // 100 if winning_amount else 0, True
+        block = self.node.block_number
+        self.emit('EndRound', block, epoch, block, close_price)
+        self.emit('RewardsCalculated', block, epoch, resp[9], resp[10], resp[6] - resp[10])
+
+    def bet(self, tx, position):
+        resp = self.rounds[self.epoch]
+        if tx['block_number'] >= resp[2] or (self.epoch, tx['from'].lower()) in self.ledgers:
+            raise ValueError('round not bettable')
+        resp[6] += tx['value']
+        resp[7 + position] += tx['value']
+        self.ledgers[(self.epoch, tx['from'].lower())] = [position, tx['value'], False]
+        self.user_rounds.setdefault(tx['from'].lower(), []).append(self.epoch)
+        self.emit('BetBear' if position else 'BetBull', tx['block_number'], tx['from'], self.epoch, tx['value'], tx=tx)
+
+    def ledger(self, epoch, user):
+        return self.ledgers.get((epoch, user.lower()), [0, 0, False])
+
+    def claimable(self, epoch, user):
+        position, amount, claimed = self.ledger(epoch, user)
+        resp = self.round(epoch)
+        won = resp[5] > resp[4] if position == 0 else resp[5] < resp[4]
+        return resp[11] and amount > 0 and not claimed and won
+
+    def claim(self, tx, epoch):
+        if not self.claimable(epoch, tx['from']):
+            raise ValueError('not eligible for claim')
+        position, amount, _ = self.ledgers[(epoch, tx['from'].lower())]
+        self.ledgers[(epoch, tx['from'].lower())][2] = True
+        resp = self.rounds[epoch]
+        self.emit('Claim', tx['block_number'], tx['from'], epoch, amount * resp[10] // resp[9], tx=tx)
+
+    def get_user_rounds(self, user, cursor, size):
+        epochs = self.user_rounds.get(user.lower(), [])[cursor:cursor + size]
+        return [epochs, cursor + len(epochs)]
+
+    def update_answer(self, answer, updated_at=None):
+        self.answer = answer
+        self.oracle_round_id += 1
+        self.oracle_updated_at = int(updated_at or time.time())
+        self.oracle_rounds[self.oracle_round_id] = (answer, self.oracle_updated_at)
+
+    def latest_round_data(self):
+        return [self.oracle_round_id, self.answer, self.oracle_updated_at, self.oracle_updated_at,
+                self.oracle_round_id]
+
+    def get_round_data(self, round_id):
+        if round_id not in self.oracle_rounds:
+            raise ValueError('No data present')
+        answer, updated_at = self.oracle_rounds[round_id]
+        return [round_id, answer, updated_at, updated_at, round_id]
+
+
+class FeeMarket:
+    """
+    Clearing gas price of every block on a congestion prone chain, for StubNode(fee_market=...)
+    A calm / congested Markov chain: congestion starts with probability congestion_rate per block, ends with
+    recovery_rate, and multiplies the base price by `congested`. Prices are drawn lazily in block order from seed
+    """
+
+    def __init__(self, base=5 * 10 ** 9, congested=4.0, congestion_rate=0.05, recovery_rate=0.2, noise=0.3, seed=0):
+        self.base = base
+        self.congested = congested
+        self.congestion_rate = congestion_rate
+        self.recovery_rate = recovery_rate
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.is_congested = False
+        self.prices = {}
+        self.last_block = 0
+
+    def clearing_price(self, block_number):
+        while self.last_block < block_number:
+            self.last_block += 1
+            if self.is_congested:
+                self.is_congested = self.random.random() >= self.recovery_rate
+            else:
+                self.is_congested = self.random.random() < self.congestion_rate
+            multiplier = self.congested if self.is_congested else 1.0
+            self.prices[self.last_block] = int(self.base * multiplier * max(self.random.lognormvariate(0, self.noise), 1))
+        return self.prices.get(block_number, self.base)
+
+
+def synthetic_stream(n, price=300.0, levels=20, tick=0.01, seed=0, symbol='BNBUSDT'):
+    """
+    A depth snapshot and n combined stream messages (trades and depth updates) of a random walk market
+    Update ids follow the Binance rules so a book built from the snapshot and updates stays consistent
+    """
+    rng = random.Random(seed)
+    stream = symbol.lower()
+    update_id = 1000
+    snapshot = {'lastUpdateId': update_id,
+                'bids': [['%.2f' % (price - tick * (i + 1)), '%.3f' % rng.uniform(1, 50)] for i in range(levels)],
+                'asks': [['%.2f' % (price + tick * (i + 1)), '%.3f' % rng.uniform(1, 50)] for i in range(levels)]}
+    messages = []
+    trade_id = 0
+    event_time = int(time.time() * 1000)
+    for i in range(n):
+        event_time += rng.randint(10, 100)
+        if rng.random() < 0.5:
+            price = max(tick, price + rng.choice([-tick, tick]))
+            trade_id += 1
+            messages.append({'stream': '%s@trade' % stream,
+                             'data': {'e': 'trade', 'E': event_time, 's': symbol, 't': trade_id, 'p': '%.2f' % price,
+                                      'q': '%.3f' % rng.uniform(0.1, 5), 'T': event_time}})
+        else:
+            first = update_id + 1
+            update_id += rng.randint(1, 3)
+            bids = [['%.2f' % (price - tick * rng.randint(1, levels)), '%.3f' % rng.choice([0, rng.uniform(1, 50)])]]
+            asks = [['%.2f' % (price + tick * rng.randint(1, levels)), '%.3f' % rng.choice([0, rng.uniform(1, 50)])]]
+            messages.append({'stream': '%s@depth@100ms' % stream,
+                             'data': {'e': 'depthUpdate', 'E': event_time, 's': symbol, 'U': first, 'u': update_id,
+                                      'b': bids, 'a': asks}})
+    return snapshot, messages
+
+
+class BinanceReplay:
+    """
+    Local Binance stand-in replaying recorded stream messages over a websocket
+    Serves /api/v3/depth from a book kept in step with the replay and /api/v3/ticker/price from the last trade
+    Replay starts with the first websocket client, interval seconds between messages (0 as fast as possible)
+    Messages at the indices in drop are applied to the book but never sent, to simulate stream gaps
+    """
+
+    def __init__(self, snapshot, messages, host='127.0.0.1', port=0, ws_port=0, interval=0.0, drop=()):
+        self.messages = messages
+        self.interval = interval
+        self.drop = set(drop)
+        self.bids = {price: qty for price, qty in snapshot['bids']}
+        self.asks = {price: qty for price, qty in snapshot['asks']}
+        self.last_update_id = snapshot['lastUpdateId']
+        self.price = None
+        self.position = 0
+        self.depth_requests = 0
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.host = host
+        self.ws_port = ws_port
+        self._started = False
+        self._loop = None
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+
+    @property
+    def rest_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        import websockets
+
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        ready = threading.Event()
+
+        async def session(ws, path=None):
+            self.clients.add(ws)
+            if not self._started:
+                self._started = True
+                asyncio.ensure_future(self.replay())
+            try:
+                await ws.wait_closed()
+            finally:
+                self.clients.discard(ws)
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            server = self._loop.run_until_complete(websockets.serve(session, self.host, self.ws_port))
+            self.ws_port = server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=serve, daemon=True).start()
+        ready.wait()
+        return self
+
+    @property
+    def ws_url(self):
+        return 'ws://%s:%s' % (self.host, self.ws_port)
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._server.shutdown()
+        self._server.server_close()
+
+    def kick(self):
+        """Close every client connection, as a server side disconnect"""
+        for ws in list(self.clients):
+            asyncio.run_coroutine_threadsafe(ws.close(), self._loop)
+
+    async def replay(self):
+        for i, msg in enumerate(self.messages):
+            self.apply(msg['data'])
+            if i not in self.drop:
+                await self.broadcast(json.dumps(msg))
+            self.position = i + 1
+            await asyncio.sleep(self.interval)
+        self.done.set()
+
+    async def broadcast(self, body):
+        for ws in list(self.clients):
+            try:
+                await ws.send(body)
+            except Exception:
+                self.clients.discard(ws)
+
+    def publish(self, msg):
+        """Apply and send one combined stream message now, for drivers that produce the market as they go"""
+        self.apply(msg['data'])
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self.broadcast(json.dumps(msg)), self._loop)
+
+    def apply(self, data):
+        with self.lock:
+            if data['e'] == 'trade':
+                self.price = data['p']
+            elif data['e'] == 'depthUpdate':
+                for book, levels in [(self.bids, data['b']), (self.asks, data['a'])]:
+                    for price, qty in levels:
+                        if float(qty) == 0:
+                            book.pop(price, None)
+                        else:
+                            book[price] = qty
+                self.last_update_id = data['u']
+
+    def depth(self, limit=1000):
+        with self.lock:
+            return {'lastUpdateId': self.last_update_id,
+                    'bids': [[price, self.bids[price]] for price in sorted(self.bids, key=float, reverse=True)][:limit],
+                    'asks': [[price, self.asks[price]] for price in sorted(self.asks, key=float)][:limit]}
+
+    def _handler_class(self):
+        replay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                params = dict(item.split('=', 1) for item in query.split('&') if '=' in item)
+                if path == '/api/v3/depth':
+                    replay.depth_requests += 1
+                    body = replay.depth(int(params.get('limit', 1000)))
+                elif path == '/api/v3/ticker/price':
+                    body = {'symbol': params.get('symbol'), 'price': replay.price}
+                else:
+                    self.send_error(404)
+                    return
+                body = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,162 @@
+import signal
+import threading
+import time
+
+import pandas as pd
+
+from utils import logger
+
+CRITICAL, BACKGROUND = 0, 1
+
+
+class Task:
+    """
+    A worker of the runtime: target is called every `interval` seconds, or once and expected to run until `stop` is
+    called when interval is None. A raise, or a long running target returning, is a crash and the task is restarted
+    after an exponential backoff
+    """
+
+    def __init__(self, name, target, interval=None, priority=BACKGROUND, stop=None, backoff=1.0, max_backoff=300):
+        self.name = name
+        self.target = target
+        self.interval = interval
+        self.priority = priority
+        self.stop = stop
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.event = threading.Event()
+        self.next_run = 0.0
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.last_run = None
+
+    def wake(self):
+        """Run now instead of at the next cadence"""
+        self.next_run = 0.0
+        self.event.set()
+
+    def run_once(self, stopped):
+        """Call target once, returns the error when it crashed and schedules the next run"""
+        self.last_run = time.time()
+        try:
+            self.target()
+            if self.interval is None and not stopped.is_set():
+                raise RuntimeError('long running task returned')
+        except Exception as e:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = repr(e)
+            self.next_run = time.time() + min(self.backoff * 2 ** (self.consecutive_failures - 1), self.max_backoff)
+            return e
+        self.runs += 1
+        self.consecutive_failures = 0
+        self.next_run = time.time() + (self.interval or 0)
+        return None
+
+
+class TaskRuntime:
+    """
+    Supervises the bot's workers on threads
+    CRITICAL tasks get a thread each. BACKGROUND tasks (reporting, claims) share one thread, run one at a time in due
+    order and are held back by defer_background() while a bet is being decided, so they never compete with the betting
+    loop for the GIL, the RPC pool or the nonce
+    """
+
+    def __init__(self, on_failure=None):
+        self.on_failure = on_failure
+        self.tasks = []
+        self.threads = []
+        self.deferred_until = 0.0
+        self._stopped = threading.Event()
+        self._background = threading.Event()
+
+    def add(self, name, target, interval=None, priority=BACKGROUND, stop=None, backoff=1.0, max_backoff=300):
+        if priority == BACKGROUND and interval is None:
+            raise ValueError('background task %s needs an interval' % name)
+        task = Task(name, target, interval=interval, priority=priority, stop=stop, backoff=backoff,
+                    max_backoff=max_backoff)
+        if priority == BACKGROUND:
+            task.event = self._background
+        self.tasks.append(task)
+        return task
+
+    def defer_background(self, seconds):
+        """Hold background tasks back for the next `seconds`"""
+        self.deferred_until = max(self.deferred_until, time.time() + seconds)
+
+    def start(self):
+        for task in self.tasks:
+            if task.priority == CRITICAL:
+                self.threads.append(threading.Thread(target=self._run_critical, args=(task,), name=task.name,
+                                                     daemon=True))
+        if any(task.priority == BACKGROUND for task in self.tasks):
+            self.threads.append(threading.Thread(target=self._run_background, name='background', daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def _execute(self, task):
+        error = task.run_once(self._stopped)
+        if error is not None and not self._stopped.is_set():
+            logger.Logger.log_message('task %s crashed (%s in a row), restart in %.1fs: %s' % (
+                task.name, str(task.consecutive_failures), task.next_run - time.time(), repr(error)))
+            if self.on_failure is not None:
+                try:
+                    self.on_failure(task, error)
+                except Exception:
+                    pass
+
+    def _run_critical(self, task):
+        while not self._stopped.is_set():
+            self._execute(task)
+            task.event.wait(max(task.next_run - time.time(), 0))
+            task.event.clear()
+
+    def _run_background(self):
+        tasks = [task for task in self.tasks if task.priority == BACKGROUND]
+        while not self._stopped.is_set():
+            now = time.time()
+            task = min(tasks, key=lambda item: item.next_run)
+            wait = max(task.next_run, self.deferred_until) - now
+            if wait > 0:
+                self._background.wait(wait)
+                self._background.clear()
+                continue
+            self._execute(task)
+
+    def stop(self, timeout=10):
+        """Ask every task to stop and wait up to timeout seconds for their threads"""
+        self._stopped.set()
+        for task in self.tasks:
+            if task.stop is not None:
+                try:
+                    task.stop()
+                except Exception as e:
+                    logger.Logger.log_message('task %s stop error: %s' % (task.name, str(e)))
+            task.event.set()
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            thread.join(max(deadline - time.time(), 0))
+        return [thread.name for thread in self.threads if thread.is_alive()]
+
+    def run_forever(self):
+        """Start and block until SIGINT or SIGTERM, then shut down"""
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(signum, lambda *args: self._stopped.set())
+        self.start()
+        while not self._stopped.is_set():
+            self._stopped.wait(1)
+        alive = self.stop()
+        if alive:
+            logger.Logger.log_message('tasks still running at shutdown: %s' % ', '.join(alive))
+
+    def status(self):
+        return pd.DataFrame([{'task': task.name,
+                              'priority': 'critical' if task.priority == CRITICAL else 'background',
+                              'interval': task.interval,
+                              'runs': task.runs,
+                              'failures': task.failures,
+                              'last_error': task.last_error,
+                              'last_run': task.last_run} for task in self.tasks])
@@ -0,0 +1,50 @@
+import types
+
+import numpy as np
+import pytest
+
+from core.backtester import evaluate, param_grid
+from core.pancake_prediction import PancakePrediction
+
+WIN_PROBABILITY = 0.55
+
+
+def live_stake(direction, resp, fraction, cap):
+    # PancakePrediction.live_size on a bankroll of 1, without bet size limits or pre-signed sizes
+    pp = types.SimpleNamespace(kelly_fraction=fraction, kelly_cap=cap, win_probability=WIN_PROBABILITY, balance=1.0,
+                               min_bet_size=0.0, max_bet_size=np.inf, presigned=types.SimpleNamespace(sizes=[]))
+    return PancakePrediction.live_size(pp, direction, resp)
+
+
+def lost_round(direction, total, side_amount):
+    # a round bet on `direction` that lost, so its PnL without gas is minus the stake
+    bull = direction == 'bull'
+    return {'epoch': np.array([1]),
+            'max_premium': np.array([0.01 if bull else 0.0]),
+            'min_premium': np.array([0.0 if bull else -0.01]),
+            'total_amount': np.array([total]),
+            'bull_amount': np.array([side_amount if bull else total - side_amount]),
+            'bear_amount': np.array([total - side_amount if bull else side_amount]),
+            'bull_won': np.array([not bull])}
+
+
+@pytest.mark.parametrize('direction', ['bull', 'bear'])
+@pytest.mark.parametrize('total, side_amount', [(10.0, 4.0), (10.0, 2.5), (30.0, 6.0), (18.5, 10.0)])
+@pytest.mark.parametrize('fraction, cap', [(0.5, 1.0), (1.0, 0.1), (0.25, 0.3)])
+def test_backtest_stake_is_the_live_stake(direction, total, side_amount, fraction, cap):
+    rounds = lost_round(direction, total, side_amount)
+    result = evaluate(rounds, param_grid(bet_threshold=(0.005,), kelly_fraction=(fraction,), kelly_cap=(cap,)),
+                      win_probability=WIN_PROBABILITY, gas_fee=0.0)
+    resp = {'total_amount': total, 'bull_amount': rounds['bull_amount'][0], 'bear_amount': rounds['bear_amount'][0]}
+    stake = live_stake(direction, resp, fraction, cap)
+    assert -result['pnl'][0] == pytest.approx(stake)
+    assert result['bets'][0] == (stake > 0)
+
+
+def test_odds_the_live_bot_rejects_are_not_bet():
+    # positive kelly before the fee, negative after it
+    rounds = lost_round('bull', 1.85, 1.0)
+    result = evaluate(rounds, param_grid(kelly_fraction=(1.0,)), win_probability=WIN_PROBABILITY, gas_fee=0.0)
+    assert live_stake('bull', {'total_amount': 1.85, 'bull_amount': 1.0, 'bear_amount': 0.85}, 1.0, 1.0) == 0
+    assert result['bets'][0] == 0
+    assert result['pnl'][0] == 0
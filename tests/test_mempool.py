@@ -0,0 +1,95 @@
+import pytest
+from eth_account import Account
+
+from connect.mempool import MempoolWatcher
+from connect.stub_node import StubNode, PredictionState
+from connect.transport import Transport
+from connect.web3_client import load_contract, address_dict
+
+GWEI = 10 ** 9
+BNB = 10 ** 18
+
+
+@pytest.fixture
+def chain():
+    # transactions stay in the pool for a block after the one they are sent in
+    node = StubNode(confirm_blocks=2).start()
+    state = PredictionState(interval_blocks=20).attach(node)
+    state.start_round()
+    w3 = Transport().web3(node.url)
+    prediction = load_contract(w3, 'pancake_bnb_prediction.abi', address_dict['pancake_bnb_prediction_address'])
+    yield node, state, w3, prediction
+    node.stop()
+
+
+def send(w3, account, to, value=0, data='0x', nonce=0, gas_price=5 * GWEI):
+    signed = account.sign_transaction({'to': to, 'value': value, 'data': data, 'gas': 200000, 'gasPrice': gas_price,
+                                       'nonce': nonce, 'chainId': 56})
+    return w3.eth.send_raw_transaction(signed.rawTransaction).hex()
+
+
+def bet(w3, prediction, account, fn_name, value, **kwargs):
+    return send(w3, account, prediction.address, value, prediction.encodeABI(fn_name=fn_name), **kwargs)
+
+
+def test_pending_bets_are_projected(chain):
+    node, state, w3, prediction = chain
+    watcher = MempoolWatcher(w3, prediction)
+    bet(w3, prediction, Account.create(), 'betBull', BNB // 2)
+    bet(w3, prediction, Account.create(), 'betBear', BNB // 5)
+    # a transfer and a call that is not a bet are not projected
+    send(w3, Account.create(), '0x' + '11' * 20, BNB)
+    send(w3, Account.create(), prediction.address, data=prediction.encodeABI(fn_name='claim', args=[1]))
+    assert watcher.poll() == 2
+    assert watcher.pending_amounts() == (BNB // 2, BNB // 5)
+    # known bets are not decoded or counted again
+    assert watcher.poll() == 0
+    assert watcher.pending_amounts() == (BNB // 2, BNB // 5)
+    resp = watcher.project({'bull_amount': 1.0, 'bear_amount': 2.0, 'total_amount': 3.0})
+    assert resp == pytest.approx({'bull_amount': 1.5, 'bear_amount': 2.2, 'total_amount': 3.7})
+
+
+def test_mined_bets_leave_the_projection(chain):
+    node, state, w3, prediction = chain
+    watcher = MempoolWatcher(w3, prediction)
+    bet(w3, prediction, Account.create(), 'betBull', BNB)
+    watcher.poll()
+    node.mine()
+    late = bet(w3, prediction, Account.create(), 'betBear', BNB)
+    assert watcher.poll() == 1
+    assert watcher.pending_amounts() == (BNB, BNB)
+    node.mine()
+    assert watcher.poll() == 0
+    assert watcher.pending_amounts() == (0, BNB)
+    assert list(watcher.pending) == [late]
+    node.mine()
+    watcher.poll()
+    assert watcher.pending_amounts() == (0, 0)
+    assert not watcher.pending
+    resp = {'bull_amount': 1.0, 'bear_amount': 2.0, 'total_amount': 3.0}
+    assert watcher.project(resp) is resp
+
+
+def test_replaced_bet_is_dropped(chain):
+    node, state, w3, prediction = chain
+    watcher = MempoolWatcher(w3, prediction)
+    account = Account.create()
+    bet(w3, prediction, account, 'betBull', BNB)
+    watcher.poll()
+    # same nonce, the bull bet is cancelled for a bear one
+    replacement = bet(w3, prediction, account, 'betBear', BNB // 2, gas_price=10 * GWEI)
+    assert watcher.poll() == 1
+    assert watcher.pending_amounts() == (0, BNB // 2)
+    assert list(watcher.pending) == [replacement]
+    assert watcher.pending[replacement].sender.lower() == account.address.lower()
+
+
+def test_restart_keeps_one_poller(chain):
+    node, state, w3, prediction = chain
+    watcher = MempoolWatcher(w3, prediction, poll_interval=0.01).start()
+    thread = watcher._thread
+    assert watcher.start()._thread is thread
+    watcher.stop()
+    assert not thread.is_alive()
+    assert watcher.start()._thread is not thread
+    watcher.stop()
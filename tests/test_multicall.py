@@ -0,0 +1,67 @@
+import pytest
+from web3 import Web3
+
+from connect.multicall import Multicall
+from connect.stub_node import StubNode, PredictionState
+from connect.transport import Transport
+from connect.web3_client import load_contract, address_dict
+
+
+@pytest.fixture
+def chain():
+    node = StubNode().start()
+    state = PredictionState(interval_blocks=20).attach(node)
+    node.mine(5)
+    state.start_round()
+    w3 = Transport().web3(node.url)
+    prediction = load_contract(w3, 'pancake_bnb_prediction.abi', address_dict['pancake_bnb_prediction_address'])
+    chainlink = load_contract(w3, 'chainlink_bnb_usd_pricefeed.abi', address_dict['chainlink_bnb_usd_address'])
+    yield node, state, w3, prediction, chainlink
+    node.stop()
+
+
+def snapshot_calls(prediction, chainlink, epoch):
+    # the calls of PancakePrediction.snapshot
+    return [prediction.functions.currentEpoch(),
+            prediction.functions.paused(),
+            chainlink.functions.latestRoundData(),
+            prediction.functions.rounds(epoch),
+            prediction.functions.rounds(epoch + 1)]
+
+
+def test_snapshot_is_one_eth_call(chain):
+    node, state, w3, prediction, chainlink = chain
+    multicall = Multicall(w3)
+    # the first call also fetches the chain id, cached afterwards
+    multicall.aggregate(snapshot_calls(prediction, chainlink, 1))
+    requests = node.request_count
+    block_number, resp = multicall.aggregate(snapshot_calls(prediction, chainlink, 1))
+    assert node.request_count - requests == 1
+    assert block_number == node.head()
+    epoch, paused, latest_round, current_round, next_round = resp
+    assert epoch == state.epoch == 1
+    assert paused is False
+    assert latest_round[1] == state.answer
+    assert current_round[0] == 1
+    assert current_round[2] == state.rounds[1][2]
+    assert next_round[0] == 0
+
+
+def test_snapshot_follows_the_chain(chain):
+    node, state, w3, prediction, chainlink = chain
+    multicall = Multicall(w3)
+    node.mine(3)
+    state.start_round()
+    state.update_answer(310 * 10 ** 8)
+    block_number, resp = multicall.aggregate(snapshot_calls(prediction, chainlink, 1))
+    assert block_number == node.head()
+    assert resp[0] == 2
+    assert resp[2][1] == 310 * 10 ** 8
+    assert resp[4][0] == 2
+
+
+def test_failed_call_is_none(chain):
+    node, state, w3, prediction, chainlink = chain
+    missing = load_contract(w3, 'pancake_bnb_prediction.abi', Web3.toChecksumAddress('0x' + '22' * 20))
+    _, resp = Multicall(w3).aggregate([prediction.functions.currentEpoch(), missing.functions.currentEpoch()])
+    assert resp == [1, None]
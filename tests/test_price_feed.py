@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+from core.price_feed import PriceFeed
+from connect.stub_node import BinanceReplay, synthetic_stream
+
+
+def first_index(messages, event, start=0):
+    return next(i for i, msg in enumerate(messages) if i >= start and msg['data']['e'] == event)
+
+
+def book(levels):
+    return {float(price): float(qty) for price, qty in levels}
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def stream():
+    return synthetic_stream(400)
+
+
+def replay_into_feed(snapshot, messages, drop=()):
+    replay = BinanceReplay(snapshot, messages, interval=0.002, drop=drop).start()
+    feed = PriceFeed(ws_url=replay.ws_url, rest_url=replay.rest_url, reconnect_delay=0.05).start()
+
+    def synced():
+        return replay.done.is_set() and feed.last_update_id == replay.last_update_id
+
+    assert wait_for(synced)
+    return replay, feed
+
+
+def test_book_follows_the_stream(stream):
+    replay, feed = replay_into_feed(*stream)
+    try:
+        assert wait_for(lambda: feed.price() == float(replay.price))
+        assert feed.gaps == 0
+        depth = replay.depth()
+        assert feed.bids == book(depth['bids'])
+        assert feed.asks == book(depth['asks'])
+    finally:
+        feed.stop()
+        replay.stop()
+
+
+def test_depth_gap_resyncs_the_book(stream):
+    snapshot, messages = stream
+    dropped = first_index(messages, 'depthUpdate', start=len(messages) // 2)
+    replay, feed = replay_into_feed(snapshot, messages, drop=[dropped])
+    try:
+        assert feed.gaps == 1
+        # the initial snapshot and the one after the gap
+        assert feed.resyncs == replay.depth_requests == 2
+        depth = replay.depth()
+        assert feed.bids == book(depth['bids'])
+        assert feed.asks == book(depth['asks'])
+        assert feed.top[0] == max(feed.bids) and feed.top[2] == min(feed.asks)
+    finally:
+        feed.stop()
+        replay.stop()
+
+
+def test_trade_gap_is_counted_without_resync(stream):
+    snapshot, messages = stream
+    dropped = first_index(messages, 'trade', start=len(messages) // 2)
+    replay, feed = replay_into_feed(snapshot, messages, drop=[dropped])
+    try:
+        assert feed.trade_gaps == 1
+        assert feed.gaps == 0
+        assert feed.resyncs == 1
+    finally:
+        feed.stop()
+        replay.stop()
+
+
+def test_price_freshness_follows_trades_only(stream):
+    snapshot, messages = stream
+    feed = PriceFeed()
+    feed.apply_snapshot(snapshot)
+    assert feed.book_fresh()
+    assert not feed.fresh()
+    feed.on_trade(messages[first_index(messages, 'trade')]['data'])
+    assert feed.fresh()
+    feed.updated_at -= 10
+    feed.on_depth(messages[first_index(messages, 'depthUpdate')]['data'])
+    # a live book does not keep an old trade fresh
+    assert feed.book_fresh()
+    assert not feed.fresh()
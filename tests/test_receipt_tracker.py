@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+from eth_account import Account
+
+from connect.receipt_tracker import ReceiptTracker
+from connect.stub_node import StubNode
+from connect.transport import Transport
+
+
+@pytest.fixture
+def node():
+    node = StubNode().start()
+    yield node
+    node.stop()
+
+
+@pytest.fixture
+def w3(node):
+    return Transport().web3(node.url)
+
+
+def send(w3, account, nonce=0, gas_price=5 * 10 ** 9):
+    signed = account.sign_transaction({'to': '0x' + '11' * 20, 'value': 0, 'gas': 21000, 'gasPrice': gas_price,
+                                       'nonce': nonce, 'chainId': 56})
+    return w3.eth.send_raw_transaction(signed.rawTransaction).hex()
+
+
+def test_receipt_resolves_the_future(node, w3):
+    tracker = ReceiptTracker(w3, poll_interval=0.05)
+    tx_hash = send(w3, Account.create())
+    called = threading.Event()
+    future = tracker.track(tx_hash, callback=lambda future: called.set())
+    node.mine()
+    receipt = future.result(timeout=2)
+    assert receipt['status'] == 1
+    assert receipt['blockNumber'] == node.head()
+    assert called.wait(1)
+    assert not tracker.pending
+    tracker.stop()
+
+
+def test_missing_receipt_times_out(w3):
+    tracker = ReceiptTracker(w3, poll_interval=0.05, timeout=0.2)
+    future = tracker.track('0x' + 'ab' * 32)
+    assert isinstance(future.exception(timeout=2), TimeoutError)
+    tracker.stop()
+
+
+def test_replacement_resolves_the_same_future(node, w3):
+    tracker = ReceiptTracker(w3, poll_interval=0.05, timeout=0.5)
+    account = Account.create()
+    stuck = send(w3, account)
+    future = tracker.track(stuck)
+    replacement = send(w3, account, gas_price=10 * 10 ** 9)
+    assert tracker.replace(stuck, replacement) is future
+    node.mine()
+    assert future.result(timeout=2)['transactionHash'].hex() == replacement
+    assert not tracker.pending
+    tracker.stop()
+
+
+def test_concurrent_tracks_start_one_poller(w3):
+    tracker = ReceiptTracker(w3, poll_interval=0.05)
+    barrier = threading.Barrier(8)
+
+    def track(i):
+        barrier.wait()
+        tracker.track('0x%064x' % i)
+
+    threads = [threading.Thread(target=track, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len([thread for thread in threading.enumerate() if thread.name == 'receipt-tracker']) == 1
+    tracker.stop()
+
+
+def test_stopped_tracker_restarts(node, w3):
+    tracker = ReceiptTracker(w3, poll_interval=0.05)
+    tracker.track('0x' + 'cd' * 32)
+    tracker.stop()
+    future = tracker.track(send(w3, Account.create()))
+    node.mine()
+    assert future.result(timeout=2)['status'] == 1
+    tracker.stop()
@@ -0,0 +1,140 @@
+import os
+import types
+
+import numpy as np
+import pytest
+from eth_account import Account
+
+from connect.simulator import Simulator, synthetic_history
+from connect.transport import Transport
+from connect.web3_client import load_contract, address_dict
+from core.round_indexer import RoundIndexer, RateLimited, TABLES
+
+
+@pytest.fixture(scope='module')
+def market():
+    # thirty simulated rounds, with a bet from a new address every fourth block
+    sim = Simulator(synthetic_history(30), interval_blocks=20).start()
+    w3 = Transport().web3(sim.node.url)
+    prediction = load_contract(w3, 'pancake_bnb_prediction.abi', address_dict['pancake_bnb_prediction_address'])
+
+    def bet(number):
+        if number % 4 == 0:
+            signed = Account.create().sign_transaction({
+                'to': prediction.address, 'value': 10 ** 16, 'gas': 200000, 'gasPrice': 5 * 10 ** 9, 'nonce': 0,
+                'data': prediction.encodeABI(fn_name='betBull' if number % 8 else 'betBear'), 'chainId': 56})
+            w3.eth.send_raw_transaction(signed.rawTransaction)
+
+    sim.run(handler=bet)
+    yield sim, w3, prediction
+    sim.stop()
+
+
+@pytest.fixture(scope='module')
+def reference(market, tmp_path_factory):
+    # the whole history in one query, before any limit is set
+    sim, w3, prediction = market
+    indexer = RoundIndexer(str(tmp_path_factory.mktemp('reference')), w3, prediction, start_block=1, confirmations=0,
+                           max_range=10 ** 6)
+    indexer.sync(end_block=sim.node.head())
+    return indexer
+
+
+@pytest.fixture
+def limited(market):
+    # a node that refuses wide queries like a public endpoint
+    sim = market[0]
+    sim.node.max_log_range = 50
+    sim.node.log_limit = 40
+    yield sim.node
+    sim.node.max_log_range = None
+    sim.node.log_limit = None
+
+
+class FlakyProvider:
+    """Answers eth_getLogs with the given errors first"""
+
+    def __init__(self, provider, errors):
+        self.provider = provider
+        self.errors = list(errors)
+        self.calls = 0
+
+    def make_request(self, method, params):
+        if method == 'eth_getLogs':
+            self.calls += 1
+            if self.errors:
+                return {'jsonrpc': '2.0', 'id': 1, 'error': self.errors.pop(0)}
+        return self.provider.make_request(method, params)
+
+
+def flaky(w3, errors):
+    return types.SimpleNamespace(provider=FlakyProvider(w3.provider, errors), eth=w3.eth)
+
+
+def assert_same_tables(indexer, reference):
+    for table in TABLES:
+        assert np.array_equal(np.asarray(indexer.table(table)), np.asarray(reference.table(table)))
+
+
+def test_refused_ranges_are_split(market, reference, limited, tmp_path):
+    sim, w3, prediction = market
+    indexer = RoundIndexer(str(tmp_path / 'limited'), w3, prediction, start_block=1, confirmations=0)
+    before = limited.request_count
+    logs = indexer.sync(end_block=limited.head())
+    assert limited.request_count - before > limited.head() // limited.max_log_range
+    assert indexer.range < indexer.max_range
+    assert logs == sum(reference.checkpoint['counts'].values())
+    assert_same_tables(indexer, reference)
+
+    rounds = indexer.frame().set_index('epoch')
+    ended = rounds[rounds['oracle_called']]
+    assert len(ended) == sim.rounds_settled
+    for epoch, resp in ended.iterrows():
+        assert resp['lock_price'] == sim.state.rounds[epoch][4] / 10 ** 8
+        assert resp['close_price'] == sim.state.rounds[epoch][5] / 10 ** 8
+    assert set(indexer.bets()['sender']) == {sender for _, sender in sim.state.ledgers}
+
+
+def test_sync_resumes_from_the_checkpoint(market, reference, limited, tmp_path):
+    sim, w3, prediction = market
+    path = str(tmp_path / 'resumed')
+    indexer = RoundIndexer(path, w3, prediction, start_block=1, confirmations=0)
+    indexer.sync(end_block=limited.head() // 2)
+    checkpoint = indexer.checkpoint
+    assert checkpoint['block'] == limited.head() // 2
+    # half a record written by a batch interrupted before its checkpoint
+    with open(indexer.table_path('rounds'), 'ab') as f:
+        f.write(b'\0' * (TABLES['rounds'].itemsize // 2))
+
+    indexer = RoundIndexer(path, w3, prediction, start_block=1, confirmations=0)
+    assert indexer.checkpoint['block'] == checkpoint['block']
+    assert os.path.getsize(indexer.table_path('rounds')) == checkpoint['counts']['rounds'] * TABLES['rounds'].itemsize
+    logs = indexer.sync(end_block=limited.head())
+    assert logs == sum(reference.checkpoint['counts'].values()) - sum(checkpoint['counts'].values())
+    assert_same_tables(indexer, reference)
+
+
+def test_rate_limits_are_retried_not_split(market, reference, tmp_path):
+    sim, w3, prediction = market
+    errors = [{'code': 429, 'message': 'Too Many Requests'},
+              {'code': -32005, 'message': 'daily request count exceeded, request rate limited'}]
+    indexer = RoundIndexer(str(tmp_path / 'flaky'), flaky(w3, errors), prediction, start_block=1, confirmations=0,
+                           backoff=0.001)
+    assert indexer.fetch(1, sim.node.head()) == reference.get_logs(1, sim.node.head())
+    assert indexer.w3.provider.calls == 3
+    assert indexer.range == indexer.max_range
+
+
+def test_unknown_errors_are_raised(market, tmp_path):
+    sim, w3, prediction = market
+    indexer = RoundIndexer(str(tmp_path / 'flaky'), flaky(w3, [{'code': -32000, 'message': 'gas limit exceeded'}]),
+                           prediction, start_block=1, confirmations=0)
+    with pytest.raises(ValueError):
+        indexer.fetch(1, sim.node.head())
+    assert indexer.w3.provider.calls == 1
+
+    errors = [{'code': -32029, 'message': 'rate limited'}] * 2
+    indexer = RoundIndexer(str(tmp_path / 'flaky'), flaky(w3, errors), prediction, start_block=1, confirmations=0,
+                           retries=1, backoff=0.001)
+    with pytest.raises(RateLimited):
+        indexer.fetch(1, sim.node.head())
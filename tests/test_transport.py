@@ -0,0 +1,72 @@
+import time
+
+import pytest
+from eth_account import Account
+
+from connect.stub_node import StubNode
+from connect.transport import Transport
+
+
+@pytest.fixture
+def nodes():
+    # a fast node with a stale head, a slow node and a healthy one
+    nodes = {'lagging': StubNode(block_lag=5).start(),
+             'slow': StubNode(delay=0.2).start(),
+             'healthy': StubNode(delay=0.01).start()}
+    for node in nodes.values():
+        node.mine(100)
+    yield nodes
+    for node in nodes.values():
+        node.stop()
+
+
+def probed(provider, timeout=2.0):
+    provider.probe()
+    deadline = time.time() + timeout
+    while any(endpoint.head is None for endpoint in provider.endpoints) and time.time() < deadline:
+        time.sleep(0.01)
+    return provider
+
+
+def test_race_skips_stale_and_slow_endpoints(nodes):
+    provider = probed(Transport().provider([node.url for node in nodes.values()]))
+    assert provider.ranked()[0].provider.endpoint_uri == nodes['healthy'].url
+    assert provider.ranked()[-1].provider.endpoint_uri == nodes['lagging'].url
+
+    start = time.perf_counter()
+    resp = provider.make_request('eth_blockNumber', [])
+    assert time.perf_counter() - start < nodes['slow'].delay
+    assert int(resp['result'], 16) == nodes['healthy'].head()
+    assert 'endpoint' not in resp
+
+
+def test_stale_answer_is_only_a_fallback(nodes):
+    # both are raced, the stale head answers first
+    provider = probed(Transport().provider([nodes['lagging'].url, nodes['healthy'].url]))
+    resp = provider.make_request('eth_blockNumber', [])
+    assert int(resp['result'], 16) == nodes['healthy'].head()
+
+
+def test_raw_transactions_are_broadcast(nodes):
+    provider = Transport().provider([node.url for node in nodes.values()])
+    account = Account.create()
+    signed = account.sign_transaction({'to': '0x' + '11' * 20, 'value': 0, 'gas': 21000, 'gasPrice': 5 * 10 ** 9,
+                                       'nonce': 0, 'chainId': 56})
+    resp = provider.make_request('eth_sendRawTransaction', [signed.rawTransaction.hex()])
+    assert 'endpoint' not in resp
+    deadline = time.time() + 2.0
+    while not all(resp['result'] in node.transactions for node in nodes.values()) and time.time() < deadline:
+        time.sleep(0.01)
+    assert all(resp['result'] in node.transactions for node in nodes.values())
+
+
+def test_rpc_errors_are_returned(nodes):
+    provider = Transport().provider([node.url for node in nodes.values()])
+    resp = provider.make_request('eth_unknownMethod', [])
+    assert resp['error']['code'] == -32601
+
+
+def test_race_without_endpoints_raises():
+    provider = Transport().provider([])
+    with pytest.raises(ConnectionError):
+        provider.make_request('eth_blockNumber', [])
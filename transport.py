@@ -0,0 +1,433 @@
+import asyncio
+import collections
+import contextlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import Web3
+from web3.eth import AsyncEth
+from web3.middleware import geth_poa_middleware
+from web3.middleware import simple_cache_middleware
+from web3.providers import JSONBaseProvider
+from web3.providers.async_base import AsyncJSONBaseProvider
+
+from core.metrics import default_metrics
+
+
+class PooledHTTPProvider(JSONBaseProvider):
+    """
+    JSON-RPC over a shared keep-alive requests.Session
+    web3's HTTPProvider caches one session per thread, this one is shared by every thread and client
+    """
+
+    def __init__(self, endpoint_uri, session, semaphore, timeout=10):
+        super(PooledHTTPProvider, self).__init__()
+        self.endpoint_uri = endpoint_uri
+        self.session = session
+        self.semaphore = semaphore
+        self.timeout = timeout
+
+    def __str__(self):
+        return 'RPC connection %s' % self.endpoint_uri
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        with self.semaphore:
+            resp = self.session.post(self.endpoint_uri, data=request_data, timeout=self.timeout,
+                                     headers={'Content-Type': 'application/json'})
+        resp.raise_for_status()
+        return self.decode_rpc_response(resp.content)
+
+    def make_batch_request(self, calls):
+        """Send [(method, params), ...] as one JSON-RPC batch, responses come back in call order"""
+        requests_data = [json.loads(self.encode_rpc_request(method, params)) for method, params in calls]
+        with self.semaphore:
+            resp = self.session.post(self.endpoint_uri, data=json.dumps(requests_data), timeout=self.timeout,
+                                     headers={'Content-Type': 'application/json'})
+        resp.raise_for_status()
+        responses = {item['id']: item for item in resp.json()}
+        return [responses[request['id']] for request in requests_data]
+
+
+class PooledAsyncHTTPProvider(AsyncJSONBaseProvider):
+    """Async JSON-RPC over one aiohttp session per event loop, connections capped at the endpoint limit"""
+
+    def __init__(self, endpoint_uri, limit, timeout=10):
+        super(PooledAsyncHTTPProvider, self).__init__()
+        self.endpoint_uri = endpoint_uri
+        self.limit = limit
+        self.timeout = timeout
+        self._sessions = {}
+
+    def __str__(self):
+        return 'Async RPC connection %s' % self.endpoint_uri
+
+    def session(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._sessions:
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60)
+            self._sessions[loop] = aiohttp.ClientSession(connector=connector, raise_for_status=True,
+                                                         timeout=aiohttp.ClientTimeout(self.timeout))
+        return self._sessions[loop]
+
+    async def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        async with self.session().post(self.endpoint_uri, data=request_data,
+                                       headers={'Content-Type': 'application/json'}) as resp:
+            return self.decode_rpc_response(await resp.read())
+
+    async def close(self):
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+
+class EndpointHealth:
+    """Rolling latency, head height and failure record of one endpoint"""
+
+    def __init__(self, provider, alpha=0.2):
+        self.provider = provider
+        self.alpha = alpha
+        self.latency = None
+        self.head = None
+        self.failures = 0
+        self.requests = 0
+
+    def record(self, latency, error=False):
+        self.requests += 1
+        self.latency = latency if self.latency is None else self.alpha * latency + (1 - self.alpha) * self.latency
+        self.failures = self.failures + 1 if error else max(self.failures - 1, 0)
+
+    def lag(self, best_head):
+        if self.head is None or best_head is None:
+            return 0
+        return max(best_head - self.head, 0)
+
+    def score(self, best_head, lag_penalty=1.0, failure_penalty=1.0):
+        """Seconds-equivalent cost, lower is better, each block of lag or recent failure adds a penalty"""
+        latency = self.latency if self.latency is not None else 0
+        return latency + self.lag(best_head) * lag_penalty + self.failures * failure_penalty
+
+    def __repr__(self):
+        return '<%s latency: %s ms, head: %s, failures: %s>' % (
+            self.provider.endpoint_uri, None if self.latency is None else round(self.latency * 1000, 2), self.head,
+            self.failures)
+
+
+class RacingProvider(JSONBaseProvider):
+    """
+    Fans read calls out to the best scored endpoints and returns the first consistent answer
+    An answer is consistent when its endpoint is within max_lag blocks of the highest head seen
+    Raw transactions are broadcast to every endpoint, filters stick to the endpoint that created them
+    """
+    broadcast_methods = {'eth_sendRawTransaction'}
+    sticky_methods = {'eth_getFilterChanges', 'eth_getFilterLogs', 'eth_uninstallFilter'}
+
+    def __init__(self, providers, fanout=2, max_lag=2, probe_interval=5, lag_penalty=1.0):
+        super(RacingProvider, self).__init__()
+        self.endpoints = [EndpointHealth(provider) for provider in providers]
+        self.fanout = fanout
+        self.max_lag = max_lag
+        self.probe_interval = probe_interval
+        self.lag_penalty = lag_penalty
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.endpoints), 1) * 4)
+        self.filters = {}
+        self.last_probe = 0
+
+    def __str__(self):
+        return 'Racing RPC connection %s' % ', '.join(e.provider.endpoint_uri for e in self.endpoints)
+
+    @property
+    def best_head(self):
+        heads = [e.head for e in self.endpoints if e.head is not None]
+        return max(heads) if heads else None
+
+    def ranked(self):
+        best_head = self.best_head
+        return sorted(self.endpoints, key=lambda e: e.score(best_head, lag_penalty=self.lag_penalty))
+
+    def consistent(self, endpoint):
+        return endpoint.lag(self.best_head) <= self.max_lag
+
+    def _request(self, endpoint, method, params):
+        start = time.perf_counter()
+        try:
+            resp = endpoint.provider.make_request(method, params)
+        except Exception:
+            endpoint.record(time.perf_counter() - start, error=True)
+            raise
+        endpoint.record(time.perf_counter() - start, error='error' in resp)
+        if method == 'eth_blockNumber' and 'result' in resp:
+            endpoint.head = int(resp['result'], 16)
+        return resp
+
+    def probe(self):
+        """Refresh every endpoint's head and latency in the background"""
+        self.last_probe = time.time()
+        for endpoint in self.endpoints:
+            self.executor.submit(self._request, endpoint, 'eth_blockNumber', [])
+
+    def make_request(self, method, params):
+        if time.time() - self.last_probe > self.probe_interval:
+            self.probe()
+        if method in self.sticky_methods and params and params[0] in self.filters:
+            return self._request(self.filters[params[0]], method, params)
+        if method in self.broadcast_methods:
+            resp = self.race(method, params, self.endpoints)
+            resp.pop('endpoint', None)
+            return resp
+        resp = self.race(method, params, self.ranked()[:self.fanout])
+        if method == 'eth_newBlockFilter' and 'result' in resp:
+            self.filters[resp['result']] = resp.pop('endpoint')
+        resp.pop('endpoint', None)
+        return resp
+
+    def make_batch_request(self, calls):
+        """Batches go to the best scored endpoint, falling through to the next one on failure"""
+        error = None
+        for endpoint in self.ranked():
+            start = time.perf_counter()
+            try:
+                resp = endpoint.provider.make_batch_request(calls)
+            except Exception as e:
+                endpoint.record(time.perf_counter() - start, error=True)
+                error = e
+                continue
+            endpoint.record(time.perf_counter() - start)
+            return resp
+        if error is None:
+            raise ConnectionError('no RPC endpoint to send the batch to')
+        raise error
+
+    def race(self, method, params, endpoints):
+        if not endpoints:
+            raise ConnectionError('no RPC endpoint to send %s to' % method)
+        futures = {self.executor.submit(self._request, endpoint, method, params): endpoint for endpoint in endpoints}
+        fallback = None
+        error = None
+        for future in as_completed(futures):
+            endpoint = futures[future]
+            try:
+                resp = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if 'error' in resp:
+                fallback = fallback or resp
+                continue
+            resp['endpoint'] = endpoint
+            if self.consistent(endpoint):
+                return resp
+            fallback = resp
+        if fallback is not None:
+            return fallback
+        if error is None:
+            raise ConnectionError('no RPC endpoint answered %s' % method)
+        raise error
+
+
+class RequestStats:
+    """
+    RPC requests per (tag, method), counted by a web3 middleware in the calling thread
+    The tag is whatever the thread is running under in tagged(), None otherwise
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def tagged(self, tag):
+        previous = getattr(self.local, 'tag', None)
+        self.local.tag = tag
+        try:
+            yield
+        finally:
+            self.local.tag = previous
+
+    def middleware(self, make_request, w3):
+        def middleware(method, params):
+            key = (getattr(self.local, 'tag', None), method)
+            with self.lock:
+                self.counts[key] += 1
+            return make_request(method, params)
+        return middleware
+
+    def by_tag(self):
+        resp = collections.Counter()
+        with self.lock:
+            for (tag, method), count in self.counts.items():
+                resp[tag] += count
+        return resp
+
+
+class Transport:
+    """
+    Shared connection pools keyed by endpoint, every client built on the same endpoint reuses one Web3
+    max_concurrency caps in-flight requests per endpoint, either an int for all endpoints or a dict endpoint -> limit
+    """
+
+    def __init__(self, pool_size=10, max_concurrency=10, timeout=10, metrics=default_metrics):
+        self.pool_size = pool_size
+        self.metrics = metrics
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.semaphores = {}
+        self.web3s = {}
+        self.async_web3s = {}
+        self.stats = RequestStats()
+
+    def limit(self, endpoint):
+        if isinstance(self.max_concurrency, dict):
+            return self.max_concurrency.get(endpoint, self.pool_size)
+        return self.max_concurrency
+
+    def session(self, endpoint):
+        with self.lock:
+            if endpoint not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(self.pool_size, self.limit(endpoint)))
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[endpoint] = session
+                self.semaphores[endpoint] = threading.BoundedSemaphore(self.limit(endpoint))
+            return self.sessions[endpoint]
+
+    def provider(self, endpoint):
+        if isinstance(endpoint, (list, tuple)):
+            return RacingProvider([self.provider(uri) for uri in endpoint])
+        session = self.session(endpoint)
+        return PooledHTTPProvider(endpoint, session, self.semaphores[endpoint], timeout=self.timeout)
+
+    def web3(self, endpoint):
+        """endpoint is a url, or a list of urls raced through a RacingProvider"""
+        if isinstance(endpoint, list):
+            endpoint = tuple(endpoint)
+        with self.lock:
+            w3 = self.web3s.get(endpoint)
+        if w3 is None:
+            w3 = Web3(self.provider(endpoint))
+            w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+            # chain id is re-validated on every eth_call, cache it so a read costs one round trip
+            w3.middleware_onion.add(simple_cache_middleware)
+            # innermost, so only requests that reach the provider are counted
+            w3.middleware_onion.inject(self.stats.middleware, name='request_stats', layer=0)
+            w3.middleware_onion.inject(self.metrics.middleware, name='rpc_timing', layer=0)
+            with self.lock:
+                w3 = self.web3s.setdefault(endpoint, w3)
+        return w3
+
+    def async_web3(self, endpoint):
+        if isinstance(endpoint, (list, tuple)):
+            # async reads go to whichever raced endpoint currently scores best
+            endpoint = self.web3(endpoint).provider.ranked()[0].provider.endpoint_uri
+        with self.lock:
+            if endpoint not in self.async_web3s:
+                self.async_web3s[endpoint] = Web3(PooledAsyncHTTPProvider(endpoint, self.limit(endpoint),
+                                                                          timeout=self.timeout),
+                                                  modules={'eth': (AsyncEth,)}, middlewares=[])
+            return self.async_web3s[endpoint]
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+            self.web3s.clear()
+
+
+default_transport = Transport()
+
+
+def _benchmark(node, clients=8, requests_per_client=200):
+    payload = json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'eth_blockNumber', 'params': []})
+
+    def unpooled():
+        # a fresh connection per request, what separate per-client and per-thread sessions degrade to
+        with requests.Session() as session:
+            session.post(node.url, data=payload, headers={'Content-Type': 'application/json'}).raise_for_status()
+
+    pooled = Transport(pool_size=clients, max_concurrency=clients).provider(node.url)
+
+    def run(name, call):
+        latencies = []
+
+        def client():
+            for _ in range(requests_per_client):
+                start = time.perf_counter()
+                call()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(clients) as pool:
+            for future in [pool.submit(client) for _ in range(clients)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        print('%-8s %8.0f req/s  p50 %.2f ms  p99 %.2f ms' % (
+            name, len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000))
+
+    run('unpooled', unpooled)
+    run('pooled', lambda: pooled.make_request('eth_blockNumber', []))
+
+    async_w3 = Transport(pool_size=clients, max_concurrency=clients).async_web3(node.url)
+
+    async def run_async():
+        latencies = []
+
+        async def client():
+            for _ in range(requests_per_client):
+                start = time.perf_counter()
+                await async_w3.provider.make_request('eth_blockNumber', [])
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client() for _ in range(clients)])
+        elapsed = time.perf_counter() - start
+        await async_w3.provider.close()
+        latencies.sort()
+        print('%-8s %8.0f req/s  p50 %.2f ms  p99 %.2f ms' % (
+            'async', len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000))
+
+    asyncio.run(run_async())
+
+
+def _race_benchmark(calls=50):
+    import statistics
+    from connect.stub_node import StubNode
+
+    # a fast node with a stale head, a slow node and a healthy one
+    nodes = [StubNode(delay=0.0, block_lag=5).start(), StubNode(delay=0.05).start(), StubNode(delay=0.01).start()]
+    for node in nodes:
+        node.mine(100)
+    w3 = Transport().web3([node.url for node in nodes])
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        w3.eth.get_block_number()
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.01)
+    print('raced   mean %.2f ms  max %.2f ms' % (statistics.mean(latencies) * 1000, max(latencies) * 1000))
+    for endpoint in w3.provider.ranked():
+        print('  ', endpoint)
+    for node in nodes:
+        node.stop()
+
+
+if __name__ == '__main__':
+    from connect.stub_node import StubNode
+
+    stub = StubNode().start()
+    _benchmark(stub)
+    stub.stop()
+    _race_benchmark()
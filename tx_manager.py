@@ -0,0 +1,92 @@
+import threading
+
+
+class NonceManager:
+    """
+    Hands out nonces from a local counter
+    The node is only asked for the pending transaction count on first use and after a failed send
+    """
+
+    def __init__(self, w3, address):
+        self.w3 = w3
+        self.address = address
+        self.lock = threading.RLock()
+        self.nonce = None
+
+    def resync(self):
+        with self.lock:
+            self.nonce = self.w3.eth.get_transaction_count(self.address, 'pending')
+            return self.nonce
+
+    def peek(self):
+        with self.lock:
+            return self.resync() if self.nonce is None else self.nonce
+
+    def reserve(self, nonce=None):
+        """Take the next nonce, or the given one if it is still next, None when it has already been used"""
+        with self.lock:
+            if nonce is not None and nonce != self.peek():
+                return None
+            nonce = self.peek()
+            self.nonce += 1
+            return nonce
+
+
+class PresignedBets:
+    """
+    BULL and BEAR bet transactions built and signed ahead of the lock window for a set of bet sizes
+    Firing one is a single eth_sendRawTransaction, no nonce, gas or chain id round trips
+    """
+
+    def __init__(self, w3, functions, nonces, private_key, sizes, gas, gas_price):
+        self.w3 = w3
+        self.functions = functions
+        self.nonces = nonces
+        self.private_key = private_key
+        self.sizes = sizes
+        self.gas = gas
+        self.gas_price = gas_price
+        self.chain_id = None
+        self.nonce = None
+        self.signed = {}
+
+    def set_gas_price(self, gas_price):
+        """Bid a new gas price, the signed set is dropped and re-signed on the next prepare() when it changed"""
+        if gas_price != self.gas_price:
+            self.gas_price = gas_price
+            self.signed = {}
+
+    def fresh(self):
+        return bool(self.signed) and self.nonce == self.nonces.peek()
+
+    def prepare(self):
+        """Sign every direction and size at the next nonce, skipped when the signed set is still usable"""
+        if self.fresh():
+            return
+        if self.chain_id is None:
+            self.chain_id = self.w3.eth.chain_id
+        nonce = self.nonces.peek()
+        signed = {}
+        for direction, function in self.functions.items():
+            for size in self.sizes:
+                tx = function().buildTransaction({'from': self.nonces.address,
+                                                  'value': self.w3.toWei(size, 'ether'),
+                                                  'gas': self.gas,
+                                                  'gasPrice': self.gas_price,
+                                                  'nonce': nonce,
+                                                  'chainId': self.chain_id})
+                signed[(direction, size)] = self.w3.eth.account.sign_transaction(tx, private_key=self.private_key)
+        self.nonce = nonce
+        self.signed = signed
+
+    def fire(self, direction, size):
+        """Send a pre-signed bet, None when there is no usable transaction for it"""
+        signed_txn = self.signed.get((direction, size))
+        if signed_txn is None or self.nonces.reserve(self.nonce) is None:
+            return None
+        self.signed = {}
+        try:
+            return self.w3.eth.send_raw_transaction(signed_txn.rawTransaction)
+        except Exception:
+            self.nonces.resync()
+            raise
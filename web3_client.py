@@ -1,43 +1,200 @@
+import collections
 import datetime as dt
+import functools
 import os
 import json
+import sqlite3
+import threading
 import time
 import pandas as pd
 import _thread
 import pytz
 from core import root
 from utils import logger
-from web3 import Web3
+from eth_utils import function_abi_to_4byte_selector
 from emoji import emojize
 from core import binance_client
 from utils import config_parser
 from tg_bot import tg_message_bot
-from web3.middleware import geth_poa_middleware
+from connect.transport import default_transport
+from core.metrics import default_metrics, register_functions
 
 wallet = binance_client.read_keys('metamask.txt')
+# seconds a head block stays current for 'latest' reads through the call cache, one BSC block
+HEAD_TTL = 3
 
 address_dict = {'contract_address': '0x0e09fabb73bd3ade0a17ecc321fd13a19e81ce82',
                 'pancake_bnb_prediction_address': '0x516ffd7D1e0Ca40b1879935B2De87cb20Fc1124b',
                 'chainlink_bnb_usdt_address': '0xD5c40f5144848Bd4EF08a9605d860e727b991513',
                 'chainlink_bnb_usd_address': '0x0567F2323251f0Aab15c8dFb1967E4e8A7D42aeE',
-                'address': '0x0E09FaBB73Bd3Ade0a17ECC321fD13a19e81cE82'}
+                'address': '0x0E09FaBB73Bd3Ade0a17ECC321fD13a19e81cE82',
+                'multicall3_address': '0xcA11bde05977b3631167028862bE2a173976CA11'}
 
 
+@functools.lru_cache(maxsize=None)
 def _load_abi(abi_name) -> str:
+    # parsed once per process, callers share the list and must not modify it
     path = os.path.join(root.ROOT_DIR, 'connect/assets/', abi_name)
     with open(path) as f:
         abi: str = json.load(f)
     return abi
 
 
+_contracts = {}
+_contracts_lock = threading.Lock()
+
+
+def load_contract(w3, abi_name, address):
+    """Contract object of an abi at an address, built once per Web3 and shared by every client on it"""
+    key = (w3, abi_name, address)
+    contract = _contracts.get(key)
+    if contract is None:
+        contract = w3.eth.contract(address=address, abi=_load_abi(abi_name))
+        # eth_call timings are labelled with the function name
+        register_functions({'0x' + function_abi_to_4byte_selector(fn_abi).hex(): fn_abi['name']
+                            for fn_abi in contract.abi if fn_abi.get('type') == 'function'})
+        with _contracts_lock:
+            contract = _contracts.setdefault(key, contract)
+    return contract
+
+
+class ChainConstants:
+    """
+    Chain values that seldom change (chain id, min bet amount) cached in a JSON file
+    A value older than ttl seconds is fetched again on its next read
+    """
+
+    def __init__(self, path, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.values = json.load(f)
+        except (OSError, ValueError):
+            self.values = {}
+
+    def get(self, key, fetch):
+        entry = self.values.get(key)
+        if entry is not None and time.time() - entry['updated_at'] < self.ttl:
+            return entry['value']
+        value = fetch()
+        with self.lock:
+            self.values[key] = {'value': value, 'updated_at': time.time()}
+            self.save()
+        return value
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.values, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+class CallCache:
+    """
+    Read-through cache of contract call results, keyed by contract address and calldata
+    Final entries (ended rounds, past block timestamps) never change and are kept for good, in memory and in the
+    optional sqlite file at `path` so they survive restarts. Other entries are only served for the block number they
+    were read at. The in-memory tier is an LRU of max_size entries, the keys of the sqlite file are loaded at start so
+    only a key known to be on disk costs a query
+    """
+
+    def __init__(self, path=None, max_size=10000, metrics=default_metrics):
+        self.max_size = max_size
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self.conn = None
+        self.persisted = set()
+        if path is not None:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS call_cache (key TEXT PRIMARY KEY, value TEXT)')
+            self.persisted = {row[0] for row in self.conn.execute('SELECT key FROM call_cache')}
+
+    def _count(self, label):
+        with self.lock:
+            self.counts[label] += 1
+        self.metrics.count('call_cache', label, label_name='tier')
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def _lookup(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return True, self.entries[key]
+        return False, None
+
+    def get(self, key, fetch, block=None, final=None):
+        """
+        Cached value of key, fetch() on a miss
+        The fetched value is kept for good when final(value) is true, otherwise for `block` only (not at all if None)
+        """
+        found, value = self._lookup(key)
+        if found:
+            self._count('hit')
+            return value
+        if block is not None:
+            found, value = self._lookup((key, block))
+            if found:
+                self._count('block_hit')
+                return value
+        if key in self.persisted:
+            # evicted from memory, the sqlite file still has it
+            with self.lock:
+                row = self.conn.execute('SELECT value FROM call_cache WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+                self._remember(key, value)
+                self._count('disk_hit')
+                return value
+        self._count('miss')
+        value = fetch()
+        if final is not None and final(value):
+            self._remember(key, value)
+            if self.conn is not None:
+                with self.lock, self.conn:
+                    self.conn.execute('INSERT OR REPLACE INTO call_cache VALUES (?, ?)', (key, json.dumps(value)))
+                    self.persisted.add(key)
+        elif block is not None:
+            self._remember((key, block), value)
+        return value
+
+    def stats(self):
+        """Hits by tier, misses and the share of reads served without an RPC request"""
+        with self.lock:
+            resp = dict(self.counts)
+        reads = sum(resp.values())
+        resp['hit_rate'] = (reads - resp.get('miss', 0)) / reads if reads else None
+        return resp
+
+
+default_call_cache = CallCache()
+
+
 class ContractConnectivity:
-    def __init__(self, abi_name, address, provider="https://bsc-dataseed.binance.org:443"):
-        self.w3 = Web3(Web3.HTTPProvider(provider))
-        self.w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+    def __init__(self, abi_name, address, provider="https://bsc-dataseed.binance.org:443", transport=default_transport,
+                 cache=default_call_cache):
+        # Clients on the same provider share one Web3 and its keep-alive connection pool
+        self.provider = provider
+        self.transport = transport
+        self.w3 = transport.web3(provider)
         self.contract = self._load_contact(abi_name=abi_name, address=address)
+        self.cache = cache
+        # last block number seen, 'latest' reads through the cache are taken at it while it is current
+        self.head = None
+        self.head_at = 0.0
 
     def _load_contact(self, abi_name, address):
-        return self.w3.eth.contract(address=address, abi=_load_abi(abi_name))
+        return load_contract(self.w3, abi_name, address)
 
     def get_balance(self):
         resp = self.w3.eth.get_balance(wallet[0])
@@ -46,19 +203,46 @@ class ContractConnectivity:
     def get_latest_block(self):
         return self.w3.eth.get_block_number()
 
+    def set_head(self, block_number):
+        self.head = block_number
+        self.head_at = time.time()
+
+    def cached_call(self, function, block_identifier='latest', final=None):
+        """
+        function.call() through the cache: kept for good when final(result) is true, otherwise reused within one block
+        A 'latest' read is pinned to the head block when it was set in the last HEAD_TTL seconds, otherwise it is only
+        served from the final entries
+        """
+        block = block_identifier
+        if block_identifier == 'latest':
+            block = self.head if time.time() - self.head_at < HEAD_TTL else None
+        if not isinstance(block, int):
+            block = None
+        key = '%s:%s' % (function.address, function._encode_transaction_data())
+        return self.cache.get(key, lambda: function.call(block_identifier=block if block is not None else 'latest'),
+                              block=block, final=final)
+
     def get_block_timestamp(self, block_number):
-        return dt.datetime.fromtimestamp(self.w3.eth.get_block(block_number).timestamp)
+        if not isinstance(block_number, int):
+            return dt.datetime.fromtimestamp(self.w3.eth.get_block(block_number).timestamp)
+        timestamp = self.cache.get('block_timestamp:%s:%s' % (self.provider, block_number),
+                                   lambda: self.w3.eth.get_block(block_number).timestamp, final=lambda value: True)
+        return dt.datetime.fromtimestamp(timestamp)
 
     def show_all_functions(self):
         return self.contract.all_functions()
 
 
 class ChainlinkConnectivity(ContractConnectivity):
-    def __init__(self, abi_name, address, provider="https://bsc-dataseed.binance.org:443", logging=False):
-        super(ChainlinkConnectivity, self).__init__(abi_name=abi_name, address=address, provider=provider)
+    def __init__(self, abi_name, address, provider="https://bsc-dataseed.binance.org:443", logging=False,
+                 transport=default_transport, cache=default_call_cache):
+        super(ChainlinkConnectivity, self).__init__(abi_name=abi_name, address=address, provider=provider,
+                                                    transport=transport, cache=cache)
 
     def latest_round_data(self):
-        resp = self.contract.functions.latestRoundData().call()
+        return self.parse_round_data(self.contract.functions.latestRoundData().call())
+
+    def parse_round_data(self, resp):
         keys = ['round_id', 'answer', 'started_at', 'update_at', 'answered_in_round']
         resp = dict(zip(keys, resp))
         resp['started_at'] = dt.datetime.fromtimestamp(resp['started_at'])